@@ -0,0 +1,179 @@
+"""產生與 online_retail_II.xlsx 相同欄位的合成交易資料（固定種子，可重現）
+
+欄位：Invoice, StockCode, Description, Quantity, InvoiceDate, Price, Customer ID, Country。
+比例參考原始資料：約 22% 的發票沒有 Customer ID、0.4% 的行沒有 Description、約 2% 為退貨
+（Invoice 以 C 開頭、Quantity < 0），SKU 和客戶的購買次數呈 Zipf 分佈，約九成來自 United Kingdom。
+
+    python benchmarks/generate_data.py --rows 1000000 --output benchmarks/data/retail_1m.parquet
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retail.export import EXCEL_MAX_ROWS, ChunkedFrame, ExcelExporter  # noqa: E402
+
+COLUMNS = ['Invoice', 'StockCode', 'Description', 'Quantity', 'InvoiceDate', 'Price', 'Customer ID', 'Country']
+GENERATE_CHUNK_ROWS = 1_000_000
+
+MISSING_CUSTOMER_RATE = 0.22     # 以發票為單位
+MISSING_DESCRIPTION_RATE = 0.004  # 以行為單位，這些行的 Price 為 0
+RETURN_INVOICE_RATE = 0.02        # 以發票為單位
+ZERO_PRICE_RATE = 0.005
+LINES_PER_INVOICE = 20            # 平均值，幾何分佈
+SKU_SKEW = 1.0                    # 第 k 熱門的權重為 1 / k^skew
+CUSTOMER_SKEW = 0.8
+START_DATE = pd.Timestamp('2009-12-01 07:45')
+SPAN_MINUTES = 740 * 24 * 60
+
+COUNTRIES = ['United Kingdom', 'Germany', 'France', 'EIRE', 'Netherlands', 'Spain', 'Belgium',
+             'Switzerland', 'Portugal', 'Australia', 'Sweden', 'Italy', 'Norway', 'Japan', 'USA']
+COUNTRY_WEIGHTS = [0.90, 0.02, 0.017, 0.017, 0.006, 0.005, 0.004,
+                   0.004, 0.003, 0.003, 0.003, 0.003, 0.002, 0.002, 0.011]
+
+
+class RetailGenerator:
+    """依固定種子產生交易資料；同一組 (rows, seed) 每次產生完全相同的分塊"""
+
+    def __init__(self, rows, seed=0):
+        self.rows = rows
+        self.seed = seed
+        rng = np.random.default_rng([seed, 0])
+
+        # SKU 和客戶數量隨資料量增加（原始資料約 100 萬行、5 千個 SKU、6 千個客戶）
+        n_skus = int(np.clip(rows / 200, 500, 50_000))
+        n_customers = int(np.clip(rows / 180, 1_000, 5_000_000))
+
+        codes = 10000 + rng.choice(90000, n_skus, replace=False)
+        suffixed = rng.random(n_skus) < 0.15
+        letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))[rng.integers(0, 26, n_skus)]
+        # 原始資料的 StockCode 大多是整數，少數帶字母後綴（Excel 中為混合型別）
+        self.sku_codes = np.array([f'{code}{letter}' if s else int(code)
+                                   for code, letter, s in zip(codes, letters, suffixed)], dtype=object)
+        self.sku_descriptions = np.array([f'PRODUCT {code}' for code in self.sku_codes], dtype=object)
+        self.sku_prices = np.round(rng.lognormal(mean=0.9, sigma=0.8, size=n_skus), 2)
+
+        self.sku_cdf = self._zipf_cdf(n_skus, SKU_SKEW)
+        self.customer_cdf = self._zipf_cdf(n_customers, CUSTOMER_SKEW)
+
+        self.customer_ids = (12346 + np.arange(n_customers)).astype(float)
+        country_weights = np.array(COUNTRY_WEIGHTS) / sum(COUNTRY_WEIGHTS)
+        self.customer_countries = rng.choice(len(COUNTRIES), n_customers, p=country_weights)
+        self.country_weights = country_weights
+        self.countries = np.array(COUNTRIES, dtype=object)
+
+    @staticmethod
+    def _zipf_cdf(n, skew):
+        """有限 Zipf 分佈的累積機率（索引 0 最熱門）"""
+        weights = 1.0 / np.arange(1, n + 1) ** skew
+        return np.cumsum(weights) / weights.sum()
+
+    @staticmethod
+    def _sample(rng, cdf, size):
+        return np.minimum(np.searchsorted(cdf, rng.random(size)), len(cdf) - 1)
+
+    def chunks(self, chunk_rows=GENERATE_CHUNK_ROWS):
+        """逐塊產生 DataFrame；發票編號、日期在整份資料中遞增"""
+        invoice_offset = 0
+        for index, start in enumerate(range(0, self.rows, chunk_rows)):
+            n = min(chunk_rows, self.rows - start)
+            rng = np.random.default_rng([self.seed, index + 1])
+
+            # 發票層級：每張發票的行數、客戶、國家、是否退貨
+            sizes = rng.geometric(1 / LINES_PER_INVOICE, n // LINES_PER_INVOICE * 2 + 10)
+            sizes = sizes[:np.searchsorted(np.cumsum(sizes), n) + 1]
+            sizes[-1] -= sizes.sum() - n
+            n_invoices = len(sizes)
+            row_invoice = np.repeat(np.arange(n_invoices), sizes)
+
+            customer = self._sample(rng, self.customer_cdf, n_invoices)
+            missing_customer = rng.random(n_invoices) < MISSING_CUSTOMER_RATE
+            invoice_customer = np.where(missing_customer, np.nan, self.customer_ids[customer])
+            invoice_country = np.where(missing_customer,
+                                       rng.choice(len(COUNTRIES), n_invoices, p=self.country_weights),
+                                       self.customer_countries[customer])
+            is_return = rng.random(n_invoices) < RETURN_INVOICE_RATE
+            numbers = 489434 + invoice_offset + np.arange(n_invoices)
+            invoice_numbers = np.array([f'C{number}' if r else int(number)
+                                        for number, r in zip(numbers, is_return)], dtype=object)
+            invoice_offset += n_invoices
+
+            # 日期隨行號遞增，發票內相同
+            first_row = np.concatenate([[0], np.cumsum(sizes)[:-1]]) + start
+            minutes = (first_row / self.rows * SPAN_MINUTES).astype('int64')
+            invoice_dates = START_DATE + pd.to_timedelta(minutes, unit='min')
+
+            # 行層級：SKU、數量、價格
+            sku = self._sample(rng, self.sku_cdf, n)
+            quantity = rng.geometric(0.15, n)
+            quantity = np.where(is_return[row_invoice], -quantity, quantity)
+            price = self.sku_prices[sku].copy()
+            price[rng.random(n) < ZERO_PRICE_RATE] = 0.0
+            description = self.sku_descriptions[sku].copy()
+            customer_ids = invoice_customer[row_invoice]
+            missing_description = rng.random(n) < MISSING_DESCRIPTION_RATE
+            description[missing_description] = None
+            # 原始資料中缺 Description 的行同時沒有 Customer ID 且 Price 為 0
+            customer_ids[missing_description] = np.nan
+            price[missing_description] = 0.0
+
+            yield pd.DataFrame({
+                'Invoice': invoice_numbers[row_invoice],
+                'StockCode': self.sku_codes[sku],
+                'Description': description,
+                'Quantity': quantity,
+                'InvoiceDate': invoice_dates[row_invoice],
+                'Price': price,
+                'Customer ID': customer_ids,
+                'Country': self.countries[invoice_country[row_invoice]],
+            }, columns=COLUMNS)
+
+
+def write_dataset(rows, output_path, seed=0, chunk_rows=GENERATE_CHUNK_ROWS):
+    """依副檔名（.xlsx、.csv、.parquet）逐塊寫出合成資料，記憶體只與 chunk_rows 有關"""
+    generator = RetailGenerator(rows, seed)
+    extension = os.path.splitext(output_path)[1].lower()
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if extension == '.xlsx':
+        if rows >= EXCEL_MAX_ROWS:
+            raise ValueError(f"{rows} 行超過 Excel 工作表上限 {EXCEL_MAX_ROWS}，請改用 .csv 或 .parquet")
+        with ExcelExporter(output_path) as exporter:
+            exporter.write_sheet('Sheet1', ChunkedFrame(COLUMNS, lambda: generator.chunks(chunk_rows)))
+    elif extension == '.csv':
+        for i, chunk in enumerate(generator.chunks(chunk_rows)):
+            chunk.to_csv(output_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    elif extension == '.parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        for chunk in generator.chunks(chunk_rows):
+            # Invoice、StockCode 在 Excel 中是混合型別，Parquet 需要統一為字串
+            chunk['Invoice'] = chunk['Invoice'].astype(str)
+            chunk['StockCode'] = chunk['StockCode'].astype(str)
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+    else:
+        raise ValueError(f"不支援的輸出格式: {extension}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='產生合成 Online Retail 交易資料')
+    parser.add_argument('--rows', type=int, required=True, help='資料行數（例如 100000 到 100000000）')
+    parser.add_argument('--output', required=True, help='輸出檔案（.xlsx、.csv 或 .parquet）')
+    parser.add_argument('--seed', type=int, default=0, help='隨機種子（預設 0）')
+    args = parser.parse_args()
+
+    write_dataset(args.rows, args.output, seed=args.seed)
+    print(f"已寫入 {args.output} ({args.rows} 行，seed={args.seed})")
@@ -0,0 +1,261 @@
+"""擴展性基準測試：對不同資料量執行兩個腳本，記錄每個步驟的耗時和峰值記憶體
+
+每個資料量先以 generate_data.py 產生（已存在則重用），再在暫存目錄中依序執行
+execute_prompt.py 和 execute_return_abnormal.py。步驟以輸出中的 "=== 步驟X: ... ===" 標題切分，
+子進程的 RSS 在背景定時取樣，取每個步驟期間的最大值。
+
+    python benchmarks/run_benchmarks.py --sizes 100000 1000000 10000000
+    python benchmarks/run_benchmarks.py --sizes 1000000 --baseline benchmarks/results/上一版.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_data import write_dataset  # noqa: E402
+
+try:
+    import psutil
+    RSS_ERRORS = (OSError, ValueError, psutil.Error)
+except ImportError:
+    psutil = None
+    RSS_ERRORS = (OSError, ValueError)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = ['execute_prompt.py', 'execute_return_abnormal.py']
+STEP_BANNER = re.compile(r'^=== (.+?) ===\s*$')
+STARTUP_STEP = '啟動'
+SAMPLE_INTERVAL = 0.05
+
+
+def _rss_bytes(pid):
+    """子進程目前的 RSS；有 psutil 時包含 --workers 的子進程，否則讀取 /proc（只限 Linux）"""
+    try:
+        if psutil is not None:
+            process = psutil.Process(pid)
+            return sum(p.memory_info().rss for p in [process] + process.children(recursive=True))
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except RSS_ERRORS:
+        return None
+
+
+def run_script(script, script_args, cwd, log_path):
+    """執行一個腳本，回傳 (returncode, 總秒數, 步驟列表)；步驟為 {'step', 'seconds', 'peak_rss_mb'}"""
+    env = dict(os.environ, PYTHONIOENCODING='utf-8')
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-u', os.path.join(REPO_DIR, script)] + script_args,
+                               cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               text=True, encoding='utf-8', env=env)
+
+    samples = []
+
+    def sample():
+        while process.poll() is None:
+            rss = _rss_bytes(process.pid)
+            if rss is not None:
+                samples.append((time.perf_counter(), rss))
+            time.sleep(SAMPLE_INTERVAL)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+
+    events = [(started, STARTUP_STEP)]
+    with open(log_path, 'w', encoding='utf-8') as log:
+        for line in process.stdout:
+            log.write(line)
+            match = STEP_BANNER.match(line.strip())
+            if match:
+                events.append((time.perf_counter(), match.group(1).split(':')[0].strip()))
+    returncode = process.wait()
+    finished = time.perf_counter()
+    sampler.join()
+
+    steps = []
+    for i, (step_start, name) in enumerate(events):
+        step_end = events[i + 1][0] if i + 1 < len(events) else finished
+        window = [rss for t, rss in samples if step_start <= t < step_end]
+        if not window:
+            # 步驟太短沒有取樣時，以步驟開始前最後一次取樣為準
+            before = [rss for t, rss in samples if t < step_start]
+            window = before[-1:]
+        steps.append({
+            'step': name,
+            'seconds': round(step_end - step_start, 4),
+            'peak_rss_mb': round(max(window) / 2 ** 20, 1) if window else None,
+        })
+    return returncode, round(finished - started, 4), steps
+
+
+def dataset_path(data_dir, rows, seed, fmt):
+    return os.path.join(data_dir, f'retail_{rows}_seed{seed}.{fmt}')
+
+
+def run_size(rows, args):
+    """產生（或重用）一個資料量的資料，執行兩個腳本，回傳各腳本的結果"""
+    data_path = os.path.abspath(dataset_path(args.data_dir, rows, args.seed, args.format))
+    if not os.path.exists(data_path):
+        print(f"產生 {rows} 行合成資料到 {data_path}...")
+        generate_started = time.perf_counter()
+        write_dataset(rows, data_path, seed=args.seed)
+        print(f"  耗時 {time.perf_counter() - generate_started:.1f} 秒")
+
+    work_dir = tempfile.mkdtemp(prefix=f'retail_bench_{rows}_')
+    script_args = {
+        'execute_prompt.py': ['--input', data_path] + shlex.split(args.prompt_args),
+        'execute_return_abnormal.py': shlex.split(args.return_args),
+    }
+    results = []
+    try:
+        for script in SCRIPTS:
+            log_path = os.path.join(work_dir, script.replace('.py', '.log'))
+            returncode, seconds, steps = run_script(script, script_args[script], work_dir, log_path)
+            peaks = [step['peak_rss_mb'] for step in steps if step['peak_rss_mb'] is not None]
+            # 腳本自己寫出的執行報告（CPU 時間、行數）一併保存
+            report_path = os.path.join(work_dir, script.replace('.py', '.report.json'))
+            report = None
+            if os.path.exists(report_path):
+                with open(report_path, 'r', encoding='utf-8') as f:
+                    report = json.load(f)
+            results.append({
+                'rows': rows,
+                'format': args.format,
+                'seed': args.seed,
+                'script': script,
+                'args': script_args[script],
+                'returncode': returncode,
+                'seconds': seconds,
+                'peak_rss_mb': max(peaks) if peaks else None,
+                'steps': steps,
+                'report': report,
+            })
+            print(f"  {script}: {seconds:.2f} 秒，峰值 {results[-1]['peak_rss_mb']} MB")
+            if returncode != 0:
+                print(f"  錯誤: {script} 結束碼 {returncode}，輸出見 {log_path}")
+                args.keep_work = True
+                break
+    finally:
+        if args.keep_work:
+            print(f"  工作目錄保留在 {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def steps_table(runs):
+    """攤平成 (script, step, rows) 一行的 DataFrame；同名步驟（例如重複標題）加總"""
+    records = []
+    for run in runs:
+        for order, step in enumerate(run['steps']):
+            records.append({'script': run['script'], 'step': step['step'], 'order': order, 'rows': run['rows'],
+                            'seconds': step['seconds'], 'peak_rss_mb': step['peak_rss_mb']})
+    if not records:
+        return pd.DataFrame(columns=['script', 'step', 'order', 'rows', 'seconds', 'peak_rss_mb'])
+    table = pd.DataFrame(records)
+    return table.groupby(['script', 'step', 'rows'], sort=False).agg(
+        order=('order', 'min'), seconds=('seconds', 'sum'), peak_rss_mb=('peak_rss_mb', 'max')).reset_index()
+
+
+def print_scaling(runs):
+    """每個步驟在各資料量下的秒數和峰值記憶體，以及每百萬行秒數（看出非線性的擴展斷崖）"""
+    table = steps_table(runs)
+    for script, script_table in table.groupby('script', sort=False):
+        print(f"\n--- {script} ---")
+        order = script_table.groupby('step', sort=False)['order'].min().sort_values().index
+        seconds = script_table.pivot(index='step', columns='rows', values='seconds').reindex(order)
+        memory = script_table.pivot(index='step', columns='rows', values='peak_rss_mb').reindex(order)
+        print("秒數:")
+        print(seconds.round(3).to_string())
+        print("峰值 RSS (MB):")
+        print(memory.to_string())
+        if seconds.shape[1] > 1:
+            per_million = seconds.div(seconds.columns.to_series() / 1e6, axis=1)
+            print("每百萬行秒數:")
+            print(per_million.round(3).to_string())
+
+
+def compare_baseline(runs, baseline_path, threshold):
+    """與先前的結果比較，回傳超過門檻的 (script, step, rows, 指標, 舊值, 新值) 列表"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    current = steps_table(runs).set_index(['script', 'step', 'rows'])
+    previous = steps_table(baseline['runs']).set_index(['script', 'step', 'rows'])
+    joined = current.join(previous, how='inner', lsuffix='', rsuffix='_baseline')
+
+    regressions = []
+    for (script, step, rows), row in joined.iterrows():
+        for metric in ('seconds', 'peak_rss_mb'):
+            old, new = row[f'{metric}_baseline'], row[metric]
+            # 太短的步驟受計時噪音影響，不判斷回歸
+            if pd.isna(old) or pd.isna(new) or (metric == 'seconds' and old < 0.1):
+                continue
+            if new > old * (1 + threshold):
+                regressions.append((script, step, rows, metric, old, new))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Online Retail 腳本的擴展性基準測試')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000],
+                        help='資料行數（預設 100000 1000000，可到 100000000）')
+    parser.add_argument('--seed', type=int, default=0, help='合成資料的隨機種子（預設 0）')
+    parser.add_argument('--format', choices=['parquet', 'csv', 'xlsx'], default='parquet',
+                        help='合成資料格式（預設 parquet；xlsx 受 Excel 行數上限限制）')
+    parser.add_argument('--data-dir', default=os.path.join(BENCH_DIR, 'data'), help='合成資料目錄')
+    parser.add_argument('--output', help='結果 JSON（預設 benchmarks/results/<時間>.json）')
+    parser.add_argument('--prompt-args', default='', help='傳給 execute_prompt.py 的額外參數，例如 "--no-cache --workers 3"')
+    parser.add_argument('--return-args', default='', help='傳給 execute_return_abnormal.py 的額外參數')
+    parser.add_argument('--baseline', help='先前的結果 JSON，列出耗時或記憶體增加超過門檻的步驟')
+    parser.add_argument('--threshold', type=float, default=0.2, help='回歸門檻（預設 0.2，即 20%%）')
+    parser.add_argument('--keep-work', action='store_true', help='保留每個資料量的工作目錄和輸出記錄')
+    args = parser.parse_args()
+
+    if psutil is None and not os.path.exists('/proc/self/statm'):
+        print("警告: 未安裝 psutil 且無 /proc，無法記錄記憶體")
+
+    runs = []
+    for rows in args.sizes:
+        print(f"\n=== {rows} 行 ===")
+        runs += run_size(rows, args)
+
+    print_scaling(runs)
+
+    output = args.output or os.path.join(BENCH_DIR, 'results', datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'runs': runs,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"\n已寫入結果 {output}")
+
+    failed = any(run['returncode'] != 0 for run in runs)
+    if args.baseline:
+        regressions = compare_baseline(runs, args.baseline, args.threshold)
+        if regressions:
+            print(f"\n與 {args.baseline} 相比超過 {args.threshold:.0%} 的步驟:")
+            for script, step, rows, metric, old, new in regressions:
+                print(f"  {script} {step} ({rows} 行) {metric}: {old} -> {new}")
+        else:
+            print(f"\n與 {args.baseline} 相比沒有超過 {args.threshold:.0%} 的步驟")
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
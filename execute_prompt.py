@@ -1,34 +1,194 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+
 import pandas as pd
-import numpy as np
-from datetime import datetime
 
-# 讀取資料
-print("正在讀取 online_retail_II.xlsx...")
-df = pd.read_excel('online_retail_II.xlsx')
+from retail.dataset import DATASET_DIR, SUMMARY_CACHE, seed_summaries, write_dataset
+from retail.duplicates import DUPLICATE_SHEET, DUPLICATE_TYPE_COLUMN, split_duplicates
+from retail.export import EXCEL_MAX_ROWS, ChunkedFrame, ExcelExporter
+from retail.handoff import (HANDOFF_DIR, PartitionWriter, clear_partitions, iter_partition_chunks,
+                            open_partitions, read_manifest, write_partitions)
+from retail.hll import DEFAULT_PRECISION, save_sketches, split_sketches, standard_error
+from retail.ingest import (apply_schema, check_required, compact_frame, file_fingerprint, load_source, projection,
+                           read_header, resolve_columns)
+from retail.kpi import (KPI_STATE_DIR, KpiState, aov_arpu_table, append_source, apply_aov_arpu,
+                        apply_growth, merge_monthly, monthly_kpis_table)
+from retail.metrics import abnormal_mask, return_mask, row_metric
+from retail.parts import expand_sources, load_parts, part_label
+from retail.profiling import add_profiling_arguments, profiler_from_args
+from retail.rfm import RFM_COLUMNS, rfm_snapshots, score_rfm, segment_transitions
+from retail.stages import PROMPT_STAGES, run_stages
+from retail.stream import DEFAULT_CHUNK_ROWS, StreamingAggregator, iter_source_chunks
+from retail.timeindex import add_time_index, format_months
+from retail.topk import top_k
+
+parser = argparse.ArgumentParser(description='Online Retail 數據清理、KPI 與 RFM 分析')
+parser.add_argument('--input', nargs='+', default=['online_retail_II.xlsx'],
+                    help='原始資料檔（.xlsx、.csv 或 .parquet，預設 online_retail_II.xlsx）；'
+                         '可指定多個檔案或 glob，Excel 的所有工作表都會載入並合併，部分之間重疊的行只保留一份')
+parser.add_argument('--no-cache', action='store_true',
+                    help='不使用欄式快取，直接解析原始資料檔')
+parser.add_argument('--stream', action='store_true',
+                    help='串流模式：分塊讀取並累加匯總，記憶體只與分組數量有關（不寫入明細工作表）')
+parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS,
+                    help=f'串流模式每塊行數（預設 {DEFAULT_CHUNK_ROWS}）')
+parser.add_argument('--compact', action='store_true',
+                    help='緊湊型別：低基數文字列轉為 categorical，Customer ID 轉為 Int32，Quantity 轉為 int32')
+parser.add_argument('--append', metavar='FILE',
+                    help='只讀取新月份的資料檔，更新 KPI 狀態並輸出 月度KPI.xlsx（不重算完整歷史；'
+                         '狀態以 --dedup 或多個資料來源建立時不支援）')
+parser.add_argument('--workers', type=int, default=1,
+                    help='多個資料檔/工作表在多個進程中並行解析；步驟6、8、9 的匯總在多個進程中並行執行（需要 pyarrow；串流模式不適用）')
+parser.add_argument('--engine', choices=['pandas', 'duckdb'], default='pandas',
+                    help='計算引擎：pandas（預設）或 duckdb（多執行緒、超過記憶體上限時溢寫到磁碟，需要 duckdb）')
+parser.add_argument('--memory-limit',
+                    help='duckdb 引擎的記憶體上限，例如 4GB（預設由 DuckDB 決定）')
+parser.add_argument('--distinct', choices=['exact', 'hll'], default='exact',
+                    help='每月客戶數、SKU Diversity、各國客戶數的不重複計數：exact（預設）或 hll（HyperLogLog 近似，附誤差）')
+parser.add_argument('--hll-precision', type=int, default=DEFAULT_PRECISION,
+                    help=f'HyperLogLog 暫存器數量為 2 的 N 次方（預設 {DEFAULT_PRECISION}，相對標準誤差約 0.81%%）')
+parser.add_argument('--rfm-snapshots', action='store_true',
+                    help='另外計算每個月底的 RFM 快照和分類轉移矩陣，寫入 RFM Snapshots、RFM Transitions 工作表')
+parser.add_argument('--rfm-sketch-k', type=int,
+                    help='以 KLL sketch（每層約 K 個值）近似 RFM 分位邊界，適合大量客戶；預設使用全部客戶的精確分位數')
+parser.add_argument('--top-capacity', type=int,
+                    help='串流模式下 Top SKUs 以 Space-Saving 只追蹤 N 個 SKU（記憶體固定，附 Revenue_Error 誤差上限）；預設精確加總')
+parser.add_argument('--dedup', action='store_true',
+                    help='所有列都相同的交易行只保留第一筆，其餘分類為 Duplicate Order（不計入 Normal/Return）')
+parser.add_argument('--dedup-window', type=float, metavar='SECONDS',
+                    help='另將 Invoice、StockCode、Quantity 相同且與前一筆相隔不超過 N 秒的交易行視為近似重複（隱含 --dedup）')
+parser.add_argument('--no-dataset', action='store_true',
+                    help=f'不更新按 YearMonth 分區的訂單資料集 {DATASET_DIR}/')
+parser.add_argument('--from-month', metavar='YYYY-MM',
+                    help=f'月度 KPI、AOV/ARPU 和 SKU Diversity 只計算此月份（含）之後；由 {DATASET_DIR}/ 只讀取範圍內的分區')
+parser.add_argument('--to-month', metavar='YYYY-MM',
+                    help='月度 KPI、AOV/ARPU 和 SKU Diversity 只計算此月份（含）之前')
+add_profiling_arguments(parser, __file__)
+args = parser.parse_args()
+
+# 每個步驟的耗時、行數和記憶體寫入 JSON 執行報告
+profiler = profiler_from_args(__file__, args)
+
+if args.append:
+    print(f"=== 追加 {args.append} 到月度 KPI 狀態 ===")
+    profiler.step('追加')
+    state = KpiState.load()
+    if state is None:
+        raise ValueError(f"找不到 KPI 狀態 {KPI_STATE_DIR}/，請先完整執行一次 execute_prompt.py")
+    touched = append_source(state, args.append, args.chunk_rows,
+                            options={'dedup': args.dedup or args.dedup_window is not None,
+                                     'dedup_window': args.dedup_window})
+    profiler.rows(rows_out=len(state.kpis))
+    state.save()
+    print(f"受影響的月份: {', '.join(touched) if touched else '無'}")
+
+    monthly_kpis_df = monthly_kpis_table(state.kpis)
+    aov_arpu_df = aov_arpu_table(state.kpis)
+    print("\n月度 KPI 預覽:")
+    print(monthly_kpis_df.tail(10))
+    print("\nAOV & ARPU KPI 預覽:")
+    print(aov_arpu_df.tail(10))
+
+    with pd.ExcelWriter('月度KPI.xlsx', engine='openpyxl') as writer:
+        monthly_kpis_df.to_excel(writer, sheet_name='Monthly KPI', index=False)
+        aov_arpu_df.to_excel(writer, sheet_name='AOV ARPU', index=False)
+    print("\n已保存月度 KPI 到 月度KPI.xlsx")
+    profiler.finish()
+    sys.exit(0)
+
+profiler.step('載入')
+
+# DuckDB 引擎：分區和步驟6、8、9 的匯總在 DuckDB 中執行，明細不需要整份載入 pandas
+engine = None
+if args.engine == 'duckdb':
+    try:
+        from retail.duckdb_engine import DuckDBEngine
+        engine = DuckDBEngine(memory_limit=args.memory_limit)
+    except ImportError:
+        print("警告: 未安裝 duckdb，改用 pandas 引擎")
+if engine is not None and (args.stream or args.compact):
+    print("警告: duckdb 引擎不需要 --stream 和 --compact，已忽略")
+    args.stream = args.compact = False
+
+# 展開檔案、glob 和 Excel 的工作表；多個部分時並行載入後合併為一份資料
+input_parts = expand_sources(args.input)
+input_path = input_parts[0][0]
+if len(input_parts) > 1:
+    print(f"資料來源: {len(input_parts)} 個部分")
+    for part in input_parts:
+        print(f"  - {part_label(part)}")
+    if engine is not None or args.stream:
+        print("警告: 多個資料來源需要合併並移除重疊的行，duckdb 引擎和串流模式改用 pandas 引擎")
+        engine = None
+        args.stream = False
+
+# 明細資料是否在記憶體中（否則寫入工作表時從交接檔逐塊讀取）
+details_in_memory = engine is None and not args.stream
+
+# HyperLogLog 不重複計數的精度；None 為精確計數
+hll_precision = args.hll_precision if args.distinct == 'hll' else None
+if hll_precision is not None and engine is not None:
+    print("警告: duckdb 引擎不支援 --distinct hll，改用精確計數")
+    hll_precision = None
+# 重複交易偵測需要完整的明細在記憶體中（雜湊表跨所有行）
+dedup = args.dedup or args.dedup_window is not None
+if dedup and not details_in_memory:
+    print("警告: 串流模式和 duckdb 引擎不支援 --dedup，已忽略")
+    dedup = False
+duplicate_count = 0
+if args.top_capacity is not None and not args.stream:
+    print("警告: --top-capacity 只用於串流模式，Top SKUs 改為精確計算")
+
+if len(input_parts) > 1:
+    # 各部分在 --workers 個進程中並行解析，統一型別後合併，移除部分之間重疊的行
+    df, source_columns = load_parts(input_parts, use_cache=not args.no_cache, workers=args.workers)
+    original_row_count = len(df)
+    profiler.rows(rows_out=original_row_count)
+    print(f"原始資料行數: {original_row_count}")
+else:
+    # 只讀取列名識別各角色的列，缺少必要的列時在載入資料之前報錯；之後只載入識別到的列
+    header = read_header(input_path, use_cache=not args.no_cache)
+    source_columns = resolve_columns(header)
+    check_required(source_columns, input_path)
+    source_projection = projection(header, source_columns)
+    print(f"載入 {len(source_projection)}/{len(header)} 列")
+
+    if engine is not None:
+        # 取前幾行用於識別列名，完整資料在步驟1-4中由 DuckDB 掃描
+        engine.register_source(input_path, use_cache=not args.no_cache, columns=source_projection)
+        df = engine.sample()
+    elif args.stream:
+        # 串流模式：先取第一塊用於識別列名，其餘分塊在步驟1-4中逐塊處理
+        chunks = iter_source_chunks(input_path, args.chunk_rows, use_cache=not args.no_cache, columns=source_projection)
+        df = next(chunks)
+        profiler.rows(rows_out=len(df))
+    else:
+        # 讀取資料（首次解析後寫入快取，原始檔未變更時直接從快取載入），套用宣告的型別並解析日期
+        df = apply_schema(load_source(input_path, use_cache=not args.no_cache, columns=source_projection),
+                          source_columns)
+        original_row_count = len(df)
+        profiler.rows(rows_out=original_row_count)
+        print(f"原始資料行數: {original_row_count}")
 
-print(f"原始資料行數: {len(df)}")
 print("\n資料列名:")
 print(df.columns.tolist())
 
 # 標準化列名（去除前後空格，統一大小寫處理）
 df.columns = df.columns.str.strip()
 
-# 查找相關列名（不區分大小寫）
-def find_column(df, keywords):
-    """查找包含關鍵詞的列名"""
-    keywords_lower = [k.lower() for k in keywords]
-    for col in df.columns:
-        col_lower = col.lower()
-        for keyword in keywords_lower:
-            if keyword in col_lower:
-                return col
-    return None
-
-quantity_col = find_column(df, ['Quantity', 'quantity', '數量'])
-customerid_col = find_column(df, ['Customer ID', 'CustomerID', 'Customer', 'customer'])
-description_col = find_column(df, ['Description', 'description', '描述'])
-price_col = find_column(df, ['Price', 'price', '價格', '單價'])
-date_col = find_column(df, ['InvoiceDate', 'Invoice Date', 'Date', 'date', '日期', '交易日期'])
+# 相關列名已由列名行識別（不區分大小寫），對應到去除空格後的名稱
+columns = {role: col.strip() if col else None for role, col in source_columns.items()}
+quantity_col = columns['quantity']
+customerid_col = columns['customerid']
+description_col = columns['description']
+price_col = columns['price']
+date_col = columns['date']
+stockcode_col = columns['stockcode']
+country_col = columns['country']
+invoice_col = columns['invoice']
 
 print("\n=== 識別的列名 ===")
 print(f"Quantity 列: {quantity_col}")
@@ -37,66 +197,160 @@ print(f"Description 列: {description_col}")
 print(f"Price 列: {price_col}")
 print(f"Date 列: {date_col}")
 
-# 檢查必要的列是否存在
-if not quantity_col:
-    raise ValueError("找不到 Quantity 列，請檢查資料文件")
-if not customerid_col:
-    raise ValueError("找不到 CustomerID 列，請檢查資料文件")
-if not description_col:
-    raise ValueError("找不到 Description 列，請檢查資料文件")
-if not price_col:
-    raise ValueError("找不到 Price 列，請檢查資料文件")
-if not date_col:
-    raise ValueError("找不到日期列，請檢查資料文件")
-
-# 步驟1: 計算 Total = Quantity * Price
-print("\n=== 步驟1: 計算 Total = Quantity * Price ===")
-df['Total'] = df[quantity_col] * df[price_col]
-print(f"已創建 Total 列")
-
-# 步驟2: 篩除 CustomerID 和 Description 缺失的資料
-print("\n=== 步驟2: 篩除 CustomerID 和 Description 缺失的資料 ===")
-missing_mask = (df[customerid_col].isna()) | (df[description_col].isna())
-abnormal_order = df[missing_mask].copy()
-abnormal_count = len(abnormal_order)
-print(f"CustomerID 或 Description 缺失的資料行數: {abnormal_count}")
-
-# 從原始資料中移除異常訂單資料
-df = df[~missing_mask].copy()
-
-# 步驟3: 篩除 Quantity < 0 的資料
-print("\n=== 步驟3: 篩除 Quantity < 0 的資料 ===")
-return_mask = df[quantity_col] < 0
-return_order = df[return_mask].copy()
-return_count = len(return_order)
-print(f"Quantity < 0 的資料行數: {return_count}")
-
-# 從資料中移除退貨訂單資料
-df = df[~return_mask].copy()
-
-# 步驟4: 剩餘資料為正常訂單
-print("\n=== 步驟4: 正常訂單 ===")
-normal_order = df.copy()
-normal_count = len(normal_order)
-print(f"正常訂單資料行數: {normal_count}")
+# 緊湊型別（在分類前轉換，三個分區共用同一組 categorical 字典）
+if args.compact and args.stream:
+    print("\n警告: 串流模式不支援 --compact，已忽略")
+elif args.compact:
+    print("\n=== 緊湊型別 ===")
+    profiler.step('緊湊型別', rows_in=len(df))
+    df, memory_report = compact_frame(
+        df,
+        text_columns=[columns[role] for role in ('stockcode', 'description', 'country', 'invoice')],
+        customerid_col=customerid_col,
+        quantity_col=quantity_col,
+    )
+    print(memory_report)
+
+if engine is not None:
+    # 步驟1-4 在 DuckDB 中執行：Total 和分區規則來自 metrics.py，明細逐批寫入 Arrow 交接檔
+    print("\n=== 步驟1-4（DuckDB）: 計算 Total，分類為 Abnormal/Return/Normal ===")
+    profiler.step('步驟1-4')
+    engine.classify(columns)
+    stats = engine.partition_stats()
+    abnormal_count, abnormal_total = stats['Abnormal Order']
+    return_count, return_total = stats['return order']
+    normal_count, normal_total = stats['Normal Order']
+    original_row_count = abnormal_count + return_count + normal_count
+
+    partition_writer = PartitionWriter()
+    for sheet_name in ('Abnormal Order', 'return order', 'Normal Order'):
+        for batch in engine.iter_partition(sheet_name):
+            partition_writer.write(sheet_name, batch)
+    partition_writer.close()
+    print(f"已寫入交接檔 {HANDOFF_DIR}/")
+    profiler.rows(rows_in=original_row_count, rows_out=original_row_count)
+    print(f"原始資料行數: {original_row_count}")
+    print(f"CustomerID 或 Description 缺失的資料行數: {abnormal_count}")
+    print(f"Quantity < 0 的資料行數: {return_count}")
+    print(f"正常訂單資料行數: {normal_count}")
+elif args.stream:
+    # 步驟1-4 逐塊執行：計算 Total、分類，並累加步驟5、6、8、9 所需的匯總
+    print("\n=== 步驟1-4（串流）: 逐塊計算 Total，分類為 Abnormal/Return/Normal 並累加匯總 ===")
+    profiler.step('步驟1-4')
+    aggregator = StreamingAggregator(
+        quantity_col, price_col, customerid_col, description_col, date_col,
+        stockcode_col=stockcode_col,
+        country_col=country_col,
+        invoice_col=invoice_col,
+        precision=hll_precision,
+        top_capacity=args.top_capacity,
+    )
+    # 明細資料逐塊寫入 Arrow 交接檔，不在記憶體中保留
+    try:
+        partition_writer = PartitionWriter()
+    except ImportError:
+        partition_writer = None
+        clear_partitions()
+        print("警告: 未安裝 pyarrow，串流模式不會寫出明細交接檔")
+
+    original_row_count = 0
+    for chunk in itertools.chain([df], chunks):
+        original_row_count += len(chunk)
+        abnormal_part, return_part, normal_part = aggregator.update(chunk)
+        if partition_writer is not None:
+            partition_writer.write('Abnormal Order', abnormal_part)
+            partition_writer.write('return order', return_part)
+            partition_writer.write('Normal Order', normal_part)
+    if partition_writer is not None:
+        partition_writer.close()
+
+    abnormal_count = aggregator.counts['Abnormal Order']
+    return_count = aggregator.counts['Return Order']
+    normal_count = aggregator.counts['Normal Order']
+    abnormal_total = aggregator.totals['Abnormal Order']
+    return_total = aggregator.totals['Return Order']
+    normal_total = aggregator.totals['Normal Order']
+    profiler.rows(rows_in=original_row_count, rows_out=abnormal_count + return_count + normal_count)
+    print(f"原始資料行數: {original_row_count}")
+    print(f"CustomerID 或 Description 缺失的資料行數: {abnormal_count}")
+    print(f"Quantity < 0 的資料行數: {return_count}")
+    print(f"正常訂單資料行數: {normal_count}")
+else:
+    # 步驟1: 計算 Total = Quantity * Price
+    print("\n=== 步驟1: 計算 Total = Quantity * Price ===")
+    profiler.step('步驟1', rows_in=len(df))
+    df['Total'] = row_metric(df, 'Total', columns)
+    profiler.rows(rows_out=len(df))
+    print(f"已創建 Total 列")
+
+    # 步驟2: 篩除 CustomerID 和 Description 缺失的資料
+    print("\n=== 步驟2: 篩除 CustomerID 和 Description 缺失的資料 ===")
+    profiler.step('步驟2', rows_in=len(df))
+    missing_mask = abnormal_mask(df, columns)
+    abnormal_order = df[missing_mask].copy()
+    abnormal_count = len(abnormal_order)
+    print(f"CustomerID 或 Description 缺失的資料行數: {abnormal_count}")
+
+    # 從原始資料中移除異常訂單資料
+    df = df[~missing_mask].copy()
+    profiler.rows(rows_out=abnormal_count)
+
+    # 步驟2.1: 篩除重複的交易（每行雜湊後以雜湊表比對，完全重複保留第一筆，近似重複保留同組最早的一筆）
+    if dedup:
+        print("\n=== 步驟2.1: 篩除重複的交易 ===")
+        profiler.step('步驟2.1', rows_in=len(df))
+        duplicate_order, df = split_duplicates(df, columns, args.dedup_window)
+        duplicate_count = len(duplicate_order)
+        duplicate_total = duplicate_order['Total'].sum() if duplicate_count > 0 else 0
+        print(f"完全重複的資料行數: {int((duplicate_order[DUPLICATE_TYPE_COLUMN] == 'Exact').sum())}")
+        if args.dedup_window is not None:
+            print(f"近似重複（{args.dedup_window:g} 秒內）的資料行數: "
+                  f"{int((duplicate_order[DUPLICATE_TYPE_COLUMN] == 'Near').sum())}")
+        profiler.rows(rows_out=duplicate_count)
+
+    # 步驟3: 篩除 Quantity < 0 的資料
+    print("\n=== 步驟3: 篩除 Quantity < 0 的資料 ===")
+    profiler.step('步驟3', rows_in=len(df))
+    returned_mask = return_mask(df, columns)
+    return_order = df[returned_mask].copy()
+    return_count = len(return_order)
+    print(f"Quantity < 0 的資料行數: {return_count}")
+
+    # 從資料中移除退貨訂單資料
+    df = df[~returned_mask].copy()
+    profiler.rows(rows_out=return_count)
+
+    # 步驟4: 剩餘資料為正常訂單
+    print("\n=== 步驟4: 正常訂單 ===")
+    profiler.step('步驟4', rows_in=len(df))
+    normal_order = df.copy()
+    normal_count = len(normal_order)
+    print(f"正常訂單資料行數: {normal_count}")
+
+    abnormal_total = abnormal_order['Total'].sum() if abnormal_count > 0 else 0
+    return_total = return_order['Total'].sum() if return_count > 0 else 0
+    normal_total = normal_order['Total'].sum() if normal_count > 0 else 0
+    profiler.rows(rows_out=normal_count)
 
 # 步驟5: 創建匯總統計
 print("\n=== 步驟5: 創建匯總統計 ===")
+profiler.step('步驟5', rows_in=abnormal_count + duplicate_count + return_count + normal_count)
 
 # 計算 Gross Order = Normal Order + Return Order
 gross_order_count = normal_count + return_count
-gross_order_total = (normal_order['Total'].sum() if normal_count > 0 else 0) + (return_order['Total'].sum() if return_count > 0 else 0)
+gross_order_total = normal_total + return_total
 
 summary_data = {
     '訂單類型': ['Abnormal Order', 'Normal Order', 'Return Order'],
     'Count': [abnormal_count, normal_count, return_count],
-    'Total': [
-        abnormal_order['Total'].sum() if abnormal_count > 0 else 0,
-        normal_order['Total'].sum() if normal_count > 0 else 0,
-        return_order['Total'].sum() if return_count > 0 else 0
-    ]
+    'Total': [abnormal_total, normal_total, return_total]
 }
 summary_df = pd.DataFrame(summary_data)
+if dedup:
+    # 重複交易接在 Abnormal Order 之後，總計仍等於原始資料行數
+    summary_df = pd.concat([summary_df.iloc[:1], pd.DataFrame({
+        '訂單類型': [DUPLICATE_SHEET], 'Count': [duplicate_count], 'Total': [duplicate_total]}),
+        summary_df.iloc[1:]], ignore_index=True)
 
 # 添加 Gross Order
 gross_order_data = pd.DataFrame({
@@ -118,135 +372,175 @@ summary_df = pd.concat([summary_df, gross_order_data, total_row], ignore_index=T
 print("\n匯總表:")
 print(summary_df)
 print(f"\nGross Order = Normal Order + Return Order: Count={gross_order_count}, Total={gross_order_total:.2f}")
+profiler.rows(rows_out=len(summary_df))
+
+# 步驟6、8、9 共用的前處理：日期解析和按月份、SKU、國家、客戶的匯總
+print("\n=== 步驟6-9 前處理: 處理日期並匯總月度、產品和客戶資料 ===")
+profiler.step('步驟6-9 前處理', rows_in=normal_count + return_count)
+
+if engine is not None:
+    # DuckDB 已在分區時解析日期並加上 YearMonth，以 SQL 建立訂單立方體
+    stage_results = engine.prompt_stage_results(columns)
+    stage_results.update(stage_results['cube'].summaries())
+elif args.stream:
+    # 串流模式已在分塊時解析日期，並累加訂單立方體和步驟9所需的匯總
+    stage_results = {
+        'cube': aggregator.cube,
+        'monthly': (aggregator.monthly('normal'), aggregator.monthly('return')),
+        'products': {
+            'sku_totals': aggregator.sku_totals() if stockcode_col else None,
+            'sku_diversity': aggregator.sku_diversity() if stockcode_col else None,
+            'country_totals': aggregator.country_totals() if country_col else None,
+        },
+        'customers': aggregator.customer_totals() if invoice_col else None,
+    }
+else:
+    # 日期以同一個明確格式只解析一次，移除無法解析的資料，YearMonth 為整數月份鍵（輸出時才格式化）
+    normal_order = add_time_index(normal_order, date_col)
+    return_order = add_time_index(return_order, date_col)
+
+    # 寫出 Arrow IPC 交接檔，供 execute_return_abnormal.py 和 --workers 的子進程以 memory map 讀取
+    try:
+        write_partitions({
+            'Normal Order': normal_order,
+            'Abnormal Order': abnormal_order,
+            'return order': return_order,
+            **({DUPLICATE_SHEET: duplicate_order} if dedup else {}),
+        })
+        print(f"\n已寫入交接檔 {HANDOFF_DIR}/")
+    except ImportError:
+        clear_partitions()
+        print("\n警告: 未安裝 pyarrow，execute_return_abnormal.py 將改為讀取 彙總表.xlsx")
+
+    # 訂單立方體（步驟6、8 的匯總都是它的投影）和步驟9的客戶匯總互不依賴，--workers 大於 1 時並行執行
+    stage_results = run_stages(
+        PROMPT_STAGES,
+        {'Normal Order': normal_order, 'Abnormal Order': abnormal_order, 'return order': return_order},
+        columns,
+        workers=args.workers,
+    )
+    stage_results.update(stage_results['cube'].summaries(hll_precision))
+order_cube = stage_results['cube']
+profiler.rows(rows_out=0 if order_cube is None else len(order_cube.cells))
+if order_cube is not None:
+    print(f"訂單立方體: {len(order_cube.cells)} 格 (YearMonth x Country x StockCode x 訂單類型)")
+    # 與交接檔一起保存，execute_return_abnormal.py 的退貨率直接由立方體投影
+    if read_manifest() is not None and order_cube.customers is not None:
+        order_cube.save()
+        print(f"已寫入訂單立方體到 {HANDOFF_DIR}/")
+
+# 三個分區按 YearMonth 寫成 Parquet 資料集，只重寫內容改變的月份；
+# execute_return_abnormal.py --from-month/--to-month 依 manifest 只讀取範圍內的檔案
+dataset_written = False
+if not args.no_dataset:
+    print(f"\n=== 更新 YearMonth 分區資料集 {DATASET_DIR}/ ===")
+    profiler.step('分區資料集', rows_in=normal_count + abnormal_count + return_count)
+    dataset_source = open_partitions()
+    if dataset_source is None:
+        print("警告: 未找到交接檔（需要 pyarrow），不更新分區資料集")
+    else:
+        for sheet_name, (rewritten, unchanged, removed) in write_dataset(dataset_source, date_col).items():
+            print(f"{sheet_name}: 重寫 {rewritten} 個月份，未變 {unchanged} 個，刪除 {removed} 個")
+        del dataset_source
+        dataset_written = True
+
+# 步驟6的月度匯總和 SKU Diversity 已由立方體投影：剛寫入的分區不必重新讀取，直接以這些結果建立 _summaries.json，
+# 之後對資料集的月份範圍查詢沿用（HyperLogLog 模式的客戶數是近似值，不寫入）
+month_range = args.from_month is not None or args.to_month is not None
+if dataset_written and hll_precision is None:
+    seeded = seed_summaries(stage_results['monthly'], stage_results['products']['sku_diversity'], columns)
+    print(f"月度匯總: 由記憶體中的結果寫入 {seeded} 個月份到 {DATASET_DIR}/{SUMMARY_CACHE}")
+if month_range:
+    # 由立方體的投影按月份篩選（每月一行，篩選與剪枝結果相同）
+    lower, upper = args.from_month or '0000-00', args.to_month or '9999-99'
+    stage_results['monthly'] = tuple(table[table['YearMonth'].between(lower, upper)].reset_index(drop=True)
+                                     for table in stage_results['monthly'])
+    sku_diversity = stage_results['products']['sku_diversity']
+    if sku_diversity is not None:
+        stage_results['products']['sku_diversity'] = sku_diversity[
+            sku_diversity['YearMonth'].between(lower, upper)].reset_index(drop=True)
 
 # 步驟6: 計算月度 KPI (Gross Revenue, Return, Revenue, Gross Orders, Return Orders, Normal Orders, Customer, Growth Rates)
 print("\n=== 步驟6: 計算月度 KPI (Gross Revenue, Return, Revenue, Gross Orders, Return Orders, Normal Orders, Customer, Growth Rates) ===")
 print("備註: Gross Revenue = -Return + Revenue, Gross Orders = -Return Orders + Normal Orders")
+profiler.step('步驟6')
 
-# 處理日期列
-normal_order[date_col] = pd.to_datetime(normal_order[date_col], errors='coerce')
-normal_order = normal_order.dropna(subset=[date_col])
-
-# 處理 Return Order 的日期列
-return_order[date_col] = pd.to_datetime(return_order[date_col], errors='coerce')
-return_order = return_order.dropna(subset=[date_col])
-
-# 添加年月列
-normal_order['YearMonth'] = normal_order[date_col].dt.to_period('M')
-return_order['YearMonth'] = return_order[date_col].dt.to_period('M')
-
-# 按月分組計算 Revenue, Orders, Customer (從 Normal Order)
-normal_monthly = normal_order.groupby('YearMonth').agg({
-    'Total': ['sum', 'count'],  # Revenue 和 Orders
-    customerid_col: 'nunique'   # Customers
-}).reset_index()
-normal_monthly.columns = ['YearMonth', 'Revenue', 'Normal_Orders', 'Customer']
-normal_monthly['YearMonth'] = normal_monthly['YearMonth'].astype(str)
-
-# 按月分組計算 Return Order KPI
-if return_count > 0:
-    return_monthly = return_order.groupby('YearMonth').agg({
-        'Total': ['sum', 'count'],
-        customerid_col: 'nunique'
-    }).reset_index()
-    return_monthly.columns = ['YearMonth', 'Return', 'Return_Orders', 'Return_Customers']
-    return_monthly['YearMonth'] = return_monthly['YearMonth'].astype(str)
-else:
-    return_monthly = pd.DataFrame(columns=['YearMonth', 'Return', 'Return_Orders', 'Return_Customers'])
+normal_monthly, return_monthly = stage_results['monthly']
 
-# 合併 Normal 和 Return 資料
-monthly_kpis = normal_monthly.merge(return_monthly, on='YearMonth', how='left').fillna(0)
+# HyperLogLog 模式：每月的暫存器從匯總表取出，步驟8之後保存，可合併任意月份範圍（精確模式沒有暫存器）
+normal_monthly, normal_sketches = split_sketches(normal_monthly)
+return_monthly, return_sketches = split_sketches(return_monthly)
+distinct_sketches = {**normal_sketches, **return_sketches}
 
-# 根據備註計算 Gross KPI: Gross Revenue = -Return + Revenue, Gross Orders = -Return Orders + Normal Orders
+# 合併 Normal 和 Return 資料，根據備註計算 Gross KPI: Gross Revenue = -Return + Revenue, Gross Orders = -Return Orders + Normal Orders
 # 注意：Return 和 Return_Orders 在 Return Order 中通常是負數（因為 Quantity < 0），所以 -Return 會變成正數
-monthly_kpis['Gross_Revenue'] = -monthly_kpis['Return'] + monthly_kpis['Revenue']
-monthly_kpis['Gross_Orders'] = -monthly_kpis['Return_Orders'] + monthly_kpis['Normal_Orders']
-
 # 注意：Customer 使用 Normal Order 的 Customer
-monthly_kpis['Customer'] = monthly_kpis['Customer']  # 保持 Normal Order 的 Customer
-
-# 排序並計算增長率
-monthly_kpis = monthly_kpis.sort_values('YearMonth')
-
-# Revenue, Orders, Customer Growth Rates (基於 Normal Order 的資料)
-monthly_kpis['Revenue_Growth'] = monthly_kpis['Revenue'].pct_change() * 100
-monthly_kpis['Orders_Growth'] = monthly_kpis['Normal_Orders'].pct_change() * 100
-monthly_kpis['Customer_Growth'] = monthly_kpis['Customer'].pct_change() * 100
-
-# Gross Growth Rates
-monthly_kpis['Gross_Revenue_Growth'] = monthly_kpis['Gross_Revenue'].pct_change() * 100
-monthly_kpis['Gross_Orders_Growth'] = monthly_kpis['Gross_Orders'].pct_change() * 100
+monthly_kpis = merge_monthly(normal_monthly, return_monthly)
 
-# 填充第一行的增長率為 0
-growth_cols = ['Revenue_Growth', 'Orders_Growth', 'Customer_Growth',
-               'Gross_Revenue_Growth', 'Gross_Orders_Growth']
-for col in growth_cols:
-    monthly_kpis[col] = monthly_kpis[col].fillna(0).round(2)
-
-# 格式化數值
-monthly_kpis['Gross_Revenue'] = monthly_kpis['Gross_Revenue'].round(2)
-monthly_kpis['Revenue'] = monthly_kpis['Revenue'].round(2)
-monthly_kpis['Return'] = monthly_kpis['Return'].round(2)
+# 計算增長率（Revenue, Orders, Customer 基於 Normal Order 的資料，以及 Gross Growth Rates），第一行為 0
+apply_growth(monthly_kpis)
 
 # 選擇需要的列（按順序：Gross Revenue, Return, Revenue, Gross Orders, Return Orders, Normal Orders, Customer, Growth Rates）
-monthly_kpis_df = monthly_kpis[['YearMonth', 
-                                 'Gross_Revenue', 'Return', 'Revenue',
-                                 'Gross_Orders', 'Return_Orders', 'Normal_Orders',
-                                 'Customer',
-                                 'Gross_Revenue_Growth', 'Gross_Orders_Growth',
-                                 'Revenue_Growth', 'Orders_Growth', 'Customer_Growth']].copy()
-
-# 重命名 Orders_Growth 為 Normal_Orders_Growth 以保持一致性
-monthly_kpis_df = monthly_kpis_df.rename(columns={'Orders_Growth': 'Normal_Orders_Growth'})
+# Orders_Growth 重命名為 Normal_Orders_Growth 以保持一致性
+monthly_kpis_df = monthly_kpis_table(monthly_kpis)
+profiler.rows(rows_in=len(normal_monthly) + len(return_monthly), rows_out=len(monthly_kpis_df))
 
 print("\n月度 KPI 預覽:")
 print(monthly_kpis_df.head(10))
 
 # 步驟7: 計算 AOV, ARPU, Growth (只使用 Revenue, Orders, Customer，不使用 Gross)
 print("\n=== 步驟7: 計算 AOV, ARPU, Growth (使用 Revenue, Normal_Orders, Customer，不使用 Gross) ===")
+profiler.step('步驟7', rows_in=len(monthly_kpis))
 
 # AOV = Average Order Value = Revenue / Orders
 # ARPU = Average Revenue Per User = Revenue / Customers
-aov_arpu_df = monthly_kpis_df[['YearMonth', 'Revenue', 'Normal_Orders', 'Customer']].copy()
-
-# 避免除零錯誤
-aov_arpu_df['AOV'] = (aov_arpu_df['Revenue'] / aov_arpu_df['Normal_Orders'].replace(0, np.nan)).round(2)
-aov_arpu_df['ARPU'] = (aov_arpu_df['Revenue'] / aov_arpu_df['Customer'].replace(0, np.nan)).round(2)
-
-# 計算增長率
-aov_arpu_df['AOV_Growth'] = aov_arpu_df['AOV'].pct_change() * 100
-aov_arpu_df['ARPU_Growth'] = aov_arpu_df['ARPU'].pct_change() * 100
-aov_arpu_df['AOV_Growth'] = aov_arpu_df['AOV_Growth'].fillna(0).round(2)
-aov_arpu_df['ARPU_Growth'] = aov_arpu_df['ARPU_Growth'].fillna(0).round(2)
-
-# 選擇需要的列
-aov_arpu_df = aov_arpu_df[['YearMonth', 'AOV', 'ARPU', 'AOV_Growth', 'ARPU_Growth']].copy()
+apply_aov_arpu(monthly_kpis)
+aov_arpu_df = aov_arpu_table(monthly_kpis)
+profiler.rows(rows_out=len(aov_arpu_df))
 
 print("\nAOV & ARPU KPI 預覽 (基於 Revenue, Orders, Customer):")
 print(aov_arpu_df.head(10))
 
+# 保存 KPI 狀態，之後可用 --append 只追加新月份的資料（追加需要精確的每月客戶組合）
+try:
+    if hll_precision is not None:
+        raise ValueError("HyperLogLog 模式的客戶數是估計值")
+    if month_range:
+        raise ValueError("只計算了 --from-month/--to-month 範圍內的月份")
+    if order_cube is not None:
+        normal_customers = order_cube.monthly_customers('normal')
+        return_customers = order_cube.monthly_customers('return')
+    else:
+        normal_customers = aggregator.monthly_customers('normal')
+        return_customers = aggregator.monthly_customers('return')
+    KpiState.build(normal_monthly, return_monthly, normal_customers, return_customers, monthly_kpis,
+                   sources=[{'path': path, **file_fingerprint(path)}
+                            for path in dict.fromkeys(path for path, _ in input_parts)],
+                   options={'dedup': dedup, 'dedup_window': args.dedup_window if dedup else None,
+                            'parts': len(input_parts)}).save()
+    print(f"\n已保存 KPI 狀態到 {KPI_STATE_DIR}/")
+except ImportError:
+    print("\n警告: 未安裝 pyarrow，無法保存 KPI 狀態")
+except ValueError as e:
+    print(f"\n警告: {e}，不保存 KPI 狀態")
+
 # 步驟8: 計算產品 KPI
 print("\n=== 步驟8: 計算產品 KPI ===")
-
-# 查找產品相關列
-stockcode_col = find_column(normal_order, ['StockCode', 'Stock Code', 'SKU', 'sku', '產品代碼'])
-country_col = find_column(normal_order, ['Country', 'country', '國家', '國家'])
+profiler.step('步驟8', rows_in=normal_count)
 
 print(f"StockCode 列: {stockcode_col}")
 print(f"Country 列: {country_col}")
 
 product_kpis = []
+product_results = stage_results['products']
 
-# 1. Top SKUs (按 Revenue 排序)
+# 1. Top SKUs (按 Revenue 排序，只部分選取前 20 名)
 if stockcode_col:
-    top_skus = normal_order.groupby(stockcode_col).agg({
-        'Total': 'sum',
-        quantity_col: 'sum'
-    }).reset_index()
-    top_skus.columns = ['SKU', 'Revenue', 'Quantity']
-    top_skus = top_skus.sort_values('Revenue', ascending=False).head(20)
+    top_skus = top_k(product_results['sku_totals'], 'Revenue', 20)
     top_skus['Rank'] = range(1, len(top_skus) + 1)
-    top_skus = top_skus[['Rank', 'SKU', 'Revenue', 'Quantity']]
+    # Space-Saving 模式附 Revenue 的誤差上限
+    top_skus = top_skus[['Rank', 'SKU', 'Revenue', 'Quantity'] +
+                        [c for c in ('Revenue_Error',) if c in top_skus.columns]]
     
     print(f"\nTop 20 SKUs (按 Revenue):")
     print(top_skus.head(10))
@@ -255,9 +549,8 @@ if stockcode_col:
 
 # 2. SKU Diversity (每月不同的 SKU 數量)
 if stockcode_col:
-    monthly_sku_diversity = normal_order.groupby('YearMonth')[stockcode_col].nunique().reset_index()
-    monthly_sku_diversity.columns = ['YearMonth', 'SKU_Count']
-    monthly_sku_diversity['YearMonth'] = monthly_sku_diversity['YearMonth'].astype(str)
+    monthly_sku_diversity, sketches = split_sketches(product_results['sku_diversity'])
+    distinct_sketches.update(sketches)
     
     print(f"\n月度 SKU Diversity:")
     print(monthly_sku_diversity.head(10))
@@ -266,11 +559,8 @@ if stockcode_col:
 
 # 3. Sales by Country
 if country_col:
-    sales_by_country = normal_order.groupby(country_col).agg({
-        'Total': ['sum', 'count'],
-        customerid_col: 'nunique'
-    }).reset_index()
-    sales_by_country.columns = ['Country', 'Revenue', 'Orders', 'Customers']
+    sales_by_country, sketches = split_sketches(product_results['country_totals'])
+    distinct_sketches.update(sketches)
     sales_by_country = sales_by_country.sort_values('Revenue', ascending=False)
     sales_by_country['Revenue'] = sales_by_country['Revenue'].round(2)
     
@@ -279,11 +569,24 @@ if country_col:
     
     product_kpis.append(('Sales by Country', sales_by_country))
 
+# HyperLogLog 模式：保存各月、各國的暫存器，合併後即為任意範圍的不重複數量
+if distinct_sketches:
+    distinct_sketches_path = os.path.join(KPI_STATE_DIR, 'distinct_sketches.npz')
+    os.makedirs(KPI_STATE_DIR, exist_ok=True)
+    save_sketches(distinct_sketches_path, distinct_sketches)
+    print(f"\n已保存 HyperLogLog 暫存器到 {distinct_sketches_path}（相對標準誤差 {standard_error(hll_precision):.2%}）")
+    for name, label in (('Customer', '全期間不重複客戶（合併各月）'), ('SKU_Count', '全期間不重複 SKU（合併各月）'),
+                        ('Customers', '全部國家的不重複客戶（合併各國）')):
+        if name in distinct_sketches:
+            sketch = distinct_sketches[name]
+            estimate = sketch.merged_count()
+            print(f"{label}: {estimate:.0f} ± {estimate * sketch.relative_error:.0f}")
+
+profiler.rows(rows_out=sum(len(kpi_df) for _, kpi_df in product_kpis))
+
 # 步驟9: 計算 RFM 分析
 print("\n=== 步驟9: 計算 RFM 分析 ===")
-
-# 查找 Invoice 列
-invoice_col = find_column(normal_order, ['InvoiceNo', 'Invoice No', 'Invoice', 'InvoiceNumber', '發票號碼', '發票'])
+profiler.step('步驟9', rows_in=normal_count)
 
 if not invoice_col:
     print("警告: 找不到 Invoice 列，跳過 RFM 分析")
@@ -291,82 +594,31 @@ if not invoice_col:
 else:
     print(f"Invoice 列: {invoice_col}")
     
-    # 確保日期列已處理
-    if date_col not in normal_order.columns or not pd.api.types.is_datetime64_any_dtype(normal_order[date_col]):
-        normal_order[date_col] = pd.to_datetime(normal_order[date_col], errors='coerce')
-    
-    # 移除日期為空的記錄
-    rfm_data = normal_order[[customerid_col, invoice_col, date_col, 'Total']].copy()
-    rfm_data = rfm_data.dropna(subset=[customerid_col, date_col])
-    
+    # 按客戶的最後購買日、唯一 Invoice 和總金額（步驟6之前已匯總）
+    rfm_calc = stage_results['customers']
+
     # 計算報告最後一天（數據中的最大日期）
-    last_report_date = rfm_data[date_col].max()
+    last_report_date = rfm_calc['LastPurchaseDate'].max()
     print(f"報告最後日期: {last_report_date.date()}")
-    
-    # 按客戶計算 RFM
-    rfm_calc = rfm_data.groupby(customerid_col).agg({
-        date_col: 'max',              # 最後購買日
-        invoice_col: 'nunique',       # Invoice 數量（唯一值）
-        'Total': 'sum'                # 總金額
-    }).reset_index()
-    
-    rfm_calc.columns = ['CustomerID', 'LastPurchaseDate', 'Frequency', 'Monetary']
-    
+
     # 計算 Recency（距離最後報告日的天數）
     rfm_calc['Recency'] = (last_report_date - rfm_calc['LastPurchaseDate']).dt.days
     
-    # 使用 qcut 給每個維度打分（1-5）
-    # Frequency: 越高越好（保持原樣）
-    # Monetary: 越高越好（保持原樣）
-    # Recency: 越低越好（需要反轉）
-    
-    try:
-        # Frequency 分數（1-5，越高越好）
-        rfm_calc['F_Score'] = pd.qcut(rfm_calc['Frequency'], q=5, labels=[1, 2, 3, 4, 5], duplicates='drop').astype(int)
-    except:
-        # 如果無法分5組，使用 rank
-        rfm_calc['F_Score'] = pd.qcut(rfm_calc['Frequency'].rank(method='first'), q=5, labels=[1, 2, 3, 4, 5], duplicates='drop').astype(int)
-    
-    try:
-        # Monetary 分數（1-5，越高越好）
-        rfm_calc['M_Score'] = pd.qcut(rfm_calc['Monetary'], q=5, labels=[1, 2, 3, 4, 5], duplicates='drop').astype(int)
-    except:
-        rfm_calc['M_Score'] = pd.qcut(rfm_calc['Monetary'].rank(method='first'), q=5, labels=[1, 2, 3, 4, 5], duplicates='drop').astype(int)
-    
-    try:
-        # Recency 分數（1-5，但需要反轉：天數越少分數越高）
-        # qcut 按天數從小到大分組，labels=[1,2,3,4,5]（天數少的在前得到1）
-        r_rank = pd.qcut(rfm_calc['Recency'], q=5, labels=[1, 2, 3, 4, 5], duplicates='drop').astype(int)
-        # 反轉：天數越少分數越高（6 - rank：天數少的1變成5，天數多的5變成1）
-        rfm_calc['R_Score'] = 6 - r_rank
-    except:
-        # 如果無法分5組，使用 rank
-        r_rank = pd.qcut(rfm_calc['Recency'].rank(method='first'), q=5, labels=[1, 2, 3, 4, 5], duplicates='drop').astype(int)
-        rfm_calc['R_Score'] = 6 - r_rank
-    
-    # 計算總分
-    rfm_calc['Total_Score'] = rfm_calc['R_Score'] + rfm_calc['F_Score'] + rfm_calc['M_Score']
-    
-    # 根據總分分類
-    def categorize_rfm(score):
-        if 13 <= score <= 15:
-            return 'Champions'
-        elif 10 <= score <= 12:
-            return 'Loyal'
-        elif 7 <= score <= 9:
-            return 'Potential Loyalist'
-        elif 4 <= score <= 6:
-            return 'At Risk'
-        elif 1 <= score <= 3:
-            return 'Lost'
-        else:
-            return 'Unknown'
-    
-    rfm_calc['Category'] = rfm_calc['Total_Score'].apply(categorize_rfm)
+    # 分位數給每個維度打分（1-5），邊界只計算一次，評分為 searchsorted 對照邊界
+    # Frequency、Monetary 越高越好；Recency 越低越好（反轉：天數越少分數越高）
+    # 邊界重複時與原本相同，以出現順序排名分組；計算總分並根據總分分類（規則見 segment_rules.json）
+    rfm_scorers = score_rfm(rfm_calc, sketch_k=args.rfm_sketch_k)
+
+    # 保存分位邊界（指標的值，邊界重複時另存排名空間的邊界），之後可用 QuantileScorer.from_dict 為新客戶的原始值評分
+    rfm_quantiles_path = os.path.join(KPI_STATE_DIR, 'rfm_quantiles.json')
+    os.makedirs(KPI_STATE_DIR, exist_ok=True)
+    with open(rfm_quantiles_path, 'w', encoding='utf-8') as f:
+        json.dump({'customers': len(rfm_calc), 'sketch_k': args.rfm_sketch_k, 'metrics': rfm_scorers},
+                  f, ensure_ascii=False, indent=2)
+    print(f"已保存 RFM 分位邊界到 {rfm_quantiles_path}")
     
     # 選擇需要的列並排序
-    rfm_df = rfm_calc[['CustomerID', 'Recency', 'Frequency', 'Monetary', 
-                       'R_Score', 'F_Score', 'M_Score', 'Total_Score', 'Category']].copy()
+    rfm_df = rfm_calc[RFM_COLUMNS].copy()
     rfm_df = rfm_df.sort_values('Total_Score', ascending=False)
     
     # 格式化數值
@@ -378,106 +630,100 @@ else:
     print(rfm_df['Category'].value_counts().sort_index())
     print(f"\nRFM 分析預覽:")
     print(rfm_df.head(10))
+profiler.rows(rows_out=len(rfm_df))
+
+# 步驟9.1: 每個月底的 RFM 快照和分類轉移矩陣（排序並累加一次，不需每月重算）
+rfm_snapshot_df = None
+if args.rfm_snapshots and invoice_col:
+    print("\n=== 步驟9.1: 計算每月底 RFM 快照和分類轉移 ===")
+    profiler.step('步驟9.1', rows_in=normal_count)
+    # 串流模式和 duckdb 引擎的明細不在記憶體中，以 memory map 開啟交接檔
+    snapshot_source = normal_order if details_in_memory else open_partitions()['Normal Order']
+    rfm_snapshot_df = rfm_snapshots(snapshot_source, customerid_col, invoice_col, date_col,
+                                    sketch_k=args.rfm_sketch_k)
+    transitions_by_month, transition_matrix = segment_transitions(rfm_snapshot_df)
+    profiler.rows(rows_out=len(rfm_snapshot_df))
+    print(f"快照: {rfm_snapshot_df['YearMonth'].nunique()} 個月, {len(rfm_snapshot_df)} 行")
+    print("\n全期間分類轉移（客戶數）:")
+    print(transition_matrix)
+elif args.rfm_snapshots:
+    print("\n警告: 找不到 Invoice 列，跳過 RFM 快照")
 
 # 將所有資料寫入 彙總表.xlsx
 print("\n=== 寫入 彙總表.xlsx ===")
+profiler.step('寫入 彙總表.xlsx', rows_in=abnormal_count + duplicate_count + return_count + normal_count)
+
+def detail_sheet(sheet_name, frame, count):
+    """明細工作表的內容；串流模式和 duckdb 引擎改為從 Arrow 交接檔逐塊讀取"""
+    if count == 0:
+        return pd.DataFrame()
+    if details_in_memory:
+        return format_months(frame)
+    manifest = read_manifest()
+    if manifest is None or sheet_name not in manifest:
+        return None
+    if manifest[sheet_name]['rows'] >= EXCEL_MAX_ROWS:
+        print(f"警告: {sheet_name} 有 {manifest[sheet_name]['rows']} 行，超過 Excel 上限，明細只保留在 {HANDOFF_DIR}/")
+        return None
+    first_chunk = next(iter_partition_chunks(sheet_name))
+    # 交接檔中的 YearMonth 是月份鍵，逐塊格式化為標籤
+    return ChunkedFrame(first_chunk.columns,
+                        lambda: (format_months(chunk) for chunk in iter_partition_chunks(sheet_name)))
+
+
+# 以串流方式寫入（constant_memory），列寬在寫入前由 DataFrame 計算
+with ExcelExporter('彙總表.xlsx', max_width=30) as exporter:
+    # 寫入 Abnormal Order、return order、Normal Order
+    detail_sheets = [('Abnormal Order', abnormal_order if details_in_memory else None, abnormal_count),
+                     ('return order', return_order if details_in_memory else None, return_count),
+                     ('Normal Order', normal_order if details_in_memory else None, normal_count)]
+    if dedup:
+        detail_sheets.insert(1, (DUPLICATE_SHEET, duplicate_order, duplicate_count))
+    for sheet_name, frame, count in detail_sheets:
+        content = detail_sheet(sheet_name, frame, count)
+        if content is None:
+            continue
+        exporter.write_sheet(sheet_name, content)
+        if count > 0:
+            print(f"已寫入 {sheet_name} 工作表 ({count} 行)")
+        else:
+            print(f"已寫入空的 {sheet_name} 工作表")
 
-with pd.ExcelWriter('彙總表.xlsx', engine='openpyxl') as writer:
-    # 寫入 Abnormal Order
-    if abnormal_count > 0:
-        abnormal_order.to_excel(writer, sheet_name='Abnormal Order', index=False)
-        print(f"已寫入 Abnormal Order 工作表 ({abnormal_count} 行)")
-    else:
-        pd.DataFrame().to_excel(writer, sheet_name='Abnormal Order', index=False)
-        print("已寫入空的 Abnormal Order 工作表")
-    
-    # 寫入 Return Order
-    if return_count > 0:
-        return_order.to_excel(writer, sheet_name='return order', index=False)
-        print(f"已寫入 return order 工作表 ({return_count} 行)")
-    else:
-        pd.DataFrame().to_excel(writer, sheet_name='return order', index=False)
-        print("已寫入空的 return order 工作表")
-    
-    # 寫入 Normal Order
-    if normal_count > 0:
-        normal_order.to_excel(writer, sheet_name='Normal Order', index=False)
-        print(f"已寫入 Normal Order 工作表 ({normal_count} 行)")
-    else:
-        pd.DataFrame().to_excel(writer, sheet_name='Normal Order', index=False)
-        print("已寫入空的 Normal Order 工作表")
-    
-    # 寫入匯總表
-    # 先寫入步驟5的匯總統計
-    summary_df.to_excel(writer, sheet_name='彙總', index=False, startrow=0)
-    
-    # 在下面添加月度 KPI（留空行）
-    start_row = len(summary_df) + 3
-    monthly_kpis_df.to_excel(writer, sheet_name='彙總', index=False, startrow=start_row)
-    
-    # 在下面添加 AOV & ARPU KPI
-    start_row = start_row + len(monthly_kpis_df) + 3
-    aov_arpu_df.to_excel(writer, sheet_name='彙總', index=False, startrow=start_row)
-    
-    # 在下面添加產品 KPI
-    current_row = start_row + len(aov_arpu_df) + 3
-    worksheet = writer.sheets['彙總']
+    # 寫入匯總表：步驟5的匯總統計，下面依序是月度 KPI、AOV & ARPU KPI（留空行）和產品 KPI
+    summary_blocks = [summary_df, 2, monthly_kpis_df, 2, aov_arpu_df, 1]
     for kpi_name, kpi_df in product_kpis:
         if len(kpi_df) > 0:
-            # 添加標題
-            worksheet.cell(row=current_row, column=1, value=kpi_name)
-            current_row += 1
-            # 寫入資料（包含列名）
-            for c_idx, col_name in enumerate(kpi_df.columns, start=1):
-                worksheet.cell(row=current_row, column=c_idx, value=col_name)
-            current_row += 1
-            # 寫入資料行
-            for row_idx, row_data in enumerate(kpi_df.values):
-                for c_idx, value in enumerate(row_data, start=1):
-                    worksheet.cell(row=current_row + row_idx, column=c_idx, value=value)
-            current_row += len(kpi_df) + 3
-    
-    # 設置列寬
-    worksheet = writer.sheets['彙總']
-    for column in worksheet.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 30)
-        worksheet.column_dimensions[column_letter].width = adjusted_width
-    
+            # 標題、列名和資料行
+            summary_blocks += [kpi_name, kpi_df, 3]
+    exporter.write_sheet('彙總', summary_blocks)
+
     # 寫入 RFM 分析
     if 'rfm_df' in locals() and len(rfm_df) > 0:
-        rfm_df.to_excel(writer, sheet_name='RFM', index=False)
+        exporter.write_sheet('RFM', rfm_df)
         print(f"已寫入 RFM 工作表 ({len(rfm_df)} 行)")
     else:
-        pd.DataFrame().to_excel(writer, sheet_name='RFM', index=False)
+        exporter.write_sheet('RFM', pd.DataFrame())
         print("已寫入空的 RFM 工作表")
-    
-    # 在其他工作表也設置列寬
-    for sheet_name in writer.sheets:
-        if sheet_name != '彙總':
-            worksheet = writer.sheets[sheet_name]
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 30)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
+
+    # 寫入 RFM 快照和分類轉移
+    if rfm_snapshot_df is not None:
+        if len(rfm_snapshot_df) >= EXCEL_MAX_ROWS:
+            rfm_snapshot_df.to_csv('RFM Snapshots.csv', index=False, encoding='utf-8-sig')
+            print(f"警告: RFM 快照有 {len(rfm_snapshot_df)} 行，超過 Excel 上限，已改為寫入 RFM Snapshots.csv")
+        else:
+            exporter.write_sheet('RFM Snapshots', rfm_snapshot_df)
+            print(f"已寫入 RFM Snapshots 工作表 ({len(rfm_snapshot_df)} 行)")
+        exporter.write_sheet('RFM Transitions', ['全期間分類轉移（客戶數）', transition_matrix, 2,
+                                                 '按月分類轉移', transitions_by_month])
+        print("已寫入 RFM Transitions 工作表")
+
+profiler.end()
 
 print(f"\n已保存所有資料到 彙總表.xlsx")
 print(f"\n工作表包含:")
 print(f"  - Abnormal Order 工作表")
+if dedup:
+    print(f"  - {DUPLICATE_SHEET} 工作表 (重複的交易，Duplicate_Type 為 Exact 或 Near)")
 print(f"  - return order 工作表")
 print(f"  - Normal Order 工作表")
 print(f"  - 彙總工作表:")
@@ -489,9 +735,12 @@ print(f"    * 產品 KPI (Top SKUs, SKU Diversity, Sales by Country)")
 print(f"  - RFM 工作表 (Recency, Frequency, Monetary 分析)")
 
 print("\n=== 完成 ===")
-print(f"原始資料行數: {len(pd.read_excel('online_retail_II.xlsx'))}")
+print(f"原始資料行數: {original_row_count}")
 print(f"異常訂單: {abnormal_count} 行")
+if dedup:
+    print(f"重複訂單: {duplicate_count} 行")
 print(f"退貨訂單: {return_count} 行")
 print(f"正常訂單: {normal_count} 行")
-print(f"總計: {abnormal_count + return_count + normal_count} 行")
+print(f"總計: {abnormal_count + duplicate_count + return_count + normal_count} 行")
 
+profiler.finish()
@@ -1,21 +1,105 @@
+import argparse
+
 import pandas as pd
-import numpy as np
+
+from retail.cube import ORDER_TYPES, load_cube
+from retail.dataset import DATASET_DIR, read_dataset, read_dataset_manifest
+from retail.export import ExcelExporter
+from retail.handoff import HANDOFF_DIR, open_partitions
+from retail.ingest import COLUMN_KEYWORDS, find_column
+from retail.profiling import add_profiling_arguments, profiler_from_args
+from retail.quality import QUALITY_CHECKS
+from retail.segments import assign_segments
+from retail.stages import RETURN_ABNORMAL_STAGES, run_stages
+from retail.timeindex import MISSING_MONTH, month_key, month_keys
+from retail.topk import top_k
+
+parser = argparse.ArgumentParser(description='Online Retail 退貨率與異常訂單分析')
+parser.add_argument('--workers', type=int, default=1,
+                    help='退貨率和異常訂單分析在多個進程中並行執行（需要 Arrow 交接檔）')
+parser.add_argument('--engine', choices=['pandas', 'duckdb'], default='pandas',
+                    help='計算引擎：pandas（預設）或 duckdb（直接掃描交接檔，需要 duckdb）')
+parser.add_argument('--memory-limit',
+                    help='duckdb 引擎的記憶體上限，例如 4GB（預設由 DuckDB 決定）')
+parser.add_argument('--from-month', metavar='YYYY-MM',
+                    help=f'只分析此月份（含）之後的訂單；有 {DATASET_DIR}/ 時只讀取範圍內的分區')
+parser.add_argument('--to-month', metavar='YYYY-MM',
+                    help='只分析此月份（含）之前的訂單')
+add_profiling_arguments(parser, __file__)
+args = parser.parse_args()
+
+# 每個步驟的耗時、行數和記憶體寫入 JSON 執行報告
+profiler = profiler_from_args(__file__, args)
 
 # 1.1 從彙總表載入 Normal Order/Abnormal Order/Return Order tabs
 print("=== 步驟1.1: 從彙總表載入資料 ===")
+profiler.step('步驟1.1')
 
-try:
-    normal_order = pd.read_excel('彙總表.xlsx', sheet_name='Normal Order')
-    abnormal_order = pd.read_excel('彙總表.xlsx', sheet_name='Abnormal Order')
-    return_order = pd.read_excel('彙總表.xlsx', sheet_name='return order')
-    
-    print(f"Normal Order: {len(normal_order)} 行")
-    print(f"Abnormal Order: {len(abnormal_order)} 行")
-    print(f"Return Order: {len(return_order)} 行")
-except Exception as e:
-    print(f"錯誤: 無法讀取 彙總表.xlsx，請先運行 execute_prompt.py")
-    print(f"錯誤詳情: {e}")
-    raise
+# 指定月份範圍時優先讀取分區資料集，只開啟範圍內的月份；
+# 否則以 memory map 開啟 execute_prompt.py 寫出的 Arrow 交接檔，不存在時才解析 彙總表.xlsx
+month_range = args.from_month is not None or args.to_month is not None
+dataset_manifest = read_dataset_manifest() if month_range else None
+partitions = open_partitions() if dataset_manifest is None else None
+if dataset_manifest is not None:
+    loaded = {}
+    for sheet_name in ('Normal Order', 'Abnormal Order', 'return order'):
+        loaded[sheet_name], files_read, files_total = read_dataset(sheet_name, args.from_month, args.to_month)
+        print(f"{sheet_name}: 從 {DATASET_DIR}/ 讀取 {files_read}/{files_total} 個月份分區")
+    normal_order = loaded['Normal Order']
+    abnormal_order = loaded['Abnormal Order']
+    return_order = loaded['return order']
+elif partitions is not None:
+    print(f"從交接檔 {HANDOFF_DIR}/ 載入（memory map）")
+    normal_order = partitions['Normal Order']
+    abnormal_order = partitions['Abnormal Order']
+    return_order = partitions['return order']
+else:
+    try:
+        normal_order = pd.read_excel('彙總表.xlsx', sheet_name='Normal Order')
+        abnormal_order = pd.read_excel('彙總表.xlsx', sheet_name='Abnormal Order')
+        return_order = pd.read_excel('彙總表.xlsx', sheet_name='return order')
+    except Exception as e:
+        print(f"錯誤: 無法讀取 彙總表.xlsx，請先運行 execute_prompt.py")
+        print(f"錯誤詳情: {e}")
+        raise
+
+# 訂單立方體由 execute_prompt.py 與交接檔一起寫出；記錄數與本次載入的來源一致時，退貨率直接由立方體投影
+if dataset_manifest is not None:
+    cube_rows = {sheet_name: sum(entry['rows'] for entry in dataset_manifest['partitions'].get(sheet_name, {}).values())
+                 for sheet_name in ORDER_TYPES}
+elif partitions is not None:
+    cube_rows = None
+else:
+    cube_rows = {'Normal Order': len(normal_order), 'return order': len(return_order)}
+order_cube = load_cube(cube_rows)
+
+if month_range and dataset_manifest is None:
+    # 沒有分區資料集時載入完整資料後按日期篩選
+    print(f"警告: 未找到分區資料集 {DATASET_DIR}/，載入全部資料後篩選月份")
+    date_col = find_column(normal_order, COLUMN_KEYWORDS['date'])
+    if date_col:
+        def in_range(frame):
+            # 以整數月份鍵比較，無法解析的日期為 MISSING_MONTH，不在任何範圍內
+            keys = month_keys(frame[date_col])
+            mask = keys != MISSING_MONTH
+            if args.from_month:
+                mask &= keys >= month_key(args.from_month)
+            if args.to_month:
+                mask &= keys <= month_key(args.to_month)
+            return frame[mask].reset_index(drop=True)
+        normal_order = in_range(normal_order)
+        abnormal_order = in_range(abnormal_order)
+        return_order = in_range(return_order)
+
+if order_cube is not None:
+    if month_range:
+        order_cube = order_cube.slice_months(args.from_month, args.to_month)
+    print(f"從 {HANDOFF_DIR}/ 載入訂單立方體: {len(order_cube.cells)} 格")
+
+print(f"Normal Order: {len(normal_order)} 行")
+print(f"Abnormal Order: {len(abnormal_order)} 行")
+print(f"Return Order: {len(return_order)} 行")
+profiler.rows(rows_out=len(normal_order) + len(abnormal_order) + len(return_order))
 
 # 標準化列名
 normal_order.columns = normal_order.columns.str.strip()
@@ -23,21 +107,11 @@ abnormal_order.columns = abnormal_order.columns.str.strip()
 return_order.columns = return_order.columns.str.strip()
 
 # 查找相關列名
-def find_column(df, keywords):
-    """查找包含關鍵詞的列名"""
-    keywords_lower = [k.lower() for k in keywords]
-    for col in df.columns:
-        col_lower = col.lower()
-        for keyword in keywords_lower:
-            if keyword in col_lower:
-                return col
-    return None
-
-stockcode_col = find_column(normal_order, ['StockCode', 'Stock Code', 'SKU', 'sku', '產品代碼'])
-country_col = find_column(normal_order, ['Country', 'country', '國家', '國家'])
-customerid_col = find_column(normal_order, ['Customer ID', 'CustomerID', 'Customer', 'customer'])
-quantity_col = find_column(normal_order, ['Quantity', 'quantity', '數量'])
-description_col = find_column(normal_order, ['Description', 'description', '描述'])
+stockcode_col = find_column(normal_order, COLUMN_KEYWORDS['stockcode'])
+country_col = find_column(normal_order, COLUMN_KEYWORDS['country'])
+customerid_col = find_column(normal_order, COLUMN_KEYWORDS['customerid'])
+quantity_col = find_column(normal_order, COLUMN_KEYWORDS['quantity'])
+description_col = find_column(normal_order, COLUMN_KEYWORDS['description'])
 
 print(f"\n識別的列名:")
 print(f"StockCode: {stockcode_col}")
@@ -46,61 +120,66 @@ print(f"CustomerID: {customerid_col}")
 print(f"Quantity: {quantity_col}")
 print(f"Description: {description_col}")
 
+# 退貨率（Normal + Return 只掃描一次，以下三個分析都是它的投影）、退貨配對和資料品質剖析互不依賴，
+# --workers 大於 1 時並行執行，子進程以 memory map 開啟交接檔
+print("\n=== 步驟2-5 前處理: 匯總退貨率和異常訂單資料 ===")
+profiler.step('步驟2-5 前處理', rows_in=len(normal_order) + len(abnormal_order) + len(return_order))
+columns = {'stockcode': stockcode_col, 'country': country_col, 'customerid': customerid_col,
+           'quantity': quantity_col, 'description': description_col,
+           'date': find_column(normal_order, COLUMN_KEYWORDS['date']),
+           'invoice': find_column(normal_order, COLUMN_KEYWORDS['invoice']),
+           'price': find_column(normal_order, COLUMN_KEYWORDS['price'])}
+engine = None
+if args.engine == 'duckdb':
+    try:
+        from retail.duckdb_engine import DuckDBEngine
+        engine = DuckDBEngine(memory_limit=args.memory_limit)
+    except ImportError:
+        print("警告: 未安裝 duckdb，改用 pandas 引擎")
+partitions = {'Normal Order': normal_order, 'Abnormal Order': abnormal_order, 'return order': return_order}
+if engine is not None:
+    # DuckDB 直接掃描三個分區（交接檔的 memory map 不複製），兩個匯總各一條 SQL
+    engine.register_partitions(partitions)
+    stage_results = {'quality': engine.quality_stage(columns),
+                     'return_latency': engine.return_latency_stage(columns)}
+    if order_cube is None:
+        stage_results['return_rates'] = engine.return_rate_stage(columns)
+else:
+    # 子進程讀取的是完整交接檔，指定月份範圍時在目前進程執行
+    workers = 1 if month_range else args.workers
+    stages = dict(RETURN_ABNORMAL_STAGES)
+    if order_cube is not None:
+        del stages['return_rates']
+    stage_results = run_stages(stages, partitions, columns, workers=workers)
+if order_cube is not None:
+    stage_results['return_rates'] = order_cube.return_rates()
+return_rates = stage_results['return_rates']
+profiler.rows(rows_out=sum(len(analysis) for analysis in return_rates.values()) + len(stage_results['quality']['abnormal']))
+
 # 2.1 在 Return Order 數據中計算（按 StockCode）
 print("\n=== 步驟2.1: 計算 Return Order 分析（按 StockCode） ===")
+profiler.step('步驟2.1', rows_in=len(return_order))
 
 if len(return_order) > 0 and stockcode_col:
-    # 計算每個 StockCode 的總退貨金額和退貨數量
-    return_by_stockcode = return_order.groupby(stockcode_col).agg({
-        'Total': 'sum',
-        quantity_col: 'count'  # Return_Count 是記錄數
-    }).reset_index()
-    return_by_stockcode.columns = ['StockCode', 'Return_Amount', 'Return_Count']
-    
-    print(f"Return Order 分析完成: {len(return_by_stockcode)} 個 StockCode")
+    # 每個 StockCode 的總退貨金額和退貨數量（Return_Count 是記錄數）
+    returned_stockcodes = int((return_rates[stockcode_col]['Return_Count'] > 0).sum())
+    print(f"Return Order 分析完成: {returned_stockcodes} 個 StockCode")
 else:
-    return_by_stockcode = pd.DataFrame(columns=['StockCode', 'Return_Amount', 'Return_Count'])
+    returned_stockcodes = 0
     print("Return Order 數據為空或缺少 StockCode 列")
+profiler.rows(rows_out=returned_stockcodes)
 
 # 2.2 合併 Normal Order 計算產品退貨率（按 StockCode）
 print("\n=== 步驟2.2: 計算產品退貨率（按 StockCode） ===")
+profiler.step('步驟2.2', rows_in=len(normal_order) + len(return_order))
 
-if len(return_by_stockcode) > 0 and len(normal_order) > 0 and stockcode_col:
-    # 按 StockCode 計算 Normal 數據
-    normal_by_stockcode = normal_order.groupby(stockcode_col).agg({
-        'Total': 'sum',
-        quantity_col: 'count'
-    }).reset_index()
-    normal_by_stockcode.columns = ['StockCode', 'Revenue', 'Normal_Count']
-    
-    # 合併計算退貨率
-    product_analysis = return_by_stockcode.merge(normal_by_stockcode, on='StockCode', how='outer').fillna(0)
-    
-    # 計算 Return_Rate: -Return_Amount / (-Return_Amount + Revenue)
-    # 注意：Return_Amount 在 Return Order 中是負數，所以 -Return_Amount 是正數
-    product_analysis['Return_Rate'] = ((-product_analysis['Return_Amount']) / 
-                                       ((-product_analysis['Return_Amount']) + product_analysis['Revenue']).replace(0, np.nan)).fillna(0)
+if returned_stockcodes > 0 and len(normal_order) > 0 and stockcode_col:
+    # Return_Rate: -Return_Amount / (-Return_Amount + Revenue), Return_Frequency: Return_Count / (Return_Count + Normal_Count)
+    product_analysis = return_rates[stockcode_col].rename(columns={stockcode_col: 'StockCode'})
     
-    # 計算 Return_Frequency: Return_Count / (Return_Count + Normal_Count)
-    total_count = product_analysis['Return_Count'] + product_analysis['Normal_Count']
-    product_analysis['Return_Frequency'] = (product_analysis['Return_Count'] / 
-                                           total_count.replace(0, np.nan)).fillna(0)
-    
-    # 根據不同情況給標籤
+    # 根據不同情況給標籤（規則見 segment_rules.json）
     # 注意：outlier 條件優先（Return_Count <= 5）
-    def categorize_product_return(row):
-        if row['Return_Count'] <= 5:
-            return '100% return items(outlier)'
-        elif row['Return_Rate'] > 0.7 and row['Return_Count'] > 5:
-            return 'High-return items'
-        elif 0.3 < row['Return_Rate'] <= 0.7:
-            return 'Medium-return items'
-        elif row['Return_Rate'] <= 0.3:
-            return 'Low-return items'
-        else:
-            return 'Unknown'
-    
-    product_analysis['Category'] = product_analysis.apply(categorize_product_return, axis=1)
+    product_analysis['Category'] = assign_segments(product_analysis, 'product_return')
     
     # 格式化
     product_analysis['Return_Rate'] = product_analysis['Return_Rate'].round(4)
@@ -115,62 +194,32 @@ if len(return_by_stockcode) > 0 and len(normal_order) > 0 and stockcode_col:
 else:
     product_analysis = pd.DataFrame()
     print("無法計算產品退貨率（數據為空或缺少必要列）")
+profiler.rows(rows_out=len(product_analysis))
 
 # 3.1 在 Return Order 數據中計算（按 CustomerID）
 print("\n=== 步驟3.1: 計算 Return Order 分析（按 CustomerID） ===")
+profiler.step('步驟3.1', rows_in=len(return_order))
 
 if len(return_order) > 0 and customerid_col:
-    # 計算每個 CustomerID 的總退貨金額和退貨數量
-    return_by_customer = return_order.groupby(customerid_col).agg({
-        'Total': 'sum',
-        quantity_col: 'count'  # Return_Count 是記錄數
-    }).reset_index()
-    return_by_customer.columns = [customerid_col, 'Return_Amount', 'Return_Count']
-    
-    print(f"Return Order 分析完成: {len(return_by_customer)} 個客戶")
+    # 每個 CustomerID 的總退貨金額和退貨數量（Return_Count 是記錄數）
+    returned_customers = int((return_rates[customerid_col]['Return_Count'] > 0).sum())
+    print(f"Return Order 分析完成: {returned_customers} 個客戶")
 else:
-    return_by_customer = pd.DataFrame()
+    returned_customers = 0
     print("Return Order 數據為空或缺少 CustomerID 列")
+profiler.rows(rows_out=returned_customers)
 
 # 3.2 合併 Normal Order 計算客戶退貨率（按 CustomerID）
 print("\n=== 步驟3.2: 計算客戶退貨率（按 CustomerID） ===")
+profiler.step('步驟3.2', rows_in=len(normal_order) + len(return_order))
 
-if len(return_by_customer) > 0 and len(normal_order) > 0 and customerid_col:
-    # 按客戶計算 Normal 數據
-    normal_by_customer = normal_order.groupby(customerid_col).agg({
-        'Total': 'sum',
-        quantity_col: 'count'
-    }).reset_index()
-    normal_by_customer.columns = [customerid_col, 'Revenue', 'Normal_Count']
-    
-    # 合併計算退貨率
-    customer_analysis = return_by_customer.merge(normal_by_customer, on=customerid_col, how='outer').fillna(0)
-    
-    # 計算 Return_Rate: -Return_Amount / (-Return_Amount + Revenue)
-    # 注意：Return_Amount 在 Return Order 中是負數，所以 -Return_Amount 是正數
-    customer_analysis['Return_Rate'] = ((-customer_analysis['Return_Amount']) / 
-                                       ((-customer_analysis['Return_Amount']) + customer_analysis['Revenue']).replace(0, np.nan)).fillna(0)
+if returned_customers > 0 and len(normal_order) > 0 and customerid_col:
+    # Return_Rate: -Return_Amount / (-Return_Amount + Revenue), Return_Frequency: Return_Count / (Return_Count + Normal_Count)
+    customer_analysis = return_rates[customerid_col]
     
-    # 計算 Return_Frequency: Return_Count / (Return_Count + Normal_Count)
-    total_count = customer_analysis['Return_Count'] + customer_analysis['Normal_Count']
-    customer_analysis['Return_Frequency'] = (customer_analysis['Return_Count'] / 
-                                           total_count.replace(0, np.nan)).fillna(0)
-    
-    # 根據不同情況給標籤
+    # 根據不同情況給標籤（規則見 segment_rules.json）
     # 注意：outlier 條件優先（Return_Count <= 5）
-    def categorize_customer_return(row):
-        if row['Return_Count'] <= 5:
-            return '100% return customer(outlier)'
-        elif row['Return_Rate'] > 0.7 and row['Return_Count'] > 5:
-            return 'High-return customer'
-        elif 0.3 < row['Return_Rate'] <= 0.7:
-            return 'Medium-return customer'
-        elif row['Return_Rate'] <= 0.3:
-            return 'Low-return customer'
-        else:
-            return 'Unknown'
-    
-    customer_analysis['Category'] = customer_analysis.apply(categorize_customer_return, axis=1)
+    customer_analysis['Category'] = assign_segments(customer_analysis, 'customer_return')
     
     # 格式化
     customer_analysis['Return_Rate'] = customer_analysis['Return_Rate'].round(4)
@@ -185,36 +234,14 @@ if len(return_by_customer) > 0 and len(normal_order) > 0 and customerid_col:
 else:
     customer_analysis = pd.DataFrame()
     print("無法計算客戶退貨率（數據為空或缺少必要列）")
+profiler.rows(rows_out=len(customer_analysis))
 
 # 4.1 計算按國家的退貨率
 print("\n=== 步驟4.1: 計算國家退貨率 ===")
+profiler.step('步驟4.1', rows_in=len(normal_order) + len(return_order))
 
 if country_col and len(return_order) > 0 and len(normal_order) > 0:
-    # 按國家計算 Return 數據
-    return_by_country = return_order.groupby(country_col).agg({
-        'Total': 'sum',
-        quantity_col: 'count'
-    }).reset_index()
-    return_by_country.columns = ['Country', 'Return_Amount', 'Return_Count']
-    
-    # 按國家計算 Normal 數據
-    normal_by_country = normal_order.groupby(country_col).agg({
-        'Total': 'sum',
-        quantity_col: 'count'
-    }).reset_index()
-    normal_by_country.columns = ['Country', 'Revenue', 'Normal_Count']
-    
-    # 合併計算退貨率
-    country_analysis = return_by_country.merge(normal_by_country, on='Country', how='outer').fillna(0)
-    
-    # 計算 Return_Rate: -Return_Amount / (-Return_Amount + Revenue)
-    country_analysis['Return_Rate'] = ((-country_analysis['Return_Amount']) / 
-                                      ((-country_analysis['Return_Amount']) + country_analysis['Revenue']).replace(0, np.nan)).fillna(0)
-    
-    # 計算 Return_Frequency: Return_Count / (Return_Count + Normal_Count)
-    total_count = country_analysis['Return_Count'] + country_analysis['Normal_Count']
-    country_analysis['Return_Frequency'] = (country_analysis['Return_Count'] / 
-                                          total_count.replace(0, np.nan)).fillna(0)
+    country_analysis = return_rates[country_col].rename(columns={country_col: 'Country'})
     
     # 格式化
     country_analysis['Return_Rate'] = country_analysis['Return_Rate'].round(4)
@@ -228,14 +255,42 @@ else:
     country_analysis = pd.DataFrame(columns=['Country', 'Return_Amount', 'Return_Count', 
                                            'Revenue', 'Normal_Count', 'Return_Rate', 'Return_Frequency'])
     print("無法計算國家退貨率（數據為空或缺少必要列）")
+profiler.rows(rows_out=len(country_analysis))
+
+# 4.2 每筆退貨配對到同一客戶、同一 StockCode 最近的原始銷售，計算退貨延遲
+print("\n=== 步驟4.2: 配對退貨與原始銷售（退貨延遲） ===")
+profiler.step('步驟4.2', rows_in=len(normal_order) + len(return_order))
+
+return_latency = stage_results['return_latency']
+if return_latency is not None and len(return_latency['lines']) > 0:
+    latency_lines = return_latency['lines']
+    latency_product = return_latency['product']
+    latency_country = return_latency['country']
+    matched_returns = int(latency_lines['Matched'].sum())
+    print(f"已配對 {matched_returns}/{len(latency_lines)} 筆退貨，未配對 {len(latency_lines) - matched_returns} 筆")
+    if matched_returns > 0:
+        print(f"退貨延遲中位數: {latency_lines['Latency_Days'].median():.2f} 天")
+    if month_range:
+        # 原始銷售早於 --from-month 的退貨在範圍內找不到銷售，計為未配對
+        print("注意: 只在指定月份範圍內配對，早於範圍的原始銷售不會被找到")
+else:
+    latency_lines = latency_product = latency_country = pd.DataFrame()
+    print("無法配對退貨（數據為空或缺少 CustomerID、StockCode 或日期列）")
+profiler.rows(rows_out=len(latency_lines))
 
 # 5.1 在 Abnormal Order 數據中計算
-print("\n=== 步驟5.1: 計算 Abnormal Order 分析 ===")
+print("\n=== 步驟5.1: 計算 Abnormal Order 分析和資料品質 ===")
+profiler.step('步驟5.1', rows_in=len(normal_order) + len(abnormal_order) + len(return_order))
 
+# 資料品質剖析：每個分區的指示矩陣（缺失、無法解析、負數/零價格、超出範圍的日期）只掃描一次，
+# Abnormal Order 按 StockCode 和 Country 分組加總即為產品異常分析
+quality = stage_results['quality']
+quality_report = quality['columns']
 if len(abnormal_order) > 0:
-    # 計算缺失 CustomerID 和缺失 Description 的數量
-    missing_customerid = abnormal_order[customerid_col].isna().sum() if customerid_col else 0
-    missing_description = abnormal_order[description_col].isna().sum() if description_col else 0
+    # 缺失 CustomerID 和缺失 Description 的數量來自 Abnormal Order 的品質計數
+    abnormal_missing = quality_report[quality_report['Partition'] == 'Abnormal Order'].set_index('Column')['Missing_Count']
+    missing_customerid = int(abnormal_missing[customerid_col]) if customerid_col else 0
+    missing_description = int(abnormal_missing[description_col]) if description_col else 0
     total_abnormal = len(abnormal_order)
     
     # 計算比例
@@ -247,48 +302,7 @@ if len(abnormal_order) > 0:
     
     # 按 StockCode 和 Country 計算缺失計數和比例
     if stockcode_col and country_col:
-        abnormal_by_product = abnormal_order.groupby([stockcode_col, country_col]).agg({
-            customerid_col: lambda x: x.isna().sum() if customerid_col else 0,
-            description_col: lambda x: x.isna().sum() if description_col else 0,
-        }).reset_index()
-        
-        # 重命名列
-        if customerid_col and description_col:
-            abnormal_by_product.columns = [stockcode_col, country_col, 'Missing_CustomerID_Count', 'Missing_Description_Count']
-            abnormal_by_product['Missing_Total_Count'] = (abnormal_by_product['Missing_CustomerID_Count'] + 
-                                                          abnormal_by_product['Missing_Description_Count'])
-        elif customerid_col:
-            abnormal_by_product.columns = [stockcode_col, country_col, 'Missing_CustomerID_Count']
-            abnormal_by_product['Missing_Total_Count'] = abnormal_by_product['Missing_CustomerID_Count']
-        elif description_col:
-            abnormal_by_product.columns = [stockcode_col, country_col, 'Missing_Description_Count']
-            abnormal_by_product['Missing_Total_Count'] = abnormal_by_product['Missing_Description_Count']
-        else:
-            abnormal_by_product = pd.DataFrame()
-        
-        if len(abnormal_by_product) > 0:
-            # 計算比例
-            total_by_product = abnormal_order.groupby([stockcode_col, country_col]).size().reset_index(name='Total_Count')
-            abnormal_by_product = abnormal_by_product.merge(total_by_product, on=[stockcode_col, country_col], how='left')
-            
-            if 'Missing_CustomerID_Count' in abnormal_by_product.columns:
-                abnormal_by_product['Missing_CustomerID_Proportion'] = (
-                    abnormal_by_product['Missing_CustomerID_Count'] / 
-                    abnormal_by_product['Total_Count'].replace(0, np.nan) * 100
-                ).fillna(0).round(2)
-            
-            if 'Missing_Description_Count' in abnormal_by_product.columns:
-                abnormal_by_product['Missing_Description_Proportion'] = (
-                    abnormal_by_product['Missing_Description_Count'] / 
-                    abnormal_by_product['Total_Count'].replace(0, np.nan) * 100
-                ).fillna(0).round(2)
-            
-            abnormal_by_product['Missing_Total_Proportion'] = (
-                abnormal_by_product['Missing_Total_Count'] / 
-                abnormal_by_product['Total_Count'].replace(0, np.nan) * 100
-            ).fillna(0).round(2)
-            
-            abnormal_by_product = abnormal_by_product.sort_values('Missing_Total_Count', ascending=False)
+        abnormal_by_product = quality['abnormal']
         
         print(f"產品異常分析完成: {len(abnormal_by_product)} 個產品-國家組合")
     else:
@@ -298,8 +312,18 @@ else:
     abnormal_by_product = pd.DataFrame()
     print("Abnormal Order 數據為空")
 
+# 列出有問題的列（Abnormal Order 依定義缺失 CustomerID 或 Description，上面已列出）
+for row in quality_report.to_dict('records'):
+    counts = {check: int(row[f'{check}_Count']) for check in QUALITY_CHECKS if row[f'{check}_Count'] > 0}
+    if row['Partition'] == 'Abnormal Order' and row['Column'] in (customerid_col, description_col):
+        counts.pop('Missing', None)
+    if counts:
+        print(f"資料品質: {row['Partition']} / {row['Column']}: {counts}")
+profiler.rows(rows_out=len(abnormal_by_product))
+
 # 6.1 生成見解
 print("\n=== 步驟6.1: 生成見解 ===")
+profiler.step('步驟6.1')
 
 insights_list = []
 
@@ -336,7 +360,7 @@ if len(customer_analysis) > 0 and 'Category' in customer_analysis.columns:
 
 # List top 10 Country based on the Return_Rate (higher the top)
 if len(country_analysis) > 0 and 'Return_Rate' in country_analysis.columns:
-    top_countries = country_analysis.nlargest(10, 'Return_Rate')
+    top_countries = top_k(country_analysis, 'Return_Rate', 10)
     if len(top_countries) > 0:
         for rank, (idx, row) in enumerate(top_countries.iterrows(), start=1):
             insights_list.append({
@@ -350,7 +374,7 @@ if len(country_analysis) > 0 and 'Return_Rate' in country_analysis.columns:
 
 # List top 10 Products based on the missing count (higher the top)
 if len(abnormal_by_product) > 0 and 'Missing_Total_Count' in abnormal_by_product.columns:
-    top_products_missing = abnormal_by_product.nlargest(10, 'Missing_Total_Count')
+    top_products_missing = top_k(abnormal_by_product, 'Missing_Total_Count', 10)
     if len(top_products_missing) > 0:
         for rank, (idx, row) in enumerate(top_products_missing.iterrows(), start=1):
             insights_list.append({
@@ -363,72 +387,48 @@ if len(abnormal_by_product) > 0 and 'Missing_Total_Count' in abnormal_by_product
         print(f"Top 10 產品（缺失計數）: {len(top_products_missing)} 個")
 
 insights_df = pd.DataFrame(insights_list)
+profiler.rows(rows_out=len(insights_df))
 
 # 1.2 寫入 Excel
 print("\n=== 步驟1.2: 寫入 Return and Abnormal.xlsx ===")
+profiler.step('步驟1.2', rows_in=len(product_analysis) + len(customer_analysis) + len(country_analysis)
+              + len(latency_lines) + len(latency_product) + len(latency_country)
+              + len(abnormal_by_product) + len(quality_report) + len(insights_df))
 
-with pd.ExcelWriter('Return and Abnormal.xlsx', engine='openpyxl') as writer:
-    # Return analysis product (步驟2.2的結果 - 產品分析)
-    if len(product_analysis) > 0:
-        product_analysis.to_excel(writer, sheet_name='Return analysis product', index=False)
-        print(f"已寫入 Return analysis product 工作表 ({len(product_analysis)} 行)")
-    else:
-        pd.DataFrame().to_excel(writer, sheet_name='Return analysis product', index=False)
-        print("已寫入空的 Return analysis product 工作表")
-    
-    # Return analysis customer (步驟3.2的結果 - 客戶分析)
-    if len(customer_analysis) > 0:
-        customer_analysis.to_excel(writer, sheet_name='Return analysis customer', index=False)
-        print(f"已寫入 Return analysis customer 工作表 ({len(customer_analysis)} 行)")
-    else:
-        pd.DataFrame().to_excel(writer, sheet_name='Return analysis customer', index=False)
-        print("已寫入空的 Return analysis customer 工作表")
-    
-    # Return analysis country (步驟4.1的結果)
-    if len(country_analysis) > 0:
-        country_analysis.to_excel(writer, sheet_name='Return analysis country', index=False)
-        print(f"已寫入 Return analysis country 工作表 ({len(country_analysis)} 行)")
-    else:
-        pd.DataFrame().to_excel(writer, sheet_name='Return analysis country', index=False)
-        print("已寫入空的 Return analysis country 工作表")
-    
-    # Abnormal analysis product (步驟5.1的結果)
-    if len(abnormal_by_product) > 0:
-        abnormal_by_product.to_excel(writer, sheet_name='Abnormal analysis product', index=False)
-        print(f"已寫入 Abnormal analysis product 工作表 ({len(abnormal_by_product)} 行)")
-    else:
-        pd.DataFrame().to_excel(writer, sheet_name='Abnormal analysis product', index=False)
-        print("已寫入空的 Abnormal analysis product 工作表")
-    
-    # Insights (步驟6.1的結果)
-    if len(insights_df) > 0:
-        insights_df.to_excel(writer, sheet_name='insights', index=False)
-        print(f"已寫入 insights 工作表 ({len(insights_df)} 行)")
-    else:
-        pd.DataFrame().to_excel(writer, sheet_name='insights', index=False)
-        print("已寫入空的 insights 工作表")
-    
-    # 設置列寬
-    for sheet_name in writer.sheets:
-        worksheet = writer.sheets[sheet_name]
-        for column in worksheet.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            worksheet.column_dimensions[column_letter].width = adjusted_width
+# 以串流方式寫入（constant_memory），列寬在寫入前由 DataFrame 計算
+with ExcelExporter('Return and Abnormal.xlsx', max_width=50) as exporter:
+    for sheet_name, result in (
+        ('Return analysis product', product_analysis),      # 步驟2.2的結果 - 產品分析
+        ('Return analysis customer', customer_analysis),    # 步驟3.2的結果 - 客戶分析
+        ('Return analysis country', country_analysis),      # 步驟4.1的結果
+        ('Return latency lines', latency_lines),            # 步驟4.2的結果 - 每筆退貨的配對
+        ('Return latency product', latency_product),        # 步驟4.2的結果 - 按 StockCode
+        ('Return latency country', latency_country),        # 步驟4.2的結果 - 按國家
+        ('Abnormal analysis product', abnormal_by_product), # 步驟5.1的結果
+        ('Data quality', quality_report),                   # 步驟5.1的結果 - 各分區、各列的資料品質
+        ('insights', insights_df),                          # 步驟6.1的結果
+    ):
+        if len(result) > 0:
+            exporter.write_sheet(sheet_name, result)
+            print(f"已寫入 {sheet_name} 工作表 ({len(result)} 行)")
+        else:
+            exporter.write_sheet(sheet_name, pd.DataFrame())
+            print(f"已寫入空的 {sheet_name} 工作表")
+
+profiler.end()
 
 print(f"\n已保存所有資料到 Return and Abnormal.xlsx")
 print(f"\n工作表包含:")
 print(f"  - Return analysis product (產品退貨率分析 - 步驟2.2，包含分類標籤)")
 print(f"  - Return analysis customer (客戶退貨率分析 - 步驟3.2，包含分類標籤)")
 print(f"  - Return analysis country (國家退貨率分析 - 步驟4.1)")
+print(f"  - Return latency lines (每筆退貨配對的原始銷售和延遲天數 - 步驟4.2)")
+print(f"  - Return latency product (產品退貨延遲分佈和未配對數 - 步驟4.2)")
+print(f"  - Return latency country (國家退貨延遲分佈和未配對數 - 步驟4.2)")
 print(f"  - Abnormal analysis product (產品異常分析 - 步驟5.1)")
+print(f"  - Data quality (各分區、各列的缺失、無法解析、負數/零價格和超出範圍日期的計數與比例 - 步驟5.1)")
 print(f"  - insights (見解：High-return items、High-return customer、Top 10 國家、Top 10 產品缺失 - 步驟6.1)")
 
 print("\n=== 完成 ===")
+
+profiler.finish()
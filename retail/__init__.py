@@ -0,0 +1 @@
+"""Online Retail 分析腳本的共用模組"""
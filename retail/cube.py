@@ -0,0 +1,286 @@
+"""訂單立方體：Normal Order 和 Return Order 按 (YearMonth, Country, StockCode, 訂單類型) 的預匯總，每次執行只建立一次
+
+- cells：每格的記錄數（Rows）、Total 加總和非空數（Total_Count）、Quantity 加總和非空數（Quantity_Count）
+- customers：(YearMonth, Country, CustomerID, 訂單類型) 粒度的 Total 加總和 Quantity 非空數，
+  同時是不重複客戶的結構（每月、每國的客戶數為組合中 CustomerID 的 nunique，HyperLogLog 也由它建立）
+
+月度 KPI、Top SKUs、SKU Diversity、Sales by Country（以及由月度 KPI 計算的 AOV/ARPU）和三個退貨率工作表
+都是立方體的投影；project() 可投影到任意維度組合的退貨率（例如 ['Country', 'StockCode']），重新切片（例如 --from-month）的成本只與立方體大小有關，不再掃描明細。
+鍵為空的格保留在立方體中（月度加總仍需計入），投影到該維度時與 groupby 預設相同，不形成分組。
+立方體與交接檔一起寫入 彙總表.arrow/，記錄數與交接檔 manifest 一致時 execute_return_abnormal.py 直接使用。
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from retail.handoff import CUBE_MANIFEST, HANDOFF_DIR, read_manifest
+from retail.hll import GroupedHLL, attach_counts
+from retail.ingest import to_arrow_safe
+from retail.returns import RETURN_RATE_COLUMNS, add_return_rates
+from retail.timeindex import MISSING_MONTH, MONTH_COLUMN, format_months, month_key, month_keys
+
+CUBE_FILES = {'cells': 'cube_cells.arrow', 'customers': 'cube_customers.arrow'}
+# 交接分區 -> 訂單類型
+ORDER_TYPES = {'Normal Order': 'normal', 'return order': 'return'}
+CELL_KEYS = [MONTH_COLUMN, 'Country', 'StockCode', 'Type']
+CELL_MEASURES = ['Rows', 'Total', 'Total_Count', 'Quantity', 'Quantity_Count']
+CUSTOMER_KEYS = [MONTH_COLUMN, 'Country', 'CustomerID', 'Type']
+CUSTOMER_MEASURES = ['Total', 'Quantity_Count']
+# 可投影的維度（CustomerID 只在 customers 中，不能與 StockCode 組合）
+CUBE_DIMENSIONS = [MONTH_COLUMN, 'Country', 'StockCode', 'CustomerID']
+# 立方體維度 -> 角色（退貨率工作表以實際列名為鍵）
+DIMENSION_ROLES = {'StockCode': 'stockcode', 'CustomerID': 'customerid', 'Country': 'country'}
+# 月度匯總的輸出列：(金額, 記錄數, 不重複客戶)
+MONTHLY_COLUMNS = {
+    'normal': ('Revenue', 'Normal_Orders', 'Customer'),
+    'return': ('Return', 'Return_Orders', 'Return_Customers'),
+}
+
+
+def _fact_rows(frame, order_type, columns):
+    """一個分區的明細轉為立方體的維度列和可加總的量"""
+    def column(role):
+        col = columns.get(role)
+        return frame[col] if col else pd.Series(None, index=frame.index, dtype=object)
+
+    if MONTH_COLUMN in frame.columns and pd.api.types.is_integer_dtype(frame[MONTH_COLUMN]):
+        months = frame[MONTH_COLUMN].to_numpy(dtype=np.int32)
+    else:
+        # 從 彙總表.xlsx 載入時 YearMonth 是標籤，由日期列重新計算月份鍵
+        months = month_keys(frame[columns['date']])
+    quantity = frame[columns['quantity']]
+    return pd.DataFrame({
+        MONTH_COLUMN: months,
+        'Country': column('country'),
+        'StockCode': column('stockcode'),
+        'CustomerID': column('customerid'),
+        'Type': order_type,
+        'Rows': np.ones(len(frame), dtype='int64'),
+        'Total': frame['Total'],
+        'Total_Count': frame['Total'].notna().astype('int64'),
+        'Quantity': quantity,
+        'Quantity_Count': quantity.notna().astype('int64'),
+    }, index=frame.index).reset_index(drop=True)
+
+
+def _rollup(facts, keys, measures):
+    # 保留空鍵（dropna=False）：鍵為空的記錄仍計入其他維度的投影
+    return facts.groupby(keys, observed=True, dropna=False, sort=True)[measures].sum().reset_index()
+
+
+class OrderCube:
+    """cells 和 customers 兩張匯總表，以及建立時的 {角色: 列名}；customers 可為 None（只需要 cells 的串流 HyperLogLog 模式）"""
+
+    def __init__(self, cells, customers, columns):
+        self.cells = cells
+        self.customers = customers
+        self.columns = dict(columns)
+
+    @classmethod
+    def from_frames(cls, normal_order, return_order, columns, with_customers=True):
+        """由 Normal Order 和 Return Order 明細建立（每個分區只掃描一次）"""
+        facts = pd.concat([_fact_rows(normal_order, 'normal', columns), _fact_rows(return_order, 'return', columns)],
+                          ignore_index=True)
+        cells = _rollup(facts, CELL_KEYS, CELL_MEASURES)
+        customers = _rollup(facts, CUSTOMER_KEYS, CUSTOMER_MEASURES) if with_customers else None
+        return cls(cells, customers, columns)
+
+    def merge(self, other):
+        """合併另一個立方體（例如下一個分塊），相同格的量相加"""
+        cells = _rollup(pd.concat([self.cells, other.cells], ignore_index=True), CELL_KEYS, CELL_MEASURES)
+        customers = None
+        if self.customers is not None and other.customers is not None:
+            customers = _rollup(pd.concat([self.customers, other.customers], ignore_index=True),
+                                CUSTOMER_KEYS, CUSTOMER_MEASURES)
+        return OrderCube(cells, customers, self.columns)
+
+    def slice_months(self, start=None, end=None):
+        """只保留 [start, end] 月份（'YYYY-MM'，含兩端）的格"""
+        def in_range(table):
+            keys = table[MONTH_COLUMN].to_numpy()
+            mask = keys != MISSING_MONTH
+            if start is not None:
+                mask &= keys >= month_key(start)
+            if end is not None:
+                mask &= keys <= month_key(end)
+            return table[mask].reset_index(drop=True)
+
+        customers = None if self.customers is None else in_range(self.customers)
+        return OrderCube(in_range(self.cells), customers, self.columns)
+
+    def rows(self, order_type):
+        """立方體涵蓋的明細記錄數"""
+        return int(self.cells.loc[self.cells['Type'] == order_type, 'Rows'].sum())
+
+    def _of_type(self, table, order_type):
+        return table[table['Type'] == order_type]
+
+    def monthly(self, order_type, precision=None, sketch=None):
+        """每月的金額、記錄數和不重複客戶數（步驟6的 normal_monthly/return_monthly）
+
+        precision 不為 None 時客戶數以 HyperLogLog 近似；sketch 為已累積的 GroupedHLL（否則由 customers 建立）。
+        """
+        amount, orders, customer = MONTHLY_COLUMNS[order_type]
+        cells = self._of_type(self.cells, order_type)
+        if len(cells) == 0:
+            return pd.DataFrame(columns=[MONTH_COLUMN, amount, orders, customer])
+        result = cells.groupby(MONTH_COLUMN)[['Total', 'Total_Count']].sum().reset_index()
+        result.columns = [MONTH_COLUMN, amount, orders]
+        if precision is not None:
+            if sketch is None:
+                pairs = self._of_type(self.customers, order_type)
+                sketch = GroupedHLL.from_values(pairs[MONTH_COLUMN], pairs['CustomerID'], precision)
+            attach_counts(result, MONTH_COLUMN, customer, sketch)
+        else:
+            counts = self._of_type(self.customers, order_type).groupby(MONTH_COLUMN)['CustomerID'].nunique()
+            result[customer] = counts.reindex(result[MONTH_COLUMN]).fillna(0).astype('int64').to_numpy()
+        return format_months(result)
+
+    def monthly_customers(self, order_type):
+        """每月不重複的 (YearMonth, 客戶) 組合，列名為實際的客戶列名"""
+        pairs = self._of_type(self.customers, order_type)[[MONTH_COLUMN, 'CustomerID']].drop_duplicates()
+        pairs.columns = [MONTH_COLUMN, self.columns['customerid']]
+        return format_months(pairs.reset_index(drop=True))
+
+    def sku_totals(self):
+        """每個 SKU 的 Revenue 和 Quantity 加總；沒有 StockCode 列時為 None"""
+        if not self.columns.get('stockcode'):
+            return None
+        cells = self._of_type(self.cells, 'normal')
+        if len(cells) == 0:
+            return pd.DataFrame(columns=['SKU', 'Revenue', 'Quantity'])
+        result = cells.groupby('StockCode', observed=True)[['Total', 'Quantity']].sum().reset_index()
+        result.columns = ['SKU', 'Revenue', 'Quantity']
+        return result
+
+    def sku_diversity(self, precision=None):
+        """每月不同的 SKU 數量；沒有 StockCode 列時為 None"""
+        if not self.columns.get('stockcode'):
+            return None
+        cells = self._of_type(self.cells, 'normal')
+        if len(cells) == 0:
+            return pd.DataFrame(columns=[MONTH_COLUMN, 'SKU_Count'])
+        if precision is not None:
+            result = pd.DataFrame({MONTH_COLUMN: np.unique(cells[MONTH_COLUMN].to_numpy())})
+            attach_counts(result, MONTH_COLUMN, 'SKU_Count',
+                          GroupedHLL.from_values(cells[MONTH_COLUMN], cells['StockCode'], precision))
+        else:
+            result = cells.groupby(MONTH_COLUMN)['StockCode'].nunique().reset_index()
+            result.columns = [MONTH_COLUMN, 'SKU_Count']
+        return format_months(result)
+
+    def country_totals(self, precision=None, sketch=None):
+        """每個國家的 Revenue、Orders、Customers；沒有 Country 列時為 None"""
+        if not self.columns.get('country'):
+            return None
+        cells = self._of_type(self.cells, 'normal')
+        if len(cells) == 0:
+            return pd.DataFrame(columns=['Country', 'Revenue', 'Orders', 'Customers'])
+        result = cells.groupby('Country', observed=True)[['Total', 'Total_Count']].sum().reset_index()
+        result.columns = ['Country', 'Revenue', 'Orders']
+        if precision is not None:
+            if sketch is None:
+                pairs = self._of_type(self.customers, 'normal')
+                sketch = GroupedHLL.from_values(pairs['Country'], pairs['CustomerID'], precision)
+            attach_counts(result, 'Country', 'Customers', sketch)
+        else:
+            counts = self._of_type(self.customers, 'normal').groupby('Country', observed=True)['CustomerID'].nunique()
+            result['Customers'] = counts.reindex(result['Country']).fillna(0).astype('int64').to_numpy()
+        return result
+
+    def summaries(self, precision=None):
+        """步驟6、8 的匯總（與 stages.PROMPT_STAGES 的 monthly、products 結構相同）"""
+        return {
+            'monthly': (self.monthly('normal', precision), self.monthly('return', precision)),
+            'products': {
+                'sku_totals': self.sku_totals(),
+                'sku_diversity': self.sku_diversity(precision),
+                'country_totals': self.country_totals(precision),
+            },
+        }
+
+    def project(self, dimensions, names=None):
+        """投影到任意維度組合（CUBE_DIMENSIONS 的子集），回傳含退貨率的表；names 可重新命名維度列
+
+        含 CustomerID 時由 customers 投影，否則由 cells 投影；月份鍵輸出為 'YYYY-MM' 標籤。
+        """
+        dimensions = [dimensions] if isinstance(dimensions, str) else list(dimensions)
+        unknown = [d for d in dimensions if d not in CUBE_DIMENSIONS]
+        if unknown or not dimensions:
+            raise ValueError(f"投影維度必須是 {', '.join(CUBE_DIMENSIONS)} 的組合: {dimensions}")
+        if 'CustomerID' in dimensions and 'StockCode' in dimensions:
+            raise ValueError("訂單立方體沒有 (CustomerID, StockCode) 粒度，無法投影")
+        table = self.customers if 'CustomerID' in dimensions else self.cells
+        is_return = (table['Type'] == 'return').to_numpy()
+        # 退貨旗標決定每一格的金額和計數落在哪一組欄位
+        stacked = table[dimensions].assign(
+            Return_Amount=np.where(is_return, table['Total'], 0.0),
+            Return_Count=np.where(is_return, table['Quantity_Count'], 0),
+            Revenue=np.where(is_return, 0.0, table['Total']),
+            Normal_Count=np.where(is_return, 0, table['Quantity_Count']),
+        )
+        if len(stacked) == 0:
+            analysis = pd.DataFrame(columns=dimensions + RETURN_RATE_COLUMNS[:4])
+        else:
+            analysis = stacked.groupby(dimensions, observed=True).sum().reset_index()
+        analysis = format_months(add_return_rates(analysis))
+        if names:
+            analysis.columns = list(names) + RETURN_RATE_COLUMNS
+        return analysis
+
+    def return_rates(self):
+        """步驟2-4：{維度的實際列名: 含退貨率的投影}（StockCode、CustomerID、Country）"""
+        rates = {}
+        for dimension, role in DIMENSION_ROLES.items():
+            col = self.columns.get(role)
+            if col and col not in rates:
+                rates[col] = self.project(dimension, names=[col])
+        return rates
+
+    def save(self, directory=HANDOFF_DIR):
+        """與交接檔一起寫出（Arrow IPC），manifest 記錄各分區的記錄數，供讀取端核對"""
+        import pyarrow as pa
+
+        manifest_path = os.path.join(directory, CUBE_MANIFEST)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        tables = {'cells': self.cells, 'customers': self.customers}
+        for name, table in tables.items():
+            if table is None:
+                continue
+            arrow_table = pa.Table.from_pandas(to_arrow_safe(table), preserve_index=False)
+            with pa.ipc.new_file(os.path.join(directory, CUBE_FILES[name]), arrow_table.schema) as writer:
+                writer.write_table(arrow_table)
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'columns': self.columns,
+                'rows': {sheet_name: self.rows(order_type) for sheet_name, order_type in ORDER_TYPES.items()},
+                'files': {name: CUBE_FILES[name] for name, table in tables.items() if table is not None},
+            }, f, ensure_ascii=False, indent=2)
+
+
+def load_cube(expected_rows=None, directory=HANDOFF_DIR):
+    """讀取已保存的立方體；不存在、沒有客戶表，或記錄數與 expected_rows（預設為交接檔 manifest）不符時回傳 None"""
+    manifest_path = os.path.join(directory, CUBE_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if expected_rows is None:
+        handoff = read_manifest(directory)
+        if handoff is None:
+            return None
+        expected_rows = {sheet_name: handoff.get(sheet_name, {}).get('rows') for sheet_name in ORDER_TYPES}
+    if 'customers' not in manifest['files'] or manifest['rows'] != expected_rows:
+        return None
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+    tables = {}
+    for name, file_name in manifest['files'].items():
+        source = pa.memory_map(os.path.join(directory, file_name), 'r')
+        tables[name] = pa.ipc.open_file(source).read_all().to_pandas()
+    return OrderCube(tables['cells'], tables['customers'], manifest['columns'])
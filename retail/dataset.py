@@ -0,0 +1,266 @@
+"""按 YearMonth 分區的訂單資料集（Hive 風格目錄，Parquet 檔）
+
+    訂單資料集/normal_order/YearMonth=2010-01/part-0.parquet
+    訂單資料集/abnormal_order/YearMonth=__HIVE_DEFAULT_PARTITION__/part-0.parquet  （日期缺失或無法解析）
+    訂單資料集/_manifest.json  （每個檔案的行數、Total 加總、日期範圍和內容雜湊）
+
+重新執行時只重寫內容雜湊改變的分區，不再存在的月份和工作表會被刪除。讀取時依 manifest 的月份剪枝，
+只開啟日期範圍內的檔案。
+
+步驟6的月度匯總和 SKU Diversity 按月份保存在 _summaries.json，每個月份的結果和它所用分區的內容雜湊一起保存：
+完整執行時由記憶體中的匯總直接寫入（seed_summaries），月份範圍查詢（monthly_summaries）只重新讀取和計算
+Normal/Return 分區內容改變的月份。
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from retail.cube import MONTHLY_COLUMNS, OrderCube
+from retail.handoff import PARTITIONS
+from retail.ingest import to_arrow_safe
+from retail.timeindex import month_keys, month_labels, parse_dates
+
+DATASET_DIR = '訂單資料集'
+DATASET_MANIFEST = '_manifest.json'
+DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+SUMMARY_CACHE = '_summaries.json'
+# 月度匯總使用的分區
+SUMMARY_SHEETS = ('Normal Order', 'return order')
+
+
+def _partition_dir(sheet_name):
+    return os.path.splitext(PARTITIONS[sheet_name])[0]
+
+
+def partition_keys(dates):
+    """日期列對應的 'YYYY-MM' 分區鍵；無法解析的日期為 DEFAULT_PARTITION"""
+    return month_labels(month_keys(dates), missing=DEFAULT_PARTITION)
+
+
+def _fingerprint(frame):
+    row_hashes = pd.util.hash_pandas_object(frame, index=False).to_numpy()
+    digest = hashlib.sha1(row_hashes.tobytes())
+    digest.update(json.dumps([str(c) for c in frame.columns]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_dataset_manifest(directory=DATASET_DIR):
+    """讀取資料集 manifest；不存在時回傳 None"""
+    path = os.path.join(directory, DATASET_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_dataset(frames, date_col, directory=DATASET_DIR):
+    """將 {工作表名稱: DataFrame} 按 YearMonth 寫成分區資料集，只重寫內容改變的分區
+
+    回傳 {工作表名稱: (重寫數, 未變數, 刪除數)}。
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    previous = read_dataset_manifest(directory) or {}
+    previous_partitions = previous.get('partitions', {}) if previous.get('date_col') == date_col else {}
+    manifest = {'date_col': date_col, 'partitions': {}}
+    summary = {}
+    os.makedirs(directory, exist_ok=True)
+    # 先移除 manifest，寫入中途失敗時讀取端不會讀到新舊混雜的分區
+    manifest_path = os.path.join(directory, DATASET_MANIFEST)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    for sheet_name, frame in frames.items():
+        partition_dir = _partition_dir(sheet_name)
+        old_entries = previous_partitions.get(sheet_name, {})
+        entries = {}
+        rewritten = unchanged = 0
+        keys = partition_keys(frame[date_col]) if len(frame) else np.array([], dtype=object)
+        order = np.argsort(keys, kind='stable')
+        boundaries = np.flatnonzero(keys[order][1:] != keys[order][:-1]) + 1
+        for rows in np.split(order, boundaries) if len(order) else []:
+            month = keys[rows[0]]
+            part = frame.iloc[rows]
+            fingerprint = _fingerprint(part)
+            relative = os.path.join(partition_dir, f'YearMonth={month}', 'part-0.parquet')
+            path = os.path.join(directory, relative)
+            old = old_entries.get(month)
+            if old and old['sha1'] == fingerprint and os.path.exists(path):
+                entries[month] = old
+                unchanged += 1
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pq.write_table(pa.Table.from_pandas(to_arrow_safe(part), preserve_index=False), path)
+            dates = parse_dates(part[date_col], date_col)
+            entries[month] = {
+                'file': relative,
+                'rows': int(len(part)),
+                'total': float(part['Total'].sum()) if 'Total' in part.columns else None,
+                'date_min': None if dates.isna().all() else str(dates.min()),
+                'date_max': None if dates.isna().all() else str(dates.max()),
+                'sha1': fingerprint,
+            }
+            rewritten += 1
+
+        # 刪除這次沒有資料的月份
+        removed = 0
+        for month, old in old_entries.items():
+            if month not in entries:
+                shutil.rmtree(os.path.dirname(os.path.join(directory, old['file'])), ignore_errors=True)
+                removed += 1
+        manifest['partitions'][sheet_name] = entries
+        summary[sheet_name] = (rewritten, unchanged, removed)
+
+    # 刪除這次沒有的工作表（例如上次 --dedup 才有的 Duplicate Order）的全部分區
+    for sheet_name, old_entries in previous_partitions.items():
+        if sheet_name not in frames:
+            shutil.rmtree(os.path.join(directory, _partition_dir(sheet_name)), ignore_errors=True)
+            summary[sheet_name] = (0, 0, len(old_entries))
+
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return summary
+
+
+def prune_months(manifest, sheet_name, start=None, end=None):
+    """依月份範圍（'YYYY-MM'，含兩端）選出分區；指定範圍時不含日期缺失的分區"""
+    months = sorted(manifest['partitions'].get(sheet_name, {}))
+    if start is None and end is None:
+        return months
+    return [month for month in months
+            if month != DEFAULT_PARTITION and (start is None or month >= start) and (end is None or month <= end)]
+
+
+def read_dataset(sheet_name, start=None, end=None, columns=None, directory=DATASET_DIR):
+    """讀取一個分區在 [start, end] 月份內的資料；回傳 (DataFrame, 讀取的檔案數, 全部檔案數)"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    manifest = read_dataset_manifest(directory)
+    if manifest is None:
+        raise FileNotFoundError(f"找不到資料集 {directory}/{DATASET_MANIFEST}，請先執行 execute_prompt.py")
+    entries = manifest['partitions'].get(sheet_name, {})
+    months = prune_months(manifest, sheet_name, start, end)
+    tables = [pq.read_table(os.path.join(directory, entries[month]['file']), columns=columns) for month in months]
+    if not tables:
+        if not entries:
+            return pd.DataFrame(columns=columns or []), 0, 0
+        # 範圍內沒有資料時仍回傳列名
+        schema = pq.read_schema(os.path.join(directory, next(iter(entries.values()))['file']))
+        empty = schema.empty_table()
+        return (empty.select(columns) if columns else empty).to_pandas(), 0, len(entries)
+    # 全空的列在個別檔案中可能是 null 型別，合併時提升為其他檔案的型別
+    return pa.concat_tables(tables, promote_options='default').to_pandas(), len(tables), len(entries)
+
+
+def _read_summary_cache(directory):
+    path = os.path.join(directory, SUMMARY_CACHE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_summary_cache(cache, directory):
+    tmp_path = os.path.join(directory, SUMMARY_CACHE + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(directory, SUMMARY_CACHE))
+
+
+def _month_hashes(manifest, month):
+    return {sheet_name: manifest['partitions'].get(sheet_name, {}).get(month, {}).get('sha1')
+            for sheet_name in SUMMARY_SHEETS}
+
+
+def _records(table):
+    """單一月份的匯總表轉為可寫入 JSON 的記錄（numpy 純量轉為 Python 型別）"""
+    if table is None:
+        return None
+    return [{key: value.item() if isinstance(value, np.generic) else value for key, value in row.items()}
+            for row in table.to_dict('records')]
+
+
+def _month_summary(month, columns, directory, manifest):
+    """讀取一個月份的 Normal/Return 分區，以訂單立方體計算該月的月度匯總和 SKU Diversity"""
+    frames = {}
+    for sheet_name in SUMMARY_SHEETS:
+        if month in manifest['partitions'].get(sheet_name, {}):
+            frames[sheet_name] = read_dataset(sheet_name, month, month, directory=directory)[0]
+    # 該月沒有退貨（或沒有正常訂單）時以另一個分區的空切片代替
+    template = next(iter(frames.values())).iloc[:0]
+    cube = OrderCube.from_frames(frames.get('Normal Order', template), frames.get('return order', template), columns)
+    return {
+        'normal': _records(cube.monthly('normal')),
+        'return': _records(cube.monthly('return')),
+        'sku_diversity': _records(cube.sku_diversity()),
+    }
+
+
+def seed_summaries(monthly, sku_diversity, columns, directory=DATASET_DIR):
+    """以剛寫入資料集的同一份資料在記憶體中的匯總（步驟6的 (normal, return) 和 SKU Diversity）建立 _summaries.json
+
+    完整執行時立方體已有每個月份的結果，不必再讀取分區重算；之後 monthly_summaries 的月份範圍查詢直接沿用。
+    回傳寫入的月份數；沒有資料集時回傳 None。
+    """
+    manifest = read_dataset_manifest(directory)
+    if manifest is None:
+        return None
+    months = sorted(set().union(*(manifest['partitions'].get(sheet_name, {}) for sheet_name in SUMMARY_SHEETS)))
+    tables = {'normal': monthly[0], 'return': monthly[1], 'sku_diversity': sku_diversity}
+    cache = {'columns': {role: col for role, col in columns.items() if col}, 'months': {}}
+    for month in months:
+        cache['months'][month] = {'sources': _month_hashes(manifest, month)}
+        for kind, table in tables.items():
+            cache['months'][month][kind] = (None if table is None
+                                            else _records(table[table['YearMonth'] == month]))
+    _write_summary_cache(cache, directory)
+    return len(months)
+
+
+def monthly_summaries(columns, start=None, end=None, directory=DATASET_DIR):
+    """步驟6的 (normal_monthly, return_monthly) 和 SKU Diversity，由 [start, end] 月份的分區計算
+
+    每個月份只在它的 Normal/Return 分區內容雜湊改變（或列名不同）時重新讀取和計算，其餘沿用 _summaries.json。
+    回傳 {'monthly': (normal, return), 'sku_diversity': 表或 None, 'computed': 重算的月份數, 'reused': 沿用的月份數}；
+    沒有資料集時回傳 None。
+    """
+    manifest = read_dataset_manifest(directory)
+    if manifest is None:
+        return None
+    months = sorted(set().union(*(prune_months(manifest, sheet_name, start, end) for sheet_name in SUMMARY_SHEETS)))
+    previous = _read_summary_cache(directory)
+    signature = {role: col for role, col in columns.items() if col}
+    cache = {'columns': signature, 'months': {}}
+    computed = reused = 0
+    for month in months:
+        hashes = _month_hashes(manifest, month)
+        old = previous.get('months', {}).get(month) if previous.get('columns') == signature else None
+        if old is not None and old['sources'] == hashes:
+            cache['months'][month] = old
+            reused += 1
+            continue
+        cache['months'][month] = {'sources': hashes, **_month_summary(month, columns, directory, manifest)}
+        computed += 1
+
+    # 沿用上次保存的、這次範圍外的月份，之後換範圍時仍可使用
+    for month, entry in previous.get('months', {}).items():
+        if month not in cache['months'] and previous.get('columns') == signature:
+            cache['months'][month] = entry
+    _write_summary_cache(cache, directory)
+
+    def table(kind, empty_columns):
+        records = [row for month in months for row in cache['months'][month][kind] or []]
+        return pd.DataFrame(records, columns=empty_columns) if records else pd.DataFrame(columns=empty_columns)
+
+    return {
+        'monthly': tuple(table(kind, ['YearMonth', *MONTHLY_COLUMNS[kind]]) for kind in ('normal', 'return')),
+        'sku_diversity': table('sku_diversity', ['YearMonth', 'SKU_Count']) if columns.get('stockcode') else None,
+        'computed': computed,
+        'reused': reused,
+    }
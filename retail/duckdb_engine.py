@@ -0,0 +1,253 @@
+"""DuckDB 引擎：在進程內執行 metrics.py 的分區規則和客戶匯總
+
+DuckDB 多執行緒執行，資料超過 memory_limit 時溢寫到 temp_directory，Parquet/CSV 來源直接掃描檔案，
+不需要整份載入記憶體。輸出的表與 pandas 引擎相同（列名、鍵排序、鍵為空的記錄不形成分組）。
+"""
+import os
+
+from retail.cube import OrderCube
+from retail.ingest import load_source
+from retail.matching import (LINE_ORDER, RETURN_LINE_ROLES, SALE_LINE_ROLES, SECONDS_PER_DAY, can_match,
+                             latency_tables)
+from retail.metrics import ABNORMAL_MISSING_ROLES, CUSTOMER_TOTALS_SQL, RETURN_CONDITION, ROW_METRICS
+from retail.quality import date_bounds, quality_sql, quality_tables
+from retail.timeindex import MONTH_COLUMN
+
+DUCKDB_TEMP_DIR = '.duckdb_tmp'
+DETAIL_BATCH_ROWS = 100_000
+PARTITION_COLUMN = '_partition'
+
+
+def quote(name):
+    """SQL 識別字（列名可能有空格，例如 Customer ID）"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _sql_expression(template, columns):
+    return template.format(**{role: quote(col) for role, col in columns.items() if col})
+
+
+class DuckDBEngine:
+    """以 DuckDB 分區並匯總；來源註冊為 raw 檢視，分區後為 classified 檢視"""
+
+    def __init__(self, memory_limit=None, temp_directory=DUCKDB_TEMP_DIR, threads=None):
+        import duckdb  # 未安裝時在建立時就拋出 ImportError
+
+        self.con = duckdb.connect()
+        os.makedirs(temp_directory, exist_ok=True)
+        self.con.execute(f"SET temp_directory = '{temp_directory}'")
+        if memory_limit:
+            self.con.execute(f"SET memory_limit = '{memory_limit}'")
+        if threads:
+            self.con.execute(f"SET threads = {int(threads)}")
+        self._frames = {}  # 已註冊的 DataFrame 需保持引用，DuckDB 只掃描不複製
+
+    def register_source(self, source_path, use_cache=True, columns=None):
+        """Parquet、CSV 直接掃描；Excel 先經欄式快取載入（Excel 受行數上限限制，可放入記憶體）
+
+        columns 為要讀取的原始列名（None 為全部），其餘列不會進入分區和交接檔。
+        """
+        extension = os.path.splitext(source_path)[1].lower()
+        path = source_path.replace("'", "''")
+        if extension == '.parquet':
+            scan = f"read_parquet('{path}')"
+        elif extension == '.csv':
+            scan = f"read_csv('{path}', header = true)"
+        else:
+            self.register_frame('raw', load_source(source_path, use_cache=use_cache, columns=columns))
+            return
+        self.con.execute(f"CREATE OR REPLACE VIEW raw AS SELECT * FROM {scan}")
+        if columns is not None:
+            # DuckDB 讀取 CSV 時可能去除列名的空格，以去除空格後的名稱對應
+            wanted = {str(c).strip() for c in columns}
+            selects = [quote(name) for name in self._column_types('raw') if str(name).strip() in wanted]
+            self.con.execute(f"CREATE OR REPLACE VIEW raw AS SELECT {', '.join(selects)} FROM {scan}")
+
+    def register_frame(self, name, frame):
+        """將 DataFrame（或 Arrow 表）註冊為檢視，DuckDB 直接掃描，不複製"""
+        self._frames[name] = frame
+        self.con.register(name, frame)
+
+    def sample(self, rows=1000):
+        """來源的前幾行，用於識別列名"""
+        df = self.con.execute(f"SELECT * FROM raw LIMIT {int(rows)}").fetchdf()
+        df.columns = [str(c).strip() for c in df.columns]
+        return df
+
+    def _column_types(self, view):
+        return {name: column_type for name, column_type, *_ in self.con.execute(f"DESCRIBE {view}").fetchall()}
+
+    def classify(self, columns):
+        """建立 classified 檢視：加上 Total 和分區列，日期列解析為 TIMESTAMP（無法解析為 NULL）"""
+        raw_columns = self._column_types('raw')
+        strip = {name: str(name).strip() for name in raw_columns}
+        date_col = columns['date']
+        selects = []
+        for name, column_type in raw_columns.items():
+            expression = quote(name)
+            if strip[name] == date_col and column_type != 'TIMESTAMP':
+                expression = f"TRY_CAST({expression} AS TIMESTAMP)"
+            selects.append(f"{expression} AS {quote(strip[name])}")
+        self.con.execute(f"CREATE OR REPLACE VIEW stripped AS SELECT {', '.join(selects)} FROM raw")
+
+        total = _sql_expression(ROW_METRICS['Total'], columns)
+        missing = ' OR '.join(f"{quote(columns[role])} IS NULL" for role in ABNORMAL_MISSING_ROLES)
+        returned = _sql_expression(RETURN_CONDITION, columns)
+        self.con.execute(f"""
+            CREATE OR REPLACE VIEW classified AS
+            SELECT *, {total} AS Total,
+                   CASE WHEN {missing} THEN 'Abnormal Order'
+                        WHEN {returned} THEN 'return order'
+                        ELSE 'Normal Order' END AS {PARTITION_COLUMN}
+            FROM stripped
+        """)
+        # 與 pandas 引擎相同：Normal/Return 只保留日期可解析的資料，並加上 YearMonth 月份鍵（見 timeindex.py）
+        date = quote(date_col)
+        for view, sheet_name in (('normal_order', 'Normal Order'), ('return_order', 'return order')):
+            self.con.execute(f"""
+                CREATE OR REPLACE VIEW {view} AS
+                SELECT * EXCLUDE ({PARTITION_COLUMN}),
+                       CAST(year({date}) * 12 + month({date}) - 1 AS INTEGER) AS {MONTH_COLUMN}
+                FROM classified
+                WHERE {PARTITION_COLUMN} = '{sheet_name}' AND {quote(date_col)} IS NOT NULL
+            """)
+        self.con.execute(f"""
+            CREATE OR REPLACE VIEW abnormal_order AS
+            SELECT * EXCLUDE ({PARTITION_COLUMN}) FROM classified WHERE {PARTITION_COLUMN} = 'Abnormal Order'
+        """)
+
+    def partition_stats(self):
+        """各分區的 (記錄數, Total 加總)，分區前的原始行數"""
+        rows = self.con.execute(f"""
+            SELECT {PARTITION_COLUMN}, COUNT(*), COALESCE(SUM(Total), 0) FROM classified GROUP BY 1
+        """).fetchall()
+        stats = {'Abnormal Order': (0, 0.0), 'return order': (0, 0.0), 'Normal Order': (0, 0.0)}
+        for sheet_name, count, total in rows:
+            stats[sheet_name] = (int(count), float(total))
+        return stats
+
+    def iter_partition(self, sheet_name, batch_rows=DETAIL_BATCH_ROWS):
+        """逐批讀取分區明細（Normal/Return 已移除日期無法解析的資料），保持原始順序"""
+        view = {'Normal Order': 'normal_order', 'return order': 'return_order',
+                'Abnormal Order': 'abnormal_order'}[sheet_name]
+        result = self.con.execute(f"SELECT * FROM {view}")
+        reader = (result.to_arrow_reader(batch_rows) if hasattr(result, 'to_arrow_reader')
+                  else result.fetch_record_batch(batch_rows))
+        empty = True
+        for batch in reader:
+            empty = False
+            yield batch.to_pandas()
+        if empty:
+            # 空分區仍輸出列名，交接檔和工作表與 pandas 引擎一致
+            yield reader.schema.empty_table().to_pandas()
+
+    def customer_totals(self, columns):
+        """以 SQL 計算 RFM 的客戶匯總；結果與 metrics.customer_totals 相同"""
+        if not columns.get('invoice'):
+            return None
+        result = self.con.execute(_sql_expression(CUSTOMER_TOTALS_SQL, columns)).fetchdf()
+        total_type = self._column_types('normal_order').get('Total', '')
+        if total_type.endswith('INT') or total_type == 'HUGEINT':
+            # 與 pandas 相同：整數列的加總保持整數
+            result['Monetary'] = result['Monetary'].astype('int64')
+        return result
+
+    def order_cube(self, columns):
+        """Normal + Return 疊在一起只掃描一次，以 SQL 建立訂單立方體（結構與 OrderCube.from_frames 相同）"""
+        def dimension(role):
+            return quote(columns[role]) if columns.get(role) else 'NULL'
+
+        quantity = quote(columns['quantity'])
+        # 與 pandas 相同：整數列的加總保持整數
+        quantity_sum = "COALESCE(SUM(quantity), 0)"
+        quantity_type = self._column_types('normal_order').get(columns['quantity'], '')
+        if quantity_type.endswith('INT') or quantity_type == 'HUGEINT':
+            quantity_sum = f"CAST({quantity_sum} AS BIGINT)"
+        # 月份鍵由日期計算（execute_return_abnormal.py 從 彙總表.xlsx 載入時 YearMonth 是標籤）
+        date = f"TRY_CAST({quote(columns['date'])} AS TIMESTAMP)"
+        facts = ' UNION ALL '.join(f"""
+            SELECT CAST(year({date}) * 12 + month({date}) - 1 AS INTEGER) AS {MONTH_COLUMN},
+                   {dimension('country')} AS Country, {dimension('stockcode')} AS StockCode,
+                   {dimension('customerid')} AS CustomerID, '{order_type}' AS Type,
+                   Total, {quantity} AS quantity
+            FROM {view}""" for view, order_type in (('normal_order', 'normal'), ('return_order', 'return')))
+        self.con.execute(f"CREATE OR REPLACE TEMP VIEW cube_facts AS {facts}")
+        cells = self.con.execute(f"""
+            SELECT {MONTH_COLUMN}, Country, StockCode, Type,
+                   COUNT(*) AS Rows, COALESCE(SUM(Total), 0) AS Total, COUNT(Total) AS Total_Count,
+                   {quantity_sum} AS Quantity, COUNT(quantity) AS Quantity_Count
+            FROM cube_facts GROUP BY ALL ORDER BY ALL
+        """).fetchdf()
+        customers = self.con.execute(f"""
+            SELECT {MONTH_COLUMN}, Country, CustomerID, Type,
+                   COALESCE(SUM(Total), 0) AS Total, COUNT(quantity) AS Quantity_Count
+            FROM cube_facts GROUP BY ALL ORDER BY ALL
+        """).fetchdf()
+        return OrderCube(cells, customers, columns)
+
+    def prompt_stage_results(self, columns):
+        """與 stages.PROMPT_STAGES 相同結構的結果：訂單立方體和 RFM 的客戶匯總"""
+        return {'cube': self.order_cube(columns), 'customers': self.customer_totals(columns)}
+
+    def register_partitions(self, partitions):
+        """execute_return_abnormal.py：將三個分區（通常來自交接檔的 memory map）註冊為檢視"""
+        for view, sheet_name in (('normal_order', 'Normal Order'), ('return_order', 'return order'),
+                                 ('abnormal_order', 'Abnormal Order')):
+            self.register_frame(view, partitions[sheet_name])
+
+    def return_rate_stage(self, columns):
+        """與 stages.return_rate_stage 相同：{維度列: 含退貨率的投影}"""
+        return self.order_cube(columns).return_rates()
+
+    def return_latency_stage(self, columns):
+        """與 stages.return_latency_stage 相同：以 ASOF JOIN 配對退貨和最近的原始銷售"""
+        if not can_match(columns):
+            return None
+
+        def select(roles):
+            # 日期列可能是文字（從 彙總表.xlsx 載入時），與 classify 相同以 TRY_CAST 解析
+            return ', '.join((f"TRY_CAST({quote(columns[role])} AS TIMESTAMP)" if role == 'date' else quote(columns[role]))
+                             + f" AS {quote(name)}" for role, name in roles.items() if columns.get(role))
+
+        return_names = [name for role, name in RETURN_LINE_ROLES.items() if columns.get(role)]
+        sale_names = [name for role, name in SALE_LINE_ROLES.items()
+                      if columns.get(role) and name not in ('StockCode', 'CustomerID')]
+        order = ', '.join(f"r.{quote(name)}" for name in LINE_ORDER if name in return_names)
+        # 銷售只保留出現在退貨中的組合；同一組合內取日期不晚於退貨的最後一筆銷售
+        lines = self.con.execute(f"""
+            WITH r AS (
+                SELECT {select(RETURN_LINE_ROLES)} FROM return_order
+            ), s AS (
+                SELECT {select(SALE_LINE_ROLES)} FROM normal_order
+                WHERE ({quote(columns['customerid'])}, {quote(columns['stockcode'])}) IN (
+                    SELECT (CustomerID, StockCode) FROM r)
+            )
+            SELECT {', '.join(f"r.{quote(name)}" for name in return_names)},
+                   {', '.join(f"s.{quote(name)}" for name in sale_names)},
+                   (epoch(r.Return_Date) - epoch(s.Sale_Date)) / {SECONDS_PER_DAY} AS Latency_Days
+            FROM r ASOF LEFT JOIN s
+              ON r.CustomerID = s.CustomerID AND r.StockCode = s.StockCode AND r.Return_Date >= s.Sale_Date
+            ORDER BY {order}
+        """).fetchdf()
+        return latency_tables(lines)
+
+    def quality_stage(self, columns):
+        """與 stages.quality_stage 相同：指示矩陣的檢查編譯為 SUM(CASE ...)，每個分區只掃描一次"""
+        bounds = date_bounds()
+        measures = ', '.join(f"CAST(SUM(CASE WHEN {condition} THEN 1 ELSE 0 END) AS BIGINT) AS {quote(name)}"
+                             for name, condition in quality_sql(columns, bounds))
+        keys = [quote(columns[role]) for role in ('stockcode', 'country') if columns.get(role)]
+        profiles = {}
+        for view, sheet_name in (('normal_order', 'Normal Order'), ('return_order', 'return order'),
+                                 ('abnormal_order', 'Abnormal Order')):
+            if sheet_name == 'Abnormal Order' and len(keys) == 2:
+                # 與 pandas 相同：鍵為空的記錄也形成分組並排在最後
+                profiles[sheet_name] = self.con.execute(f"""
+                    SELECT {', '.join(keys)}, {measures}, COUNT(*) AS Total_Count
+                    FROM {view} GROUP BY 1, 2 ORDER BY 1 NULLS LAST, 2 NULLS LAST
+                """).fetchdf()
+            else:
+                # 空分區的 SUM 為 NULL，與 pandas 相同計為 0
+                profiles[sheet_name] = self.con.execute(
+                    f"SELECT {measures}, COUNT(*) AS Total_Count FROM {view}").fetchdf().fillna(0)
+        return quality_tables(profiles, columns)
@@ -0,0 +1,60 @@
+"""重複交易偵測：每一行的鍵列以向量化方式雜湊為 uint64，以雜湊表標記重複
+
+- 完全重複（Exact）：所有已識別的列都相同，保留第一筆，之後的每一筆都標記；
+  duplicated 以雜湊表實作，為線性時間
+- 近似重複（Near）：Invoice、StockCode、Quantity 相同，且與同組前一筆的時間相隔不超過 window 秒；
+  先以雜湊表找出出現不只一次的 (Invoice, StockCode, Quantity)，只對這些候選行按日期排序
+
+64 位元雜湊的碰撞機率約為 n² / 2^65，數百萬行時可忽略。
+"""
+import numpy as np
+import pandas as pd
+
+DUPLICATE_SHEET = 'Duplicate Order'
+DUPLICATE_TYPE_COLUMN = 'Duplicate_Type'
+# 近似重複的鍵（角色）
+NEAR_KEY_ROLES = ('invoice', 'stockcode', 'quantity')
+
+
+def row_hashes(frame, cols):
+    """每一行 cols 的 uint64 雜湊（與索引無關）"""
+    return pd.util.hash_pandas_object(frame[cols], index=False).to_numpy()
+
+
+def can_detect_near(columns):
+    return all(columns.get(role) for role in NEAR_KEY_ROLES + ('date',))
+
+
+def duplicate_types(frame, columns, window=None):
+    """每一行的重複類型：'Exact'、'Near' 或 None（不重複）；window 為 None 時只偵測完全重複"""
+    types = np.full(len(frame), None, dtype=object)
+    if len(frame) == 0:
+        return types
+    key_cols = [col for col in columns.values() if col and col in frame.columns]
+    exact = pd.Series(row_hashes(frame, key_cols)).duplicated(keep='first').to_numpy()
+    types[exact] = 'Exact'
+    if window is None or not can_detect_near(columns):
+        return types
+
+    # 只有 (Invoice, StockCode, Quantity) 出現不只一次、日期有效且不是完全重複的行才需要比較時間
+    keys = row_hashes(frame, [columns[role] for role in NEAR_KEY_ROLES])
+    dates = frame[columns['date']].to_numpy(dtype='datetime64[ns]', na_value=np.datetime64('NaT'))
+    candidates = np.flatnonzero(pd.Series(keys).duplicated(keep=False).to_numpy() & ~exact & ~np.isnat(dates))
+    if len(candidates) == 0:
+        return types
+    # 同組內按日期排序（日期相同時保留原始順序），與前一筆相隔不超過 window 秒的為近似重複
+    order = candidates[np.lexsort((candidates, dates[candidates], keys[candidates]))]
+    same_key = keys[order[1:]] == keys[order[:-1]]
+    gap = dates[order[1:]] - dates[order[:-1]]
+    near = same_key & (gap <= np.timedelta64(int(window * 1e9), 'ns'))
+    types[order[1:][near]] = 'Near'
+    return types
+
+
+def split_duplicates(frame, columns, window=None):
+    """回傳 (重複的行（加上 Duplicate_Type 列）, 其餘的行)"""
+    types = duplicate_types(frame, columns, window)
+    mask = pd.notna(types)
+    duplicates = frame[mask].copy()
+    duplicates[DUPLICATE_TYPE_COLUMN] = types[mask]
+    return duplicates, frame[~mask].copy()
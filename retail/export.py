@@ -0,0 +1,190 @@
+"""Excel 輸出：逐列串流寫入（xlsxwriter constant_memory，未安裝時用 openpyxl write_only），
+列寬在寫入前由 DataFrame 向量化計算，不再逐格掃描工作表
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+
+DATETIME_FORMAT = 'YYYY-MM-DD HH:MM:SS'
+DATE_FORMAT = 'YYYY-MM-DD'
+EXCEL_MAX_ROWS = 1_048_576
+
+
+class ChunkedFrame:
+    """分塊提供資料的表格；open_chunks 每次呼叫都回傳新的 DataFrame 迭代器（計算列寬和寫入各走一遍）"""
+
+    def __init__(self, columns, open_chunks):
+        self.columns = list(columns)
+        self.open_chunks = open_chunks
+
+
+def _block_frames(block):
+    if isinstance(block, ChunkedFrame):
+        return block.open_chunks()
+    return [block]
+
+
+def _text_lengths(series):
+    """每格轉為字串後的最大長度（缺失值不計）"""
+    series = series.dropna()
+    if len(series) == 0:
+        return 0
+    if isinstance(series.dtype, pd.PeriodDtype) or series.dtype == object or pd.api.types.is_string_dtype(series):
+        return int(series.astype(str).str.len().max())
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return int(series.astype(str).str.len().max())
+    if pd.api.types.is_bool_dtype(series):
+        return 5
+    if pd.api.types.is_integer_dtype(series):
+        # 整數長度只取決於最大和最小值
+        return max(len(str(series.max())), len(str(series.min())))
+    return int(series.astype(str).str.len().max())
+
+
+def column_widths(blocks, max_width):
+    """計算工作表各列寬度：max(標題、內容長度) + 2，上限 max_width"""
+    lengths = {}
+
+    def update(position, length):
+        lengths[position] = max(lengths.get(position, 0), length)
+
+    for block in blocks:
+        if isinstance(block, str):
+            update(0, len(block))
+        elif isinstance(block, (pd.DataFrame, ChunkedFrame)):
+            for position, name in enumerate(block.columns):
+                update(position, len(str(name)))
+            for frame in _block_frames(block):
+                for position in range(frame.shape[1]):
+                    update(position, _text_lengths(frame.iloc[:, position]))
+    return {position: min(length + 2, max_width) for position, length in lengths.items()}
+
+
+def _column_values(series):
+    """將列轉為 Python 值列表，缺失值為 None"""
+    if isinstance(series.dtype, pd.PeriodDtype):
+        values = series.astype(str).tolist()
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        values = list(series.dt.to_pydatetime()) if len(series) else []
+    else:
+        values = series.tolist()
+    missing = series.isna().to_numpy()
+    if missing.any():
+        values = [None if is_missing else value for value, is_missing in zip(values, missing)]
+    return values
+
+
+def _frame_rows(frame):
+    columns = [_column_values(frame.iloc[:, position]) for position in range(frame.shape[1])]
+    return zip(*columns) if columns else iter(())
+
+
+def _block_rows(block):
+    """把區塊展開為逐列的值序列"""
+    if isinstance(block, str):
+        yield (block,)
+    elif isinstance(block, int):
+        for _ in range(block):
+            yield ()
+    else:
+        if len(block.columns) == 0:
+            return
+        yield tuple(str(c) for c in block.columns)
+        for frame in _block_frames(block):
+            yield from _frame_rows(frame)
+
+
+def _limit_rows(sheet_name, blocks):
+    for row_index, row in enumerate(row for block in blocks for row in _block_rows(block)):
+        if row_index >= EXCEL_MAX_ROWS:
+            raise ValueError(f"工作表 {sheet_name} 超過 Excel 上限 {EXCEL_MAX_ROWS} 行")
+        yield row
+
+
+class _XlsxWriterBackend:
+    def __init__(self, path):
+        import xlsxwriter
+
+        self.workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        self.datetime_format = self.workbook.add_format({'num_format': DATETIME_FORMAT})
+        self.date_format = self.workbook.add_format({'num_format': DATE_FORMAT})
+
+    def write_sheet(self, sheet_name, widths, rows):
+        worksheet = self.workbook.add_worksheet(sheet_name)
+        for position, width in widths.items():
+            worksheet.set_column(position, position, width)
+        write_string, write_number = worksheet.write_string, worksheet.write_number
+        for row_index, row in enumerate(rows):
+            for col_index, value in enumerate(row):
+                if value is None:
+                    continue
+                if isinstance(value, str):
+                    write_string(row_index, col_index, value)
+                elif isinstance(value, bool):
+                    worksheet.write_boolean(row_index, col_index, value)
+                elif isinstance(value, (int, float, np.integer, np.floating)):
+                    if np.isfinite(value):
+                        write_number(row_index, col_index, value)
+                elif isinstance(value, datetime.datetime):
+                    worksheet.write_datetime(row_index, col_index, value.replace(tzinfo=None), self.datetime_format)
+                elif isinstance(value, datetime.date):
+                    worksheet.write_datetime(row_index, col_index, value, self.date_format)
+                else:
+                    write_string(row_index, col_index, str(value))
+
+    def close(self):
+        self.workbook.close()
+
+
+class _OpenpyxlWriteOnlyBackend:
+    def __init__(self, path):
+        from openpyxl import Workbook
+
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+
+    def write_sheet(self, sheet_name, widths, rows):
+        from openpyxl.utils import get_column_letter
+
+        worksheet = self.workbook.create_sheet(sheet_name)
+        # write_only 模式下列寬必須在寫入資料前設定
+        for position, width in widths.items():
+            worksheet.column_dimensions[get_column_letter(position + 1)].width = width
+        for row in rows:
+            worksheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+class ExcelExporter:
+    """串流寫入多個工作表；每個工作表由區塊組成：
+
+    - DataFrame / ChunkedFrame：標題列 + 資料列（沒有任何列的 DataFrame 不寫入內容）
+    - str：單格標題列
+    - int：空白列數
+    """
+
+    def __init__(self, path, max_width=30):
+        self.max_width = max_width
+        try:
+            self.backend = _XlsxWriterBackend(path)
+        except ImportError:
+            self.backend = _OpenpyxlWriteOnlyBackend(path)
+
+    def write_sheet(self, sheet_name, blocks):
+        if not isinstance(blocks, (list, tuple)):
+            blocks = [blocks]
+        widths = column_widths(blocks, self.max_width)
+        self.backend.write_sheet(sheet_name, widths, _limit_rows(sheet_name, blocks))
+
+    def close(self):
+        self.backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,129 @@
+"""execute_prompt.py 與 execute_return_abnormal.py 之間的二進位交接（Arrow IPC）
+
+彙總表.xlsx 只作為給人看的輸出；三個分區另外以未壓縮的 Arrow IPC 檔寫出，
+下游以 memory map 開啟，欄位直接包裝成 Arrow 型別，不需要複製或重新解析。
+"""
+import json
+import os
+
+import pandas as pd
+
+from retail.ingest import to_arrow_safe
+
+HANDOFF_DIR = '彙總表.arrow'
+PARTITIONS = {
+    'Normal Order': 'normal_order.arrow',
+    'Abnormal Order': 'abnormal_order.arrow',
+    'return order': 'return_order.arrow',
+    'Duplicate Order': 'duplicate_order.arrow',  # 只在 execute_prompt.py --dedup 時寫出
+}
+MANIFEST = 'manifest.json'
+# 訂單立方體（cube.py）與交接檔一起寫出，交接檔重寫時一併失效
+CUBE_MANIFEST = 'cube.json'
+
+
+class PartitionWriter:
+    """逐塊寫入交接分區；close() 時才寫 manifest，供串流模式使用"""
+
+    def __init__(self, directory=HANDOFF_DIR):
+        import pyarrow  # noqa: F401  未安裝時在建立時就拋出 ImportError
+
+        self.directory = directory
+        self._writers = {}
+        self._schemas = {}
+        self._rows = {}
+        os.makedirs(directory, exist_ok=True)
+        # 先移除 manifest，寫入中途失敗時下游不會讀到新舊混雜的分區
+        clear_partitions(directory)
+
+    def write(self, sheet_name, df):
+        import pyarrow as pa
+
+        if sheet_name not in self._writers:
+            table = pa.Table.from_pandas(to_arrow_safe(df), preserve_index=False)
+            # 全空的列推斷為 null 型別，改為字串以便後續分塊寫入
+            schema = pa.schema([
+                field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                for field in table.schema
+            ]).with_metadata(table.schema.metadata)
+            path = os.path.join(self.directory, PARTITIONS[sheet_name])
+            # 不壓縮，才能 memory map 後零拷貝讀取
+            options = pa.ipc.IpcWriteOptions(compression=None)
+            self._writers[sheet_name] = pa.ipc.new_file(path, schema, options=options)
+            self._schemas[sheet_name] = schema
+            self._rows[sheet_name] = 0
+        schema = self._schemas[sheet_name]
+        table = pa.Table.from_pandas(to_arrow_safe(df), schema=schema, preserve_index=False)
+        self._writers[sheet_name].write_table(table)
+        self._rows[sheet_name] += table.num_rows
+
+    def close(self):
+        manifest = {}
+        for sheet_name, writer in self._writers.items():
+            writer.close()
+            manifest[sheet_name] = {'file': PARTITIONS[sheet_name], 'rows': self._rows[sheet_name]}
+        with open(os.path.join(self.directory, MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        return manifest
+
+
+def write_partitions(frames, directory=HANDOFF_DIR):
+    """將 {工作表名稱: DataFrame} 寫成 Arrow IPC 檔，並寫入 manifest"""
+    writer = PartitionWriter(directory)
+    for sheet_name, df in frames.items():
+        writer.write(sheet_name, df)
+    return writer.close()
+
+
+def clear_partitions(directory=HANDOFF_DIR):
+    """移除 manifest（和訂單立方體的 manifest），使下游改為讀取 彙總表.xlsx"""
+    for name in (MANIFEST, CUBE_MANIFEST):
+        manifest_path = os.path.join(directory, name)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+
+def _arrow_types_mapper(arrow_type):
+    import pyarrow as pa
+
+    # 擴展型別和字典編碼（categorical）交回 pandas 預設轉換
+    if isinstance(arrow_type, pa.ExtensionType) or pa.types.is_dictionary(arrow_type):
+        return None
+    return pd.ArrowDtype(arrow_type)
+
+
+def open_partitions(directory=HANDOFF_DIR):
+    """以 memory map 開啟交接分區，回傳 {工作表名稱: DataFrame}；不存在時回傳 None"""
+    manifest = read_manifest(directory)
+    if manifest is None:
+        return None
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+
+    frames = {}
+    for sheet_name, entry in manifest.items():
+        source = pa.memory_map(os.path.join(directory, entry['file']), 'r')
+        table = pa.ipc.open_file(source).read_all()
+        frames[sheet_name] = table.to_pandas(types_mapper=_arrow_types_mapper)
+    return frames
+
+
+def read_manifest(directory=HANDOFF_DIR):
+    """讀取 manifest；不存在時回傳 None"""
+    manifest_path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def iter_partition_chunks(sheet_name, directory=HANDOFF_DIR):
+    """以 memory map 逐個 record batch 讀取一個交接分區"""
+    import pyarrow as pa
+
+    entry = read_manifest(directory)[sheet_name]
+    reader = pa.ipc.open_file(pa.memory_map(os.path.join(directory, entry['file']), 'r'))
+    for i in range(reader.num_record_batches):
+        yield reader.get_batch(i).to_pandas(types_mapper=_arrow_types_mapper)
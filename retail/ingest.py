@@ -0,0 +1,278 @@
+"""原始資料讀取：解析 Excel 一次，之後從欄式快取（Feather）載入"""
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from retail.timeindex import parse_dates
+
+CACHE_VERSION = 1
+
+# 各角色列名的關鍵詞（不區分大小寫，依序比對）
+COLUMN_KEYWORDS = {
+    'quantity': ['Quantity', 'quantity', '數量'],
+    'customerid': ['Customer ID', 'CustomerID', 'Customer', 'customer'],
+    'description': ['Description', 'description', '描述'],
+    'price': ['Price', 'price', '價格', '單價'],
+    'date': ['InvoiceDate', 'Invoice Date', 'Date', 'date', '日期', '交易日期'],
+    'stockcode': ['StockCode', 'Stock Code', 'SKU', 'sku', '產品代碼'],
+    'country': ['Country', 'country', '國家', '國家'],
+    'invoice': ['InvoiceNo', 'Invoice No', 'Invoice', 'InvoiceNumber', '發票號碼', '發票'],
+}
+# 缺少時無法分類的角色
+REQUIRED_ROLES = ('quantity', 'customerid', 'description', 'price', 'date')
+# 宣告的型別：Price、Customer ID 統一為浮點數（與串流模式相同，Customer ID 可能有缺失值）
+DECLARED_DTYPES = {'price': 'float64', 'customerid': 'float64'}
+
+
+def find_column(df, keywords):
+    """查找包含關鍵詞的列名；df 可以是 DataFrame 或列名列表"""
+    keywords_lower = [k.lower() for k in keywords]
+    for col in getattr(df, 'columns', df):
+        col_lower = str(col).lower()
+        for keyword in keywords_lower:
+            if keyword in col_lower:
+                return col
+    return None
+
+
+def cache_paths(source_path, sheet_name=None):
+    """回傳快取資料檔與中繼資料檔的路徑（放在原始檔旁邊）；指定工作表時每個工作表各有一份快取"""
+    if sheet_name is not None:
+        source_path = f'{source_path}[{sheet_name}]'
+    return source_path + '.feather', source_path + '.cache.json'
+
+
+def file_fingerprint(source_path, with_hash=True):
+    """計算檔案指紋：大小、修改時間、內容雜湊"""
+    stat = os.stat(source_path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        digest = hashlib.sha256()
+        with open(source_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        fingerprint['sha256'] = digest.hexdigest()
+    return fingerprint
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(meta_path, meta):
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, meta_path)
+
+
+def as_text(series):
+    """將列轉為字串，保留缺失值"""
+    return series.where(series.isna(), series.astype(str)).astype(object)
+
+
+def to_arrow_safe(df):
+    """混合型別的 object 列（例如 StockCode 同時有數字和字串）統一轉為字串，以便欄式存儲；
+    Period 列轉為字串（與寫入 Excel 相同），避免讀取端未註冊 pandas 擴展型別時變成整數
+    """
+    df = df.copy()
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.PeriodDtype):
+            df[col] = df[col].astype(str)
+        elif df[col].dtype == object:
+            types = df[col].dropna().map(type).unique()
+            if len(types) > 1:
+                df[col] = as_text(df[col])
+    return df
+
+
+def compact_frame(df, text_columns=(), customerid_col=None, quantity_col=None, max_category_ratio=0.5):
+    """緊湊型別：低基數文字列轉為 categorical（所有分區共用同一字典），
+    Customer ID 轉為可為空的 Int32，Quantity 轉為 int32；轉換必須無損，否則保留原型別。
+
+    Price 保留 float64：float32 無法精確表示分位金額，會改變 Total 和 Revenue 的加總。
+    回傳 (新 DataFrame, 各列記憶體報告)。
+    """
+    before = df.memory_usage(deep=True, index=False)
+    before_types = df.dtypes.astype(str)
+    df = df.copy()
+
+    for col in text_columns:
+        if not col or col not in df.columns:
+            continue
+        values = as_text(df[col]) if df[col].dtype == object else df[col]
+        if values.nunique(dropna=True) <= max_category_ratio * max(len(values), 1):
+            df[col] = values.astype('category')
+
+    if customerid_col and pd.api.types.is_numeric_dtype(df[customerid_col]):
+        ids = df[customerid_col]
+        present = ids.dropna()
+        if ((present % 1 == 0).all() and (len(present) == 0 or
+                                          (present.min() >= -2**31 and present.max() < 2**31))):
+            df[customerid_col] = ids.astype('Int32')
+
+    if quantity_col and pd.api.types.is_integer_dtype(df[quantity_col]):
+        quantities = df[quantity_col]
+        if len(quantities) == 0 or (quantities.min() >= -2**31 and quantities.max() < 2**31):
+            df[quantity_col] = quantities.astype('int32')
+
+    after = df.memory_usage(deep=True, index=False)
+    report = pd.DataFrame({
+        '原型別': before_types,
+        '新型別': df.dtypes.astype(str),
+        '原記憶體(MB)': (before / 2**20).round(2),
+        '新記憶體(MB)': (after / 2**20).round(2),
+    })
+    report.loc['總計'] = ['', '', round(before.sum() / 2**20, 2), round(after.sum() / 2**20, 2)]
+    return df, report
+
+
+def cached_columns(meta):
+    """快取中實際保存的列（舊版快取保存全部列）；meta['columns'] 是原始檔的完整列名"""
+    return meta.get('cached_columns', meta['columns'])
+
+
+def cache_covers(meta, columns=None):
+    """有效的快取（check_cache 的結果，可為 None）是否包含要載入的列（columns 為 None 時為全部列）"""
+    return meta is not None and set(meta['columns'] if columns is None else columns) <= set(cached_columns(meta))
+
+
+def check_cache(source_path, sheet_name=None):
+    """檢查快取是否仍有效，有效則回傳中繼資料，否則回傳 None"""
+    data_path, meta_path = cache_paths(source_path, sheet_name)
+    meta = _read_meta(meta_path)
+    if not meta or meta.get('version') != CACHE_VERSION or not os.path.exists(data_path):
+        return None
+
+    fingerprint = file_fingerprint(source_path, with_hash=False)
+    if fingerprint['size'] != meta['source']['size']:
+        return None
+    if fingerprint['mtime_ns'] == meta['source']['mtime_ns']:
+        return meta
+
+    # 修改時間變了但內容可能相同（例如複製或 touch），用內容雜湊確認
+    fingerprint = file_fingerprint(source_path)
+    if fingerprint['sha256'] != meta['source']['sha256']:
+        return None
+    meta['source'] = fingerprint
+    _write_meta(meta_path, meta)
+    return meta
+
+
+def read_header(source_path, use_cache=True, sheet_name=None):
+    """只讀取原始資料的列名（快取有效時取自快取的中繼資料），不解析資料行；sheet_name 為 None 時讀取第一個工作表"""
+    extension = os.path.splitext(source_path)[1].lower()
+    if extension == '.parquet':
+        import pyarrow.parquet as pq
+
+        return list(pq.read_schema(source_path).names)
+    if use_cache:
+        meta = check_cache(source_path, sheet_name)
+        if meta is not None:
+            return list(meta['columns'])
+    if extension == '.csv':
+        return [str(c) for c in pd.read_csv(source_path, nrows=0).columns]
+    return [str(c) for c in pd.read_excel(source_path, sheet_name=sheet_name or 0, nrows=0).columns]
+
+
+def resolve_columns(header):
+    """以 COLUMN_KEYWORDS 比對列名，回傳 {角色: 原始列名}（找不到為 None）"""
+    return {role: find_column(header, keywords) for role, keywords in COLUMN_KEYWORDS.items()}
+
+
+def check_required(columns, source_path):
+    """缺少必要角色時在載入資料之前拋出錯誤"""
+    missing = [role for role in REQUIRED_ROLES if not columns.get(role)]
+    if missing:
+        raise ValueError(f"找不到必要的列 {missing}，請檢查資料文件 {source_path}")
+
+
+def projection(header, columns):
+    """需要載入的列：已識別的角色列，保持原始順序"""
+    wanted = {col for col in columns.values() if col}
+    return [col for col in header if col in wanted]
+
+
+def apply_schema(df, columns):
+    """載入後套用宣告的型別，並以同一個明確格式解析日期列（之後的步驟不再解析）"""
+    for role, dtype in DECLARED_DTYPES.items():
+        col = columns.get(role)
+        if col in df.columns and pd.api.types.is_numeric_dtype(df[col]) and df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    date_col = columns.get('date')
+    if date_col in df.columns:
+        df[date_col] = parse_dates(df[date_col], date_col)
+    return df
+
+
+def read_raw(source_path, columns=None, **read_kwargs):
+    """依副檔名解析原始資料（.xlsx/.xls、.csv、.parquet）；columns 為要載入的列（None 為全部）"""
+    extension = os.path.splitext(source_path)[1].lower()
+    if extension == '.csv':
+        return pd.read_csv(source_path, usecols=columns, **read_kwargs)
+    if extension == '.parquet':
+        return pd.read_parquet(source_path, columns=columns, **read_kwargs)
+    return pd.read_excel(source_path, usecols=columns, **read_kwargs)
+
+
+def load_source(source_path, use_cache=True, columns=None, sheet_name=None, **read_kwargs):
+    """讀取原始資料；若快取有效則直接從 Feather 載入，否則解析原始檔並寫入快取
+
+    columns 不為 None 時只載入這些列：首次解析也只解析這些列（usecols），快取只保存已解析的列；
+    之後需要快取沒有的列時重新解析一次，並與快取原有的列合併保存。
+    不論是否使用快取，混合數字和字串的列（例如 Invoice、StockCode）都轉為字串。
+    sheet_name 指定 Excel 的工作表（None 為第一個工作表）。
+    """
+    if sheet_name is not None:
+        read_kwargs['sheet_name'] = sheet_name
+    if os.path.splitext(source_path)[1].lower() == '.parquet':
+        # Parquet 本身是欄式格式，不需要快取
+        print(f"正在讀取 {os.path.basename(source_path)}...")
+        return read_raw(source_path, columns, **read_kwargs)
+
+    if use_cache:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print("警告: 未安裝 pyarrow，無法使用欄式快取，直接讀取 Excel")
+            use_cache = False
+
+    data_path, meta_path = cache_paths(source_path, sheet_name)
+    meta = check_cache(source_path, sheet_name) if use_cache else None
+    if cache_covers(meta, columns):
+        print(f"從快取載入 {os.path.basename(data_path)}...")
+        return pd.read_feather(data_path, columns=columns)
+
+    print(f"正在讀取 {os.path.basename(source_path)}...")
+    if not use_cache:
+        # 與快取相同，混合型別的列統一轉為字串，輸出的儲存格型別不因是否使用快取而不同
+        return to_arrow_safe(read_raw(source_path, columns, **read_kwargs))
+
+    # 先取指紋再解析，避免解析期間檔案被修改而寫入過期的指紋
+    fingerprint = file_fingerprint(source_path)
+    header = meta['columns'] if meta is not None else read_header(source_path, use_cache=False, sheet_name=sheet_name)
+    parse = None
+    if columns is not None:
+        # 只解析需要的列（加上仍有效的快取已有的列），未使用的列不增加解析時間
+        wanted = set(columns) | (set(cached_columns(meta)) if meta is not None else set())
+        parse = [col for col in header if col in wanted]
+    df = to_arrow_safe(read_raw(source_path, parse, **read_kwargs))
+
+    tmp_path = data_path + '.tmp'
+    df.to_feather(tmp_path)
+    os.replace(tmp_path, data_path)
+    _write_meta(meta_path, {
+        'version': CACHE_VERSION,
+        'source': fingerprint,
+        'rows': len(df),
+        'columns': header,
+        'cached_columns': [str(c) for c in df.columns],
+    })
+    print(f"已寫入快取 {os.path.basename(data_path)} ({len(df.columns)}/{len(header)} 列，{len(df)} 行)")
+    return df if columns is None else df[columns]
@@ -0,0 +1,255 @@
+"""月度 KPI（步驟6、7）的計算，以及可增量追加的 KPI 狀態"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from retail.ingest import check_required, file_fingerprint, projection, read_header, resolve_columns
+from retail.stream import DEFAULT_CHUNK_ROWS, StreamingAggregator, iter_source_chunks
+from retail.timeindex import format_months
+
+KPI_STATE_DIR = 'kpi_state'
+KPI_STATE_VERSION = 2
+# 完整執行的選項：重複交易和部分之間的重疊要與所有歷史資料比對，追加只讀取新檔案，無法重現
+PLAIN_OPTIONS = {'dedup': False, 'dedup_window': None, 'parts': 1}
+
+# 增長率列 -> 來源列
+GROWTH_COLUMNS = {
+    'Revenue_Growth': 'Revenue',
+    'Orders_Growth': 'Normal_Orders',
+    'Customer_Growth': 'Customer',
+    'Gross_Revenue_Growth': 'Gross_Revenue',
+    'Gross_Orders_Growth': 'Gross_Orders',
+}
+AOV_ARPU_GROWTH_COLUMNS = {
+    'AOV_Growth': 'AOV',
+    'ARPU_Growth': 'ARPU',
+}
+
+
+def merge_monthly(normal_monthly, return_monthly):
+    """合併 Normal 和 Return 月度匯總，計算 Gross KPI（未四捨五入）"""
+    kpis = normal_monthly.merge(return_monthly, on='YearMonth', how='left').fillna(0)
+    # Gross Revenue = -Return + Revenue, Gross Orders = -Return Orders + Normal Orders
+    kpis['Gross_Revenue'] = -kpis['Return'] + kpis['Revenue']
+    kpis['Gross_Orders'] = -kpis['Return_Orders'] + kpis['Normal_Orders']
+    return kpis.sort_values('YearMonth').reset_index(drop=True)
+
+
+def _growth(values, previous):
+    """與 pct_change() * 100 相同，第一期（無上期）為 0"""
+    return ((values / previous - 1) * 100).fillna(0).round(2)
+
+
+def _apply_growth(kpis, growth_columns, positions):
+    if positions is None:
+        positions = np.arange(len(kpis))
+    positions = np.asarray(sorted(set(p for p in positions if 0 <= p < len(kpis))), dtype=int)
+    if len(positions) == 0:
+        return kpis
+    for growth_col, source_col in growth_columns.items():
+        values = kpis[source_col].to_numpy(dtype=float)
+        previous = np.where(positions > 0, values[np.maximum(positions - 1, 0)], np.nan)
+        growth = _growth(pd.Series(values[positions]), pd.Series(previous))
+        if growth_col not in kpis.columns:
+            kpis[growth_col] = 0.0
+        kpis.loc[positions, growth_col] = growth.to_numpy()
+    return kpis
+
+
+def apply_growth(kpis, positions=None):
+    """計算月度增長率；positions 指定只重算的列位置（預設全部）"""
+    return _apply_growth(kpis, GROWTH_COLUMNS, positions)
+
+
+def apply_aov_arpu(kpis, positions=None):
+    """計算 AOV、ARPU 及其增長率（基於四捨五入後的 Revenue，不使用 Gross）"""
+    if positions is None:
+        rows = slice(None)
+    else:
+        rows = sorted(set(p for p in positions if 0 <= p < len(kpis)))
+    revenue = kpis.loc[rows, 'Revenue'].round(2)
+    # AOV = Revenue / Normal Orders, ARPU = Revenue / Customer，避免除零錯誤
+    kpis.loc[rows, 'AOV'] = (revenue / kpis.loc[rows, 'Normal_Orders'].replace(0, np.nan)).round(2)
+    kpis.loc[rows, 'ARPU'] = (revenue / kpis.loc[rows, 'Customer'].replace(0, np.nan)).round(2)
+    # AOV/ARPU 改變時，下一期的增長率也要重算
+    growth_positions = None if positions is None else set(positions) | {p + 1 for p in positions}
+    return _apply_growth(kpis, AOV_ARPU_GROWTH_COLUMNS, growth_positions)
+
+
+def monthly_kpis_table(kpis):
+    """輸出用的月度 KPI 表（Gross Revenue, Return, Revenue, Gross Orders, Return Orders, Normal Orders, Customer, Growth Rates）"""
+    # HyperLogLog 模式的 Customer 是估計值，誤差列放在旁邊
+    customer_cols = ['Customer', 'Customer_Error'] if 'Customer_Error' in kpis.columns else ['Customer']
+    monthly_kpis_df = kpis[['YearMonth',
+                            'Gross_Revenue', 'Return', 'Revenue',
+                            'Gross_Orders', 'Return_Orders', 'Normal_Orders'] +
+                           customer_cols +
+                           ['Gross_Revenue_Growth', 'Gross_Orders_Growth',
+                            'Revenue_Growth', 'Orders_Growth', 'Customer_Growth']].copy()
+    for col in ['Gross_Revenue', 'Revenue', 'Return']:
+        monthly_kpis_df[col] = monthly_kpis_df[col].round(2)
+    return monthly_kpis_df.rename(columns={'Orders_Growth': 'Normal_Orders_Growth'})
+
+
+def aov_arpu_table(kpis):
+    """輸出用的 AOV & ARPU 表"""
+    return kpis[['YearMonth', 'AOV', 'ARPU', 'AOV_Growth', 'ARPU_Growth']].copy()
+
+
+class KpiState:
+    """持久化的月度 KPI 狀態：各月匯總、各月不重複客戶，以及已計算好的 KPI 表
+
+    追加新月份資料時只更新受影響的月份，並只重算這些月份及其下一期的增長率，
+    結果與完整重算相同。options 記錄建立狀態時的 --dedup、--dedup-window 和資料來源的部分數。
+    """
+
+    def __init__(self, normal_monthly, return_monthly, customers, kpis, sources=None, options=None):
+        self.normal_monthly = normal_monthly
+        self.return_monthly = return_monthly
+        self.customers = customers
+        self.kpis = kpis
+        self.sources = sources or []
+        self.options = {**PLAIN_OPTIONS, **(options or {})}
+
+    @classmethod
+    def build(cls, normal_monthly, return_monthly, normal_customers, return_customers, kpis, sources=None,
+              options=None):
+        """由完整執行的結果建立狀態；*_customers 為 (YearMonth, CustomerID) 不重複組合，sources 為各資料檔的指紋，
+        options 為完整執行的選項（鍵同 PLAIN_OPTIONS）
+        """
+        customers = pd.concat([
+            _customer_pairs('normal', normal_customers),
+            _customer_pairs('return', return_customers),
+        ], ignore_index=True)
+        return cls(
+            normal_monthly[['YearMonth', 'Revenue', 'Normal_Orders']].copy(),
+            return_monthly[['YearMonth', 'Return', 'Return_Orders']].copy(),
+            customers,
+            kpis.copy(),
+            list(sources or []),
+            options,
+        )
+
+    @classmethod
+    def load(cls, directory=KPI_STATE_DIR):
+        """讀取狀態；不存在時回傳 None"""
+        meta_path = os.path.join(directory, 'state.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != KPI_STATE_VERSION:
+            return None
+        tables = {name: pd.read_feather(os.path.join(directory, f'{name}.feather'))
+                  for name in ('normal_monthly', 'return_monthly', 'customers', 'kpis')}
+        return cls(sources=meta['sources'], options=meta['options'], **tables)
+
+    def save(self, directory=KPI_STATE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, 'state.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        for name in ('normal_monthly', 'return_monthly', 'customers', 'kpis'):
+            getattr(self, name).reset_index(drop=True).to_feather(os.path.join(directory, f'{name}.feather'))
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': KPI_STATE_VERSION, 'sources': self.sources, 'options': self.options},
+                      f, ensure_ascii=False, indent=2)
+
+    def has_source(self, sha256):
+        return any(source.get('sha256') == sha256 for source in self.sources)
+
+    def check_append(self, options=None):
+        """追加與完整重算相同的前提：狀態和這次追加都沒有使用 --dedup，且狀態由單一資料來源建立；否則拋出 ValueError"""
+        options = {**PLAIN_OPTIONS, **(options or {})}
+        if self.options['dedup'] or options['dedup']:
+            built = '（KPI 狀態以 --dedup 建立）' if self.options['dedup'] else ''
+            raise ValueError(f"--dedup/--dedup-window 要與所有歷史交易比對重複{built}，追加只讀取新檔案，"
+                             "無法得到與完整重算相同的結果，請改為完整執行 execute_prompt.py")
+        if self.options['parts'] > 1:
+            raise ValueError(f"KPI 狀態由 {self.options['parts']} 個資料來源合併建立：部分之間重疊的行要與所有歷史資料比對，"
+                             "追加無法得到與完整重算相同的結果，請改為完整執行 execute_prompt.py")
+
+    def append(self, normal_monthly, return_monthly, normal_customers, return_customers, source=None):
+        """追加新資料的月度匯總，回傳受影響（更新或新增）的月份"""
+        self.normal_monthly = _add_monthly(self.normal_monthly, normal_monthly[['YearMonth', 'Revenue', 'Normal_Orders']])
+        self.return_monthly = _add_monthly(self.return_monthly, return_monthly[['YearMonth', 'Return', 'Return_Orders']])
+        self.customers = pd.concat([
+            self.customers,
+            _customer_pairs('normal', normal_customers),
+            _customer_pairs('return', return_customers),
+        ], ignore_index=True).drop_duplicates(ignore_index=True)
+        if source:
+            self.sources.append(source)
+
+        touched = sorted(set(normal_monthly['YearMonth']) | set(return_monthly['YearMonth']))
+        # 只有 Normal Order 有資料的月份才出現在月度 KPI 中（與完整執行的 left merge 一致）
+        touched = [m for m in touched if m in set(self.normal_monthly['YearMonth'])]
+        if not touched:
+            return []
+
+        rows = merge_monthly(
+            self._with_customers('normal', self.normal_monthly, touched, 'Customer'),
+            self._with_customers('return', self.return_monthly, touched, 'Return_Customers'),
+        )
+        kpis = self.kpis[~self.kpis['YearMonth'].isin(touched)]
+        kpis = pd.concat([kpis, rows], ignore_index=True).sort_values('YearMonth').reset_index(drop=True)
+
+        # 受影響的月份及其下一期需要重算增長率
+        positions = set(np.flatnonzero(kpis['YearMonth'].isin(touched).to_numpy()))
+        apply_growth(kpis, positions | {p + 1 for p in positions})
+        apply_aov_arpu(kpis, positions)
+        self.kpis = kpis
+        return touched
+
+    def _with_customers(self, kind, monthly, months, column):
+        monthly = monthly[monthly['YearMonth'].isin(months)]
+        pairs = self.customers[(self.customers['Kind'] == kind) & self.customers['YearMonth'].isin(months)]
+        counts = pairs.groupby('YearMonth')['CustomerID'].count().rename(column)
+        result = monthly.merge(counts, left_on='YearMonth', right_index=True, how='left')
+        result[column] = result[column].fillna(0).astype('int64')
+        return result
+
+
+def append_source(state, source_path, chunk_rows=DEFAULT_CHUNK_ROWS, options=None):
+    """只讀取新檔案的資料（分類與完整執行相同），追加到 KPI 狀態，回傳受影響的月份
+
+    options 為這次執行的 --dedup/--dedup-window（鍵同 PLAIN_OPTIONS）；與狀態不一致或無法增量重現時拋出 ValueError。
+    """
+    state.check_append(options)
+    fingerprint = file_fingerprint(source_path)
+    if state.has_source(fingerprint['sha256']):
+        raise ValueError(f"{source_path} 已經追加過，不會重複計算")
+
+    # 只讀取列名識別角色，缺少必要的列時在讀取資料之前報錯；之後只讀取需要的列
+    header = read_header(source_path, use_cache=False)
+    columns = resolve_columns(header)
+    check_required(columns, source_path)
+    source_columns = projection(header, columns)
+    # 分塊的列名會去除前後空格
+    columns = {role: col.strip() if col else None for role, col in columns.items()}
+
+    aggregator = StreamingAggregator(
+        columns['quantity'], columns['price'], columns['customerid'], columns['description'], columns['date'])
+    for chunk in iter_source_chunks(source_path, chunk_rows, use_cache=False, columns=source_columns):
+        aggregator.update(chunk)
+
+    return state.append(
+        aggregator.monthly('normal'), aggregator.monthly('return'),
+        aggregator.monthly_customers('normal'), aggregator.monthly_customers('return'),
+        source={'path': os.path.basename(source_path), **fingerprint},
+    )
+
+
+def _customer_pairs(kind, pairs):
+    pairs = pairs.copy()
+    pairs.columns = ['YearMonth', 'CustomerID']
+    pairs['YearMonth'] = format_months(pairs)['YearMonth'].astype(str)
+    pairs.insert(0, 'Kind', kind)
+    return pairs.drop_duplicates(ignore_index=True)
+
+
+def _add_monthly(acc, part):
+    combined = pd.concat([acc, part], ignore_index=True)
+    return combined.groupby('YearMonth', as_index=False).sum()
@@ -0,0 +1,124 @@
+"""退貨與原始銷售配對：每筆退貨連結同一客戶、同一 StockCode 在退貨當時或之前最近的一筆銷售（as-of join）
+
+銷售只保留出現在退貨中的 (CustomerID, StockCode) 組合，組合編碼為單一 int64 鍵後按日期排序，
+merge_asof 以雜湊找到組合、在組內二分搜尋日期，整體為 O((n + m) log n)，不會逐對比較退貨和銷售。
+找不到符合條件銷售的退貨（例如原始銷售早於資料範圍）為未配對，Latency_Days 為空。
+"""
+import numpy as np
+import pandas as pd
+
+from retail.timeindex import parse_dates
+
+# 配對需要的角色
+MATCH_ROLES = ('customerid', 'stockcode', 'date')
+# 角色 -> 配對明細的列名
+RETURN_LINE_ROLES = {'invoice': 'Invoice', 'stockcode': 'StockCode', 'customerid': 'CustomerID',
+                     'country': 'Country', 'date': 'Return_Date', 'quantity': 'Quantity'}
+SALE_LINE_ROLES = {'invoice': 'Sale_Invoice', 'stockcode': 'StockCode', 'customerid': 'CustomerID',
+                   'date': 'Sale_Date'}
+# 配對明細的排序（DuckDB 引擎使用相同的順序）
+LINE_ORDER = ['Return_Date', 'Invoice', 'StockCode', 'Quantity']
+# 延遲分佈的區間（天，右閉）
+LATENCY_BUCKETS = {'Within_7_Days': 7, 'Days_8_30': 30, 'Days_31_90': 90, 'Over_90_Days': np.inf}
+SECONDS_PER_DAY = 86400
+
+
+def can_match(columns):
+    return all(columns.get(role) for role in MATCH_ROLES)
+
+
+def _select(frame, columns, roles):
+    """取出角色列並改為配對明細的列名（保留原型別，例如 --compact 的 categorical）"""
+    return pd.DataFrame({name: frame[columns[role]].reset_index(drop=True)
+                         for role, name in roles.items() if columns.get(role)})
+
+
+def _timestamps(values):
+    return pd.Series(parse_dates(values).to_numpy(dtype='datetime64[ns]', na_value=np.datetime64('NaT')))
+
+
+def _pair_keys(returns, sales):
+    """(CustomerID, StockCode) 組合編碼為 int64；任一鍵缺失為 -1，不與任何銷售配對"""
+    codes = []
+    for name in ('CustomerID', 'StockCode'):
+        values = pd.concat([returns[name], sales[name]], ignore_index=True)
+        codes.append(pd.factorize(values)[0].astype(np.int64))
+    customer, stockcode = codes
+    pairs = np.where((customer < 0) | (stockcode < 0), -1, customer * (stockcode.max() + 1) + stockcode)
+    return pairs[:len(returns)], pairs[len(returns):]
+
+
+def match_returns(sales, returns, columns):
+    """Return Order 的每一行配對到最近的 Normal Order 銷售；缺少配對需要的列時回傳 None
+
+    回傳的配對明細含退貨列（Invoice、StockCode、CustomerID、Country、Return_Date、Quantity）、
+    配對到的 Sale_Invoice、Sale_Date 及 Latency_Days（未四捨五入），按 LINE_ORDER 排序。
+    """
+    if not can_match(columns):
+        return None
+    lines = _select(returns, columns, RETURN_LINE_ROLES)
+    lines['Return_Date'] = _timestamps(lines['Return_Date'])
+    sales = _select(sales, columns, SALE_LINE_ROLES)
+    sales['Sale_Date'] = _timestamps(sales['Sale_Date'])
+    return_pairs, sale_pairs = _pair_keys(lines, sales)
+
+    # 只有出現在退貨中的組合需要建立索引，其餘銷售在排序前就排除
+    eligible = np.isin(sale_pairs, return_pairs[return_pairs >= 0]) & sales['Sale_Date'].notna().to_numpy()
+    index = (sales.loc[eligible].drop(columns=['CustomerID', 'StockCode'])
+             .assign(_pair=sale_pairs[eligible])
+             .sort_values('Sale_Date', kind='stable'))
+
+    lines['_row'] = np.arange(len(lines))
+    matchable = (return_pairs >= 0) & lines['Return_Date'].notna().to_numpy()
+    probes = lines.loc[matchable].assign(_pair=return_pairs[matchable]).sort_values('Return_Date', kind='stable')
+    # 同一組合內日期不晚於退貨的最後一筆銷售；日期相同時取原始順序的最後一筆
+    matched = pd.merge_asof(probes, index, left_on='Return_Date', right_on='Sale_Date', by='_pair',
+                            direction='backward', allow_exact_matches=True)
+    lines = pd.concat([matched, lines.loc[~matchable]], ignore_index=True).sort_values('_row')
+    lines['Latency_Days'] = (lines['Return_Date'] - lines['Sale_Date']).dt.total_seconds() / SECONDS_PER_DAY
+    order = [name for name in LINE_ORDER if name in lines.columns]
+    return lines.drop(columns=['_row', '_pair']).sort_values(order, kind='stable').reset_index(drop=True)
+
+
+def latency_summary(lines, key):
+    """按 key 匯總退貨數、未配對數和延遲分佈（平均、中位數、P90、最大值及各區間的退貨數）"""
+    if key not in lines.columns:
+        return pd.DataFrame()
+    latency = lines['Latency_Days']
+    groups = latency.groupby(lines[key], observed=True)
+    summary = pd.DataFrame({
+        'Returns': groups.size(),
+        'Matched': groups.count(),
+    })
+    summary['Unmatched'] = summary['Returns'] - summary['Matched']
+    summary['Unmatched_Rate'] = (summary['Unmatched'] / summary['Returns']).round(4)
+    summary['Latency_Mean'] = groups.mean().round(2)
+    summary['Latency_Median'] = groups.median().round(2)
+    summary['Latency_P90'] = groups.quantile(0.9).round(2)
+    summary['Latency_Max'] = groups.max().round(2)
+
+    # 每筆已配對的退貨落在第一個上界不小於延遲的區間，未配對的為 -1（不計入任何區間）
+    bucket = np.searchsorted(np.array(list(LATENCY_BUCKETS.values())), latency.to_numpy(), side='left')
+    bucket = pd.Series(np.where(latency.notna(), bucket, -1), index=lines.index)
+    counts = (bucket.groupby([lines[key], bucket], observed=True).size().unstack(fill_value=0)
+              .reindex(columns=range(len(LATENCY_BUCKETS)), fill_value=0))
+    counts.columns = list(LATENCY_BUCKETS)
+    summary = summary.join(counts).fillna({name: 0 for name in LATENCY_BUCKETS})
+    summary[list(LATENCY_BUCKETS)] = summary[list(LATENCY_BUCKETS)].astype('int64')
+    return (summary.rename_axis(key).reset_index()
+            .sort_values('Returns', ascending=False, kind='stable').reset_index(drop=True))
+
+
+def latency_tables(lines):
+    """由配對明細產生 {'lines': 明細, 'product': 按 StockCode, 'country': 按 Country}；lines 為 None 時回傳 None"""
+    if lines is None:
+        return None
+    tables = {
+        'product': latency_summary(lines, 'StockCode'),
+        'country': latency_summary(lines, 'Country'),
+    }
+    lines = lines.copy()
+    lines['Latency_Days'] = lines['Latency_Days'].round(2)
+    lines['Matched'] = lines['Latency_Days'].notna()
+    tables['lines'] = lines
+    return tables
@@ -0,0 +1,61 @@
+"""指標定義：列層級公式、分區規則和客戶匯總只寫一次，由 pandas 或 DuckDB 引擎執行
+
+列名以角色表示（quantity、customerid 等，同 COLUMN_KEYWORDS），執行時由 columns 對應到實際列名；
+Total、YearMonth 等衍生列直接使用列名。匯總後的衍生指標（Gross_Revenue、AOV、ARPU、Growth、
+Return_Rate、Return_Frequency、R/F/M 分數）只作用在小表上，兩個引擎共用 kpi.py、returns.py 等模組。
+"""
+import pandas as pd
+
+# 列層級公式：{角色} 代入列名，pandas 以 DataFrame.eval 計算，DuckDB 編譯為 SQL
+ROW_METRICS = {
+    'Total': '{quantity} * {price}',
+}
+
+# 分區規則（依序比對，第一個符合的規則決定分區）
+ABNORMAL_MISSING_ROLES = ['customerid', 'description']  # 任一缺失即為 Abnormal Order
+RETURN_CONDITION = '{quantity} < 0'                     # 其餘資料中符合條件的為 return order
+
+# RFM 的客戶匯總（月度、產品、國家和退貨率的匯總是訂單立方體的投影，見 cube.py）：日期和客戶都不為空的
+# Normal Order，每個客戶的最後購買日、唯一 Invoice 數和 Total 加總；{角色} 代入列名後由 DuckDB 執行
+CUSTOMER_TOTALS_COLUMNS = ['CustomerID', 'LastPurchaseDate', 'Frequency', 'Monetary']
+CUSTOMER_TOTALS_SQL = """
+    SELECT {customerid} AS CustomerID, MAX({date}) AS LastPurchaseDate,
+           COUNT(DISTINCT {invoice}) AS Frequency, COALESCE(SUM(Total), 0) AS Monetary
+    FROM normal_order
+    WHERE {date} IS NOT NULL AND {customerid} IS NOT NULL
+    GROUP BY 1 ORDER BY 1
+"""
+
+
+def row_metric(df, name, columns):
+    """以 pandas 計算列層級指標（例如 Total）"""
+    expression = ROW_METRICS[name].format(**{role: f'`{col}`' for role, col in columns.items() if col})
+    return df.eval(expression)
+
+
+def abnormal_mask(df, columns):
+    """Abnormal Order：ABNORMAL_MISSING_ROLES 中任一列缺失"""
+    mask = pd.Series(False, index=df.index)
+    for role in ABNORMAL_MISSING_ROLES:
+        mask |= df[columns[role]].isna()
+    return mask
+
+
+def return_mask(df, columns):
+    """return order：符合 RETURN_CONDITION（在移除 Abnormal Order 之後套用）"""
+    expression = RETURN_CONDITION.format(**{role: f'`{col}`' for role, col in columns.items() if col})
+    return df.eval(expression)
+
+
+def customer_totals(frame, columns):
+    """以 pandas 計算 RFM 的客戶匯總（同 CUSTOMER_TOTALS_SQL）；缺少 Invoice 列時回傳 None"""
+    if not columns.get('invoice'):
+        return None
+    frame = frame.dropna(subset=[columns['date'], columns['customerid']])
+    if len(frame) == 0:
+        return pd.DataFrame(columns=CUSTOMER_TOTALS_COLUMNS)
+    result = frame.groupby(columns['customerid'], observed=True).agg(
+        LastPurchaseDate=(columns['date'], 'max'), Frequency=(columns['invoice'], 'nunique'),
+        Monetary=('Total', 'sum')).reset_index()
+    result.columns = CUSTOMER_TOTALS_COLUMNS
+    return result
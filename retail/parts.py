@@ -0,0 +1,127 @@
+"""多檔案、多工作表的載入：展開檔案、glob 和 Excel 的所有工作表，各部分在進程池中並行解析後合併
+
+- 每個部分獨立識別列名，改名為第一個部分的列名後套用宣告的型別
+- 合併前統一各部分的型別：categorical 字典取聯集，categorical 與其他型別混合時還原為值，
+  文字與數字混合時（例如 StockCode 在某個工作表全是數字）統一轉為字串
+- 工作表之間重疊的行（例如兩個年度工作表都包含 2010-12）只保留一份：同一行在合併結果中出現的次數
+  是它在任一部分中出現的最多次數，因此同一個部分內真正重複的行保持不變（由 --dedup 處理）
+"""
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from retail.duplicates import row_hashes
+from retail.ingest import apply_schema, as_text, check_required, load_source, projection, read_header, resolve_columns
+from retail.stages import process_context
+
+EXCEL_EXTENSIONS = ('.xlsx', '.xlsm', '.xls')
+
+
+def expand_sources(patterns):
+    """展開檔案路徑和 glob，Excel 檔案展開為每個工作表，回傳 [(路徑, 工作表)]
+
+    只有一個工作表的 Excel 和其他格式的工作表為 None（讀取第一個工作表，與單一檔案相同）。
+    """
+    parts = []
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not paths or not all(os.path.exists(path) for path in paths):
+            raise FileNotFoundError(f"找不到資料檔 {pattern}")
+        for path in paths:
+            if os.path.splitext(path)[1].lower() in EXCEL_EXTENSIONS:
+                sheets = pd.ExcelFile(path).sheet_names
+                if len(sheets) > 1:
+                    parts.extend((path, sheet) for sheet in sheets)
+                    continue
+            parts.append((path, None))
+    return parts
+
+
+def part_label(part):
+    path, sheet = part
+    return os.path.basename(path) if sheet is None else f'{os.path.basename(path)} [{sheet}]'
+
+
+def _load_part(part, header, rename, columns, use_cache):
+    """子進程：載入一個部分的投影列，改名為統一的列名並套用型別"""
+    path, sheet = part
+    df = load_source(path, use_cache=use_cache, columns=projection(header, columns), sheet_name=sheet)
+    return apply_schema(df.rename(columns=rename), {role: rename.get(col, col) for role, col in columns.items()})
+
+
+def unify_dtypes(frames):
+    """統一各部分同名列的型別，使合併後 categorical 字典只有一份、不會退化為 object"""
+    # 後面的部分缺少的列補為缺失值
+    frames = [frame.reindex(columns=frames[0].columns) for frame in frames]
+    for col in frames[0].columns:
+        dtypes = [frame[col].dtype for frame in frames]
+        categorical = [isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes]
+        if all(categorical):
+            categories = union_categoricals([frame[col] for frame in frames], ignore_order=True).categories
+            for frame in frames:
+                frame[col] = frame[col].cat.set_categories(categories)
+            continue
+        if any(categorical):
+            for frame, is_categorical in zip(frames, categorical):
+                if is_categorical:
+                    frame[col] = frame[col].astype(frame[col].cat.categories.dtype)
+            dtypes = [frame[col].dtype for frame in frames]
+        numeric = [pd.api.types.is_numeric_dtype(dtype) for dtype in dtypes]
+        if any(numeric) and not all(numeric):
+            for frame in frames:
+                frame[col] = as_text(frame[col])
+    return frames
+
+
+def combine_parts(frames):
+    """合併各部分，回傳 (合併後的資料, 移除的重疊行數)
+
+    同一行（所有列都相同）在某個部分中的第 n 次出現，只有在之前的部分都出現不到 n 次時才保留。
+    """
+    frames = unify_dtypes(frames)
+    df = pd.concat(frames, ignore_index=True)
+    key = pd.DataFrame({
+        'hash': row_hashes(df, list(df.columns)),
+        'part': np.repeat(np.arange(len(frames), dtype=np.int32), [len(frame) for frame in frames]),
+    })
+    occurrence = key.groupby(['hash', 'part'], sort=False).cumcount().to_numpy()
+    # 每個 (行, 部分) 之前的部分中出現的最多次數
+    counts = key.groupby(['hash', 'part']).size()
+    earlier = counts.groupby(level='hash').cummax().groupby(level='hash').shift(fill_value=0)
+    keep = occurrence >= earlier.reindex(pd.MultiIndex.from_frame(key)).to_numpy()
+    return df[keep].reset_index(drop=True), int((~keep).sum())
+
+
+def load_parts(parts, use_cache=True, workers=1):
+    """並行載入所有部分並合併，回傳 (合併後的資料, {角色: 列名})；列名以第一個部分為準"""
+    headers = [read_header(path, use_cache=use_cache, sheet_name=sheet) for path, sheet in parts]
+    part_columns = [resolve_columns(header) for header in headers]
+    for part, columns in zip(parts, part_columns):
+        check_required(columns, part_label(part))
+    source_columns = part_columns[0]
+    # 第一個部分沒有的角色不載入，其餘部分的列改名為第一個部分的列名
+    part_columns = [{role: col if source_columns[role] else None for role, col in columns.items()}
+                    for columns in part_columns]
+    renames = [{col: source_columns[role] for role, col in columns.items() if col} for columns in part_columns]
+    print(f"載入 {len(projection(headers[0], source_columns))}/{len(headers[0])} 列")
+
+    tasks = list(zip(parts, headers, renames, part_columns))
+    context = process_context() if workers > 1 else None
+    if workers > 1 and context is None:
+        print("警告: 此平台不支援 fork，改為單進程載入")
+    if context is not None:
+        with ProcessPoolExecutor(max_workers=min(workers, len(parts)), mp_context=context) as pool:
+            futures = [pool.submit(_load_part, *task, use_cache) for task in tasks]
+            frames = [future.result() for future in futures]
+    else:
+        frames = [_load_part(*task, use_cache) for task in tasks]
+
+    for part, frame in zip(parts, frames):
+        print(f"  {part_label(part)}: {len(frame)} 行")
+    df, overlap = combine_parts(frames)
+    print(f"部分之間重疊的行: {overlap}（已移除）")
+    return df, source_columns
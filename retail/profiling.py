@@ -0,0 +1,217 @@
+"""逐步驟量測：牆鐘時間、CPU 時間、輸入/輸出行數和記憶體，結束時寫出 JSON 執行報告
+
+腳本是由上而下的步驟，因此不用 with 區塊包住每個步驟：step() 會結束上一個步驟並開始下一個，
+rows() 記錄目前步驟的輸入/輸出行數。記憶體有兩種模式：
+- rss：背景執行緒定時取樣進程 RSS（預設，幾乎沒有額外成本，包含 Arrow 等非 Python 配置）
+- tracemalloc：Python/numpy 配置的精確峰值，但會明顯拖慢執行
+"""
+import atexit
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MEMORY_MODES = ('rss', 'tracemalloc')
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def current_rss():
+    """目前進程的 RSS（位元組）；無法取得時回傳 None"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class _RssSampler(threading.Thread):
+    """定時取樣 RSS，記錄自上次 reset() 以來的最大值"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = current_rss()
+        self._stopped = threading.Event()
+
+    def reset(self):
+        self.peak = current_rss()
+
+    def run(self):
+        while not self._stopped.wait(RSS_SAMPLE_INTERVAL):
+            rss = current_rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def stop(self):
+        self._stopped.set()
+
+
+def _mb(value):
+    return None if value is None else round(value / 2 ** 20, 2)
+
+
+class RunProfiler:
+    """記錄每個步驟的量測結果；finish() 或進程結束時寫出 report_path"""
+
+    def __init__(self, script, report_path, memory='rss', profile_step=None, args=None):
+        if memory not in MEMORY_MODES:
+            raise ValueError(f"未知的記憶體模式: {memory}（可用: {', '.join(MEMORY_MODES)}）")
+        self.script = script
+        self.report_path = report_path
+        self.memory = memory
+        self.profile_step = profile_step
+        self.args = args or {}
+        self.steps = []
+        self.completed = False
+        self._current = None
+        self._cprofile = None
+        self._started = datetime.now()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+        if memory == 'tracemalloc':
+            tracemalloc.start()
+            self._sampler = None
+        else:
+            self._sampler = _RssSampler()
+            self._sampler.start()
+        # 腳本中途出錯或 sys.exit 時仍寫出已完成步驟的報告
+        atexit.register(self._write_report)
+
+    def _memory_now(self):
+        if self.memory == 'tracemalloc':
+            return tracemalloc.get_traced_memory()[0]
+        return current_rss()
+
+    def step(self, name, rows_in=None):
+        """結束目前步驟並開始名為 name 的步驟"""
+        self.end()
+        if self.memory == 'tracemalloc':
+            tracemalloc.reset_peak()
+        else:
+            self._sampler.reset()
+        self._current = {
+            'step': name,
+            'rows_in': rows_in,
+            'rows_out': None,
+            '_wall': time.perf_counter(),
+            '_cpu': time.process_time(),
+            '_memory': self._memory_now(),
+        }
+        if name == self.profile_step:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def rows(self, rows_in=None, rows_out=None):
+        """記錄目前步驟的輸入/輸出行數"""
+        if self._current is None:
+            return
+        if rows_in is not None:
+            self._current['rows_in'] = int(rows_in)
+        if rows_out is not None:
+            self._current['rows_out'] = int(rows_out)
+
+    def end(self):
+        """結束目前步驟（沒有進行中的步驟時不做任何事）"""
+        if self._current is None:
+            return
+        current, self._current = self._current, None
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._dump_cprofile(current['step'])
+            self._cprofile = None
+
+        wall = time.perf_counter() - current['_wall']
+        memory_end = self._memory_now()
+        if self.memory == 'tracemalloc':
+            peak = tracemalloc.get_traced_memory()[1]
+        else:
+            samples = [v for v in (self._sampler.peak, current['_memory'], memory_end) if v is not None]
+            peak = max(samples) if samples else None
+        allocated = memory_end - current['_memory'] if None not in (memory_end, current['_memory']) else None
+        rows_in = current['rows_in']
+        self.steps.append({
+            'step': current['step'],
+            'wall_seconds': round(wall, 4),
+            'cpu_seconds': round(time.process_time() - current['_cpu'], 4),
+            'rows_in': None if rows_in is None else int(rows_in),
+            'rows_out': current['rows_out'],
+            'rows_per_second': round(rows_in / wall, 1) if rows_in and wall > 0 else None,
+            'peak_mb': _mb(peak),
+            'allocated_mb': _mb(allocated),
+        })
+
+    def _profile_path(self, step_name):
+        stem = os.path.splitext(self.report_path)[0]
+        if stem.endswith('.report'):
+            stem = stem[:-len('.report')]
+        return f"{stem}.{step_name}.prof"
+
+    def _dump_cprofile(self, step_name):
+        path = self._profile_path(step_name)
+        self._cprofile.dump_stats(path)
+        buffer = io.StringIO()
+        pstats.Stats(self._cprofile, stream=buffer).sort_stats('cumulative').print_stats(15)
+        print(f"\n[{step_name}] cProfile（按累計時間前 15 項，完整結果見 {path}）:")
+        print(buffer.getvalue())
+
+    def _write_report(self):
+        self.end()
+        if self._sampler is not None:
+            self._sampler.stop()
+        report = {
+            'script': self.script,
+            'started': self._started.isoformat(timespec='seconds'),
+            'completed': self.completed,
+            'args': self.args,
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'memory_mode': self.memory,
+            'total': {
+                'wall_seconds': round(time.perf_counter() - self._wall_start, 4),
+                'cpu_seconds': round(time.process_time() - self._cpu_start, 4),
+                'peak_mb': max((s['peak_mb'] for s in self.steps if s['peak_mb'] is not None), default=None),
+            },
+            'steps': self.steps,
+        }
+        with open(self.report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+        return report
+
+    def finish(self):
+        """結束最後一個步驟並寫出報告"""
+        self.completed = True
+        atexit.unregister(self._write_report)
+        self._write_report()
+        print(f"\n已寫入執行報告 {self.report_path}")
+
+
+def add_profiling_arguments(parser, script):
+    """在 argparse 中加入 --report、--memory、--profile-step"""
+    stem = os.path.splitext(os.path.basename(script))[0]
+    parser.add_argument('--report', default=f'{stem}.report.json',
+                        help=f'每個步驟耗時、行數和記憶體的 JSON 報告（預設 {stem}.report.json）')
+    parser.add_argument('--memory', choices=MEMORY_MODES, default='rss',
+                        help='記憶體量測方式：rss 取樣（預設）或 tracemalloc（較精確但較慢）')
+    parser.add_argument('--profile-step', metavar='STEP',
+                        help='以 cProfile 剖析指定步驟（例如 步驟8），結果寫入 .prof 檔')
+
+
+def profiler_from_args(script, args):
+    return RunProfiler(os.path.basename(script), args.report, memory=args.memory,
+                       profile_step=args.profile_step, args=vars(args))
@@ -0,0 +1,189 @@
+"""資料品質剖析：每個 (列, 檢查) 產生一個 0/1 指示列，整個指示矩陣只掃描一次，按任意分組鍵加總
+
+檢查規則只寫一次：pandas 以 numpy 陣列計算，DuckDB 引擎編譯為 SUM(CASE ...) 的 SQL。
+Abnormal analysis product 工作表是 Abnormal Order 按 (StockCode, Country) 分組後的缺失計數；
+Data quality 工作表是每個分區、每一列的計數和比例（不適用的檢查留空）。
+"""
+import numpy as np
+import pandas as pd
+
+from retail.metrics import ABNORMAL_MISSING_ROLES
+from retail.timeindex import parse_dates
+
+# 角色 -> 指示列名稱中的標籤（Missing_CustomerID_Count 等）
+ROLE_LABELS = {
+    'quantity': 'Quantity',
+    'customerid': 'CustomerID',
+    'description': 'Description',
+    'price': 'Price',
+    'date': 'Date',
+    'stockcode': 'StockCode',
+    'country': 'Country',
+    'invoice': 'Invoice',
+}
+NUMERIC_ROLES = ('quantity', 'price', 'customerid')
+# 早於此日期或晚於執行當天的日期視為超出範圍
+MIN_VALID_DATE = '2000-01-01'
+
+# 檢查規則：(適用的角色（None 為全部）, pandas 函數, SQL 模板)
+# pandas 函數的參數為 (缺失, 解析後的值, 日期範圍)，都是 numpy 陣列；
+# SQL 模板中 {value} 是原始列，{parsed} 是 TRY_CAST 後的值，{lower}/{upper} 是日期範圍
+QUALITY_CHECKS = {
+    'Missing': (None, lambda missing, parsed, bounds: missing,
+                '{value} IS NULL'),
+    'Unparseable': (NUMERIC_ROLES + ('date',), lambda missing, parsed, bounds: ~missing & pd.isna(parsed),
+                    '{value} IS NOT NULL AND {parsed} IS NULL'),
+    'Negative': (('price',), lambda missing, parsed, bounds: parsed < 0,
+                 '{parsed} < 0'),
+    'Zero': (('price',), lambda missing, parsed, bounds: parsed == 0,
+             '{parsed} = 0'),
+    'Out_Of_Range': (('date',), lambda missing, parsed, bounds: (parsed < bounds[0]) | (parsed >= bounds[1]),
+                     "{parsed} < TIMESTAMP '{lower}' OR {parsed} >= TIMESTAMP '{upper}'"),
+}
+
+
+def date_bounds():
+    """有效日期範圍 [MIN_VALID_DATE, 執行當天的隔天)"""
+    return pd.Timestamp(MIN_VALID_DATE), pd.Timestamp.today().normalize() + pd.Timedelta(days=1)
+
+
+def indicator_name(check, role):
+    return f'{check}_{ROLE_LABELS[role]}_Count'
+
+
+def profiled_columns(columns):
+    """要剖析的 (角色, 列名)：已識別的角色列，順序同 ROLE_LABELS"""
+    return [(role, columns[role]) for role in ROLE_LABELS if columns.get(role)]
+
+
+def applicable_checks(role):
+    return [check for check, (roles, _, _) in QUALITY_CHECKS.items() if roles is None or role in roles]
+
+
+def _parse(role, values):
+    """解析後的值（numpy 陣列）：日期為 datetime64，數值為 float64（無法解析為 NaT/NaN）"""
+    if role == 'date':
+        return parse_dates(values).to_numpy(dtype='datetime64[ns]', na_value=np.datetime64('NaT'))
+    if role in NUMERIC_ROLES:
+        if not pd.api.types.is_numeric_dtype(values):
+            values = pd.to_numeric(values, errors='coerce')
+        return values.to_numpy(dtype=float, na_value=np.nan)
+    return None
+
+
+def indicator_matrix(frame, columns, bounds=None):
+    """指示矩陣：每個 (角色列, 適用的檢查) 一個 int8 列，索引與 frame 相同"""
+    bounds = bounds or date_bounds()
+    bounds = tuple(np.datetime64(bound, 'ns') for bound in bounds)
+    indicators = {}
+    for role, col in profiled_columns(columns):
+        values = frame[col]
+        missing = values.isna().to_numpy(dtype=bool)
+        parsed = _parse(role, values)
+        for check in applicable_checks(role):
+            test = QUALITY_CHECKS[check][1]
+            indicators[indicator_name(check, role)] = test(missing, parsed, bounds).astype(np.int8)
+    return pd.DataFrame(indicators, index=frame.index)
+
+
+def profile(frame, columns, keys=None, bounds=None):
+    """指示矩陣按 keys 分組加總，加上 Total_Count；keys 為空時只有一行（整個分區）
+
+    鍵為空的記錄也形成分組（排在最後），各組加總即為整個分區的計數。
+    """
+    matrix = indicator_matrix(frame, columns, bounds)
+    if not keys:
+        counts = matrix.sum().to_frame().T.astype('int64')
+        counts['Total_Count'] = len(frame)
+        return counts
+    grouped = matrix.groupby([frame[key] for key in keys], observed=True, dropna=False, sort=True)
+    counts = grouped.sum().astype('int64')
+    counts['Total_Count'] = grouped.size()
+    return counts.reset_index()
+
+
+def quality_sql(columns, bounds=None):
+    """與 indicator_matrix 相同的檢查，回傳 [(指示列名稱, SQL 條件)]"""
+    lower, upper = bounds or date_bounds()
+    conditions = []
+    for role, col in profiled_columns(columns):
+        value = '"' + str(col).replace('"', '""') + '"'
+        parsed = {'date': f"TRY_CAST({value} AS TIMESTAMP)"}.get(
+            role, f"TRY_CAST({value} AS DOUBLE)" if role in NUMERIC_ROLES else value)
+        for check in applicable_checks(role):
+            condition = QUALITY_CHECKS[check][2].format(value=value, parsed=parsed, lower=lower, upper=upper)
+            conditions.append((indicator_name(check, role), condition))
+    return conditions
+
+
+def add_missing_proportions(abnormal_by_product):
+    """由缺失計數和 Total_Count 計算各比例（百分比，兩位小數），按 Missing_Total_Count 排序"""
+    if 'Missing_CustomerID_Count' in abnormal_by_product.columns:
+        abnormal_by_product['Missing_CustomerID_Proportion'] = (
+            abnormal_by_product['Missing_CustomerID_Count'] /
+            abnormal_by_product['Total_Count'].replace(0, np.nan) * 100
+        ).fillna(0).round(2)
+
+    if 'Missing_Description_Count' in abnormal_by_product.columns:
+        abnormal_by_product['Missing_Description_Proportion'] = (
+            abnormal_by_product['Missing_Description_Count'] /
+            abnormal_by_product['Total_Count'].replace(0, np.nan) * 100
+        ).fillna(0).round(2)
+
+    abnormal_by_product['Missing_Total_Proportion'] = (
+        abnormal_by_product['Missing_Total_Count'] /
+        abnormal_by_product['Total_Count'].replace(0, np.nan) * 100
+    ).fillna(0).round(2)
+
+    return abnormal_by_product.sort_values('Missing_Total_Count', ascending=False)
+
+
+def abnormal_table(counts, columns):
+    """步驟5.1：Abnormal Order 按 (StockCode, Country) 的分組加總 -> 缺失計數和比例（鍵為空的組合不列出）"""
+    keys = [columns['stockcode'], columns['country']]
+    names = [indicator_name('Missing', role) for role in ABNORMAL_MISSING_ROLES if columns.get(role)]
+    if not names or not all(key in counts.columns for key in keys):
+        return pd.DataFrame()
+    counts = counts[counts[keys].notna().all(axis=1)].reset_index(drop=True)
+    if len(counts) == 0:
+        return pd.DataFrame()
+    abnormal_by_product = counts[keys + names].copy()
+    abnormal_by_product['Missing_Total_Count'] = counts[names].sum(axis=1)
+    abnormal_by_product['Total_Count'] = counts['Total_Count']
+    return add_missing_proportions(abnormal_by_product)
+
+
+def column_report(profiles, columns):
+    """Data quality 工作表：{分區名稱: 分組加總} -> 每個分區、每一列一行的計數和比例"""
+    rows = []
+    for partition, counts in profiles.items():
+        totals = counts[[c for c in counts.columns if str(c).endswith('_Count')]].sum()
+        total_rows = int(totals['Total_Count'])
+        for role, col in profiled_columns(columns):
+            row = {'Partition': partition, 'Column': col, 'Rows': total_rows}
+            for check in QUALITY_CHECKS:
+                name = indicator_name(check, role)
+                # 不適用的檢查為 NaN（工作表中留空）
+                count = totals[name] if name in totals else np.nan
+                row[f'{check}_Count'] = count
+                row[f'{check}_Proportion'] = round(count / total_rows * 100, 2) if total_rows else 0.0
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def quality_tables(profiles, columns):
+    """{'abnormal': Abnormal analysis product, 'columns': Data quality}；profiles 的 Abnormal Order 按 (StockCode, Country) 分組"""
+    return {
+        'abnormal': abnormal_table(profiles['Abnormal Order'], columns),
+        'columns': column_report(profiles, columns),
+    }
+
+
+def profile_partitions(partitions, columns, bounds=None):
+    """三個分區各掃描一次：Abnormal Order 按 (StockCode, Country) 分組，其餘分區只有整體計數"""
+    bounds = bounds or date_bounds()
+    keys = [columns['stockcode'], columns['country']] if columns.get('stockcode') and columns.get('country') else None
+    return {
+        sheet_name: profile(partitions[sheet_name], columns, keys if sheet_name == 'Abnormal Order' else None, bounds)
+        for sheet_name in ('Normal Order', 'return order', 'Abnormal Order')
+    }
@@ -0,0 +1,14 @@
+"""退貨率公式；各維度的 Return_Amount、Return_Count、Revenue、Normal_Count 由訂單立方體（cube.py）投影"""
+import numpy as np
+
+RETURN_RATE_COLUMNS = ['Return_Amount', 'Return_Count', 'Revenue', 'Normal_Count', 'Return_Rate', 'Return_Frequency']
+
+
+def add_return_rates(analysis):
+    """Return_Rate = -Return_Amount / (-Return_Amount + Revenue)，Return_Frequency = Return_Count / (Return_Count + Normal_Count)"""
+    # 注意：Return_Amount 在 Return Order 中是負數，所以 -Return_Amount 是正數
+    analysis['Return_Rate'] = ((-analysis['Return_Amount']) /
+                               ((-analysis['Return_Amount']) + analysis['Revenue']).replace(0, np.nan)).fillna(0)
+    total_count = analysis['Return_Count'] + analysis['Normal_Count']
+    analysis['Return_Frequency'] = (analysis['Return_Count'] / total_count.replace(0, np.nan)).fillna(0)
+    return analysis
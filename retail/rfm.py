@@ -0,0 +1,133 @@
+"""RFM 評分，以及每個月底的滾動 RFM 快照和客戶分類轉移矩陣
+
+快照只排序並累加一次：先匯總到 (客戶, 月份)，每個 Invoice 只計入第一次出現的月份，
+再展開為每個客戶從第一次購買起每個月一行的網格，按客戶累加 Frequency、Monetary，
+最後購買日向前填補。每個月的評分只使用當時已有購買記錄的客戶。
+"""
+import numpy as np
+import pandas as pd
+
+from retail.quantiles import quantile_scores
+from retail.segments import assign_segments
+from retail.timeindex import month_keys, month_labels, parse_dates
+
+RFM_COLUMNS = ['CustomerID', 'Recency', 'Frequency', 'Monetary', 'R_Score', 'F_Score', 'M_Score', 'Total_Score', 'Category']
+NEW_CUSTOMER = 'New'
+
+# (指標, 分數列, 是否反轉)：Recency 天數越少分數越高
+_SCORES = (('Frequency', 'F_Score', False), ('Monetary', 'M_Score', False), ('Recency', 'R_Score', True))
+
+
+def score_rfm(rfm_calc, sketch_k=None):
+    """為含 Recency、Frequency、Monetary 的表加上 R/F/M 分數、Total_Score 和 Category
+
+    回傳 {指標: 分位邊界設定}，可寫入 JSON 並以 QuantileScorer.from_dict 還原。
+    """
+    scorers = {}
+    for metric, score_col, reverse in _SCORES:
+        scores, scorer = quantile_scores(rfm_calc[metric], reverse=reverse, sketch_k=sketch_k)
+        rfm_calc[score_col] = scores
+        scorers[metric] = scorer.to_dict()
+    rfm_calc['Total_Score'] = rfm_calc['R_Score'] + rfm_calc['F_Score'] + rfm_calc['M_Score']
+    # 根據總分分類（規則見 segment_rules.json）
+    rfm_calc['Category'] = assign_segments(rfm_calc, 'rfm')
+    return scorers
+
+
+def _customer_months(normal_order, customerid_col, invoice_col, date_col):
+    """(客戶, 月份) 的新 Invoice 數、金額和最後購買日，以及每個月的最後交易日"""
+    # 日期通常已在步驟6前解析（parse_dates 不會重新解析）
+    dates = parse_dates(normal_order[date_col], date_col)
+    frame = pd.DataFrame({
+        'CustomerID': normal_order[customerid_col].to_numpy(),
+        'Invoice': normal_order[invoice_col].astype(str).to_numpy(),
+        'Date': dates.to_numpy(dtype='datetime64[ns]', na_value=np.datetime64('NaT')),
+        'Total': normal_order['Total'].astype(float).to_numpy(),
+    }).dropna(subset=['CustomerID', 'Date'])
+    frame['YearMonth'] = month_keys(frame['Date'])
+
+    # 每個月的快照日為該月最後一筆交易的日期（最後一個月即步驟9的報告最後日期）
+    as_of = frame.groupby('YearMonth')['Date'].max()
+
+    # Frequency 是不重複 Invoice 數：每個 (客戶, Invoice) 只計入最早的月份
+    first_invoice = frame.groupby(['CustomerID', 'Invoice'])['YearMonth'].min().reset_index()
+    new_invoices = first_invoice.groupby(['CustomerID', 'YearMonth']).size().rename('New_Invoices')
+    activity = frame.groupby(['CustomerID', 'YearMonth']).agg(Monetary=('Total', 'sum'), LastPurchaseDate=('Date', 'max'))
+    activity = activity.join(new_invoices).fillna({'New_Invoices': 0})
+    return activity.reset_index(), as_of
+
+
+def rfm_snapshots(normal_order, customerid_col, invoice_col, date_col, sketch_k=None):
+    """每個月底每個客戶的 Recency、Frequency、Monetary、R/F/M 分數和 Category
+
+    最後一個月的快照與步驟9（以報告最後日期計算）的結果相同。
+    """
+    activity, as_of = _customer_months(normal_order, customerid_col, invoice_col, date_col)
+    if len(activity) == 0:
+        return pd.DataFrame(columns=['YearMonth', 'AsOfDate'] + RFM_COLUMNS)
+
+    months = as_of.index
+    month_codes = pd.Index(months).get_indexer(activity['YearMonth'])
+    customers, customer_codes = np.unique(activity['CustomerID'].to_numpy(), return_inverse=True)
+
+    # 網格：每個客戶從第一次購買的月份到最後一個月各一行，按 (客戶, 月份) 排序
+    first_month = np.full(len(customers), len(months))
+    np.minimum.at(first_month, customer_codes, month_codes)
+    span = len(months) - first_month
+    grid_customer = np.repeat(np.arange(len(customers)), span)
+    offsets = np.arange(len(grid_customer)) - np.repeat(np.cumsum(span) - span, span)
+    grid_month = np.repeat(first_month, span) + offsets
+
+    # 有購買的 (客戶, 月份) 對應到網格的位置
+    grid_start = np.cumsum(span) - span
+    positions = grid_start[customer_codes] + (month_codes - first_month[customer_codes])
+    new_invoices = np.zeros(len(grid_customer))
+    monetary = np.zeros(len(grid_customer))
+    new_invoices[positions] = activity['New_Invoices'].to_numpy()
+    monetary[positions] = activity['Monetary'].to_numpy()
+    last_purchase = pd.Series(pd.NaT, index=range(len(grid_customer)), dtype='datetime64[ns]')
+    last_purchase.iloc[positions] = activity['LastPurchaseDate'].to_numpy()
+
+    snapshots = pd.DataFrame({'CustomerID': customers[grid_customer], 'YearMonth': months[grid_month]})
+    group = pd.Series(grid_customer)
+    snapshots['Frequency'] = pd.Series(new_invoices).groupby(group).cumsum().astype('int64').to_numpy()
+    snapshots['Monetary'] = pd.Series(monetary).groupby(group).cumsum().to_numpy()
+    snapshots['LastPurchaseDate'] = last_purchase.groupby(group).ffill().to_numpy()
+    snapshots['AsOfDate'] = as_of.to_numpy()[grid_month]
+    snapshots['Recency'] = (snapshots['AsOfDate'] - snapshots['LastPurchaseDate']).dt.days
+
+    # 每個月只對當時的客戶評分；同一月內按 CustomerID 排序，與步驟9的排名順序一致
+    snapshots = snapshots.sort_values(['YearMonth', 'CustomerID'], kind='stable').reset_index(drop=True)
+    scored = []
+    for _, month_frame in snapshots.groupby('YearMonth', sort=True):
+        month_frame = month_frame.copy()
+        score_rfm(month_frame, sketch_k)
+        scored.append(month_frame)
+    snapshots = pd.concat(scored, ignore_index=True)
+    snapshots['YearMonth'] = month_labels(snapshots['YearMonth'].to_numpy())
+    snapshots['Monetary'] = snapshots['Monetary'].round(2)
+    return snapshots[['YearMonth', 'AsOfDate'] + RFM_COLUMNS]
+
+
+def segment_transitions(snapshots):
+    """相鄰月份之間的分類轉移：回傳 (按月的長表, 全期間加總的 From x To 矩陣)
+
+    當月第一次購買的客戶 From 為 New。
+    """
+    if len(snapshots) == 0:
+        return pd.DataFrame(columns=['YearMonth', 'From', 'To', 'Customers']), pd.DataFrame()
+    ordered = snapshots.sort_values(['CustomerID', 'YearMonth'], kind='stable')
+    previous = ordered.groupby('CustomerID')['Category'].shift(1)
+    first_month = ordered['YearMonth'] == ordered['YearMonth'].min()
+    moves = pd.DataFrame({
+        'YearMonth': ordered['YearMonth'],
+        'From': previous.fillna(NEW_CUSTOMER),
+        'To': ordered['Category'],
+    })[~first_month]
+
+    by_month = moves.groupby(['YearMonth', 'From', 'To']).size().rename('Customers').reset_index()
+    categories = sorted((set(moves['From']) | set(moves['To'])) - {NEW_CUSTOMER})
+    matrix = pd.crosstab(moves['From'], moves['To'])
+    matrix = matrix.reindex(index=[NEW_CUSTOMER] + categories, columns=categories, fill_value=0)
+    matrix = matrix.rename_axis(index='From \\ To', columns=None).reset_index()
+    return by_month, matrix
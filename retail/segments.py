@@ -0,0 +1,57 @@
+"""分類規則引擎：segment_rules.json 中宣告的規則編譯為向量化遮罩，以 np.select 一次完成分類
+
+規則依序比對，第一個符合的規則決定標籤（與 if/elif 相同），都不符合時使用 default。
+每條規則的 when 為 {列名: {運算子: 值}}，同一規則內的所有條件需同時成立。
+支援的運算子：<、<=、>、>=、==、!=、between（[下限, 上限]，含兩端）、in（值列表）。
+"""
+import json
+import os
+
+import numpy as np
+
+SEGMENT_RULES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                  'segment_rules.json')
+
+_OPERATORS = {
+    '<': lambda column, value: column < value,
+    '<=': lambda column, value: column <= value,
+    '>': lambda column, value: column > value,
+    '>=': lambda column, value: column >= value,
+    '==': lambda column, value: column == value,
+    '!=': lambda column, value: column != value,
+    'between': lambda column, value: (column >= value[0]) & (column <= value[1]),
+    'in': lambda column, value: column.isin(value),
+}
+
+
+def load_rules(path=SEGMENT_RULES_PATH):
+    """讀取分類規則設定，並檢查運算子是否支援"""
+    with open(path, 'r', encoding='utf-8') as f:
+        rulesets = json.load(f)
+    for name, ruleset in rulesets.items():
+        for rule in ruleset['rules']:
+            for column, conditions in rule['when'].items():
+                unknown = set(conditions) - set(_OPERATORS)
+                if unknown:
+                    raise ValueError(f"分類規則 {name}/{rule['label']} 的 {column} 使用了不支援的運算子: {sorted(unknown)}")
+    return rulesets
+
+
+def _rule_mask(df, when):
+    mask = np.ones(len(df), dtype=bool)
+    for column, conditions in when.items():
+        values = df[column]
+        for operator, value in conditions.items():
+            # 缺失值比較結果視為不符合
+            mask &= _OPERATORS[operator](values, value).fillna(False).to_numpy(dtype=bool)
+    return mask
+
+
+def assign_segments(df, ruleset):
+    """依規則為每一行指定標籤，回傳與 df 對齊的標籤陣列"""
+    if isinstance(ruleset, str):
+        ruleset = load_rules()[ruleset]
+    rules = ruleset['rules']
+    conditions = [_rule_mask(df, rule['when']) for rule in rules]
+    labels = [rule['label'] for rule in rules]
+    return np.select(conditions, labels, default=ruleset.get('default', 'Unknown')).astype(object)
@@ -0,0 +1,321 @@
+"""常駐的 KPI 查詢服務：清理後的分區只載入一次，之後任意篩選的查詢都在記憶體中的索引上完成
+
+KpiIndex 將 Normal Order 和 Return Order 匯總到 (月份, Country, StockCode, CustomerID) 最細粒度，
+按月份排序（月份範圍是一段連續的行），並為 Country、StockCode、CustomerID 各建一個倒排索引
+（鍵 -> 匯總行位置）。查詢時從最小的候選集合開始篩選，再以 bincount 加總，
+指標的公式與 execute_prompt.py（月度 KPI、AOV/ARPU）和 execute_return_abnormal.py（退貨率）相同：
+
+    GET /kpi?country=Germany&quarter=2011Q3&metrics=ARPU,AOV
+    GET /kpi?sku=85123A&from=2011-06&metrics=Return_Rate
+    GET /kpi?country=Germany,France&group_by=month
+    GET /dimensions
+    GET /health
+
+篩選值可以用逗號分隔多個；group_by 為 month、country、sku 或 customer。
+"""
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from retail.ingest import COLUMN_KEYWORDS, find_column
+from retail.returns import add_return_rates
+from retail.timeindex import MONTH_COLUMN, month_key, month_keys, month_labels
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+DIMENSIONS = ('month', 'country', 'sku', 'customer')
+# 匯總行上的加總量：*_Orders 與月度 KPI 相同（Total 非空的行數），*_Count 與退貨率相同（Quantity 非空的行數），
+# Normal_Rows 標記有 Normal Order 記錄的組合（Customer 只計 Normal Order 的客戶）
+MEASURES = ('Revenue', 'Normal_Orders', 'Normal_Count', 'Normal_Rows', 'Return', 'Return_Orders', 'Return_Count')
+KPI_COLUMNS = ['Gross_Revenue', 'Return', 'Revenue', 'Gross_Orders', 'Return_Orders', 'Normal_Orders',
+               'Customer', 'AOV', 'ARPU', 'Return_Rate', 'Return_Frequency']
+
+
+def _labels(values):
+    """維度值的文字標籤：整數值的浮點數（例如 Customer ID 12345.0）寫成 '12345'"""
+    labels = []
+    for value in values:
+        if isinstance(value, (float, np.floating)) and float(value).is_integer():
+            labels.append(str(int(value)))
+        else:
+            labels.append(str(value))
+    return labels
+
+
+class KpiIndex:
+    """Normal Order 和 Return Order 的預匯總索引；建立後唯讀，可在多個執行緒中同時查詢"""
+
+    def __init__(self, normal_order, return_order):
+        normal_order = normal_order.rename(columns=lambda c: str(c).strip())
+        return_order = return_order.rename(columns=lambda c: str(c).strip())
+        self.columns = {role: find_column(normal_order, COLUMN_KEYWORDS[role])
+                        for role in ('date', 'country', 'stockcode', 'customerid', 'quantity')}
+        if not self.columns['date'] or not self.columns['quantity']:
+            raise ValueError("交接資料中找不到日期或 Quantity 列，請先執行 execute_prompt.py")
+
+        parts = []
+        for frame, is_return in ((normal_order, False), (return_order, True)):
+            if len(frame) == 0:
+                continue
+            amount = frame['Total'].fillna(0).to_numpy(dtype=float)
+            orders = frame['Total'].notna().to_numpy().astype('int64')
+            counted = frame[self.columns['quantity']].notna().to_numpy().astype('int64')
+            zeros = np.zeros(len(frame), dtype='int64')
+            part = pd.DataFrame({
+                'month': self._months(frame),
+                'country': self._dimension(frame, 'country'),
+                'sku': self._dimension(frame, 'stockcode'),
+                'customer': self._dimension(frame, 'customerid'),
+                'Revenue': 0.0 if is_return else amount,
+                'Normal_Orders': zeros if is_return else orders,
+                'Normal_Count': zeros if is_return else counted,
+                'Normal_Rows': zeros if is_return else np.ones(len(frame), dtype='int64'),
+                'Return': amount if is_return else 0.0,
+                'Return_Orders': orders if is_return else zeros,
+                'Return_Count': counted if is_return else zeros,
+            })
+            parts.append(part)
+        if parts:
+            stacked = pd.concat(parts, ignore_index=True)
+        else:
+            stacked = pd.DataFrame({dim: pd.Series(dtype=object) for dim in DIMENSIONS})
+            for measure in MEASURES:
+                stacked[measure] = 0
+
+        # 文字維度編碼為整數，缺失值為 -1（不屬於任何篩選值，也不計入不重複客戶）
+        self.labels = {}
+        codes = {'month': stacked['month'].to_numpy(dtype=np.int32)}
+        for dim in ('country', 'sku', 'customer'):
+            dim_codes, uniques = pd.factorize(stacked[dim], sort=True)
+            codes[dim] = dim_codes.astype(np.int32)
+            self.labels[dim] = np.array(_labels(uniques), dtype=object)
+        base = pd.DataFrame(codes).assign(**{m: stacked[m].to_numpy() for m in MEASURES})
+        base = base.groupby(list(DIMENSIONS), sort=True).sum().reset_index()
+
+        # 按月份排序：月份範圍以二分搜尋取得連續的一段
+        self.codes = {dim: base[dim].to_numpy() for dim in DIMENSIONS}
+        self.measures = {m: base[m].to_numpy() for m in MEASURES}
+        self.lookup = {dim: {label: code for code, label in enumerate(labels)} for dim, labels in self.labels.items()}
+        # 倒排索引：order 按鍵排序的行位置，starts[code]:starts[code + 1] 為該鍵的行
+        self.inverted = {}
+        for dim in ('country', 'sku', 'customer'):
+            order = np.argsort(self.codes[dim], kind='stable')
+            starts = np.searchsorted(self.codes[dim][order], np.arange(len(self.labels[dim]) + 1))
+            self.inverted[dim] = (order, starts)
+        self.source_rows = len(normal_order) + len(return_order)
+
+    def _months(self, frame):
+        if MONTH_COLUMN in frame.columns and pd.api.types.is_integer_dtype(frame[MONTH_COLUMN]):
+            return frame[MONTH_COLUMN].to_numpy(dtype=np.int32)
+        # 從 彙總表.xlsx 載入時沒有月份鍵
+        return month_keys(frame[self.columns['date']])
+
+    def _dimension(self, frame, role):
+        column = self.columns[role]
+        if not column:
+            return np.full(len(frame), None, dtype=object)
+        return frame[column].to_numpy(dtype=object, na_value=None)
+
+    def __len__(self):
+        return len(self.codes['month'])
+
+    def dimensions(self):
+        """各維度的取值（月份為標籤）"""
+        months = np.unique(self.codes['month'])
+        return {
+            'month': list(month_labels(months[months >= 0])),
+            'country': list(self.labels['country']),
+            'sku_count': len(self.labels['sku']),
+            'customer_count': len(self.labels['customer']),
+        }
+
+    def select(self, filters):
+        """符合篩選條件的匯總行位置；filters 為 {維度: [標籤]}，月份另以 'from'/'to' 標籤指定範圍"""
+        months = self.codes['month']
+        lo = 0 if filters.get('from') is None else int(np.searchsorted(months, month_key(filters['from'])))
+        hi = len(months) if filters.get('to') is None else int(np.searchsorted(months, month_key(filters['to']), side='right'))
+        if filters.get('from') is not None or filters.get('to') is not None:
+            # 日期缺失的行（月份鍵 -1）不在任何範圍內
+            lo = max(lo, int(np.searchsorted(months, 0)))
+
+        wanted = {}
+        for dim in ('country', 'sku', 'customer'):
+            if filters.get(dim) is not None:
+                wanted[dim] = np.array([self.lookup[dim][label] for label in filters[dim] if label in self.lookup[dim]],
+                                       dtype=np.int32)
+        if not wanted:
+            return np.arange(lo, hi)
+
+        # 從候選行最少的維度開始，其他維度以成員檢查篩選
+        def candidates(dim):
+            order, starts = self.inverted[dim]
+            return int(np.sum(starts[wanted[dim] + 1] - starts[wanted[dim]]))
+        first, *rest = sorted(wanted, key=candidates)
+        order, starts = self.inverted[first]
+        rows = np.concatenate([order[starts[c]:starts[c + 1]] for c in wanted[first]] or [np.array([], dtype=np.int64)])
+        rows = np.sort(rows)
+        rows = rows[(rows >= lo) & (rows < hi)]
+        for dim in rest:
+            rows = rows[np.isin(self.codes[dim][rows], wanted[dim])]
+        return rows
+
+    def query(self, filters=None, group_by=None, metrics=None):
+        """計算篩選後的 KPI；group_by 指定時每個維度值一行。回傳 DataFrame"""
+        filters = filters or {}
+        unknown = sorted(set(metrics or []) - set(KPI_COLUMNS))
+        if unknown:
+            raise ValueError(f"未知的指標 {unknown}，可用的指標: {', '.join(KPI_COLUMNS)}")
+        rows = self.select(filters)
+        if group_by is None:
+            groups = np.zeros(len(rows), dtype=np.int64)
+            keys = np.array([0])
+        else:
+            if group_by not in DIMENSIONS:
+                raise ValueError(f"group_by 必須是 {', '.join(DIMENSIONS)} 之一")
+            keys, groups = np.unique(self.codes[group_by][rows], return_inverse=True)
+            groups = groups.reshape(-1)
+
+        sums = {m: np.bincount(groups, weights=self.measures[m][rows], minlength=len(keys)) for m in MEASURES}
+        # 不重複客戶：只計有 Normal Order 記錄且 CustomerID 非空的 (組, 客戶) 組合
+        customers = self.codes['customer'][rows]
+        counted = (self.measures['Normal_Rows'][rows] > 0) & (customers >= 0)
+        pairs = np.unique(groups[counted].astype(np.int64) * (len(self.labels['customer']) + 1) + customers[counted])
+        sums['Customer'] = np.bincount(pairs // (len(self.labels['customer']) + 1), minlength=len(keys))
+
+        result = pd.DataFrame({
+            'Return_Amount': sums['Return'],
+            'Return_Count': sums['Return_Count'].astype('int64'),
+            'Revenue': sums['Revenue'],
+            'Normal_Count': sums['Normal_Count'].astype('int64'),
+        })
+        result = add_return_rates(result)
+        result['Return'] = result['Return_Amount']
+        result['Normal_Orders'] = sums['Normal_Orders'].astype('int64')
+        result['Return_Orders'] = sums['Return_Orders'].astype('int64')
+        result['Customer'] = sums['Customer'].astype('int64')
+        # Gross Revenue = -Return + Revenue, Gross Orders = -Return Orders + Normal Orders（與月度 KPI 相同）
+        result['Gross_Revenue'] = -result['Return'] + result['Revenue']
+        result['Gross_Orders'] = -result['Return_Orders'] + result['Normal_Orders']
+        # AOV = Revenue / Normal Orders, ARPU = Revenue / Customer（基於四捨五入後的 Revenue）
+        revenue = result['Revenue'].round(2)
+        result['AOV'] = (revenue / result['Normal_Orders'].replace(0, np.nan)).round(2)
+        result['ARPU'] = (revenue / result['Customer'].replace(0, np.nan)).round(2)
+        for col in ['Gross_Revenue', 'Revenue', 'Return']:
+            result[col] = result[col].round(2)
+
+        result = result[KPI_COLUMNS if not metrics else [m for m in KPI_COLUMNS if m in metrics]]
+        if group_by is not None:
+            labels = month_labels(keys) if group_by == 'month' else [
+                None if key < 0 else self.labels[group_by][key] for key in keys]
+            result.insert(0, group_by, labels)
+        return result
+
+
+def load_index():
+    """由 execute_prompt.py 的輸出建立索引：優先 Arrow 交接檔，其次分區資料集，最後 彙總表.xlsx"""
+    from retail.dataset import DATASET_DIR, read_dataset, read_dataset_manifest
+    from retail.handoff import HANDOFF_DIR, open_partitions
+
+    partitions = open_partitions()
+    if partitions is not None:
+        return KpiIndex(partitions['Normal Order'], partitions['return order']), f'{HANDOFF_DIR}/'
+    if read_dataset_manifest() is not None:
+        normal_order = read_dataset('Normal Order')[0]
+        return_order = read_dataset('return order')[0]
+        return KpiIndex(normal_order, return_order), f'{DATASET_DIR}/'
+    try:
+        normal_order = pd.read_excel('彙總表.xlsx', sheet_name='Normal Order')
+        return_order = pd.read_excel('彙總表.xlsx', sheet_name='return order')
+    except Exception as e:
+        raise FileNotFoundError(f"無法讀取交接檔或 彙總表.xlsx，請先運行 execute_prompt.py（{e}）") from e
+    return KpiIndex(normal_order, return_order), '彙總表.xlsx'
+
+
+def parse_query(params):
+    """將 URL 查詢參數（parse_qs 的結果）轉為 (filters, group_by, metrics)"""
+    def values(name):
+        items = [v.strip() for raw in params.get(name, []) for v in raw.split(',')]
+        return [v for v in items if v] or None
+
+    filters = {'country': values('country'), 'sku': values('sku'), 'customer': values('customer')}
+    start, end = (values('from') or [None])[0], (values('to') or [None])[0]
+    quarter = (values('quarter') or [None])[0]
+    if quarter is not None:
+        # 2011Q3 -> 2011-07 ~ 2011-09
+        try:
+            year, q = quarter.upper().split('Q')
+            year, q = int(year), int(q)
+        except ValueError:
+            raise ValueError(f"quarter 格式應為 YYYYQn，例如 2011Q3: {quarter}")
+        if not 1 <= q <= 4:
+            raise ValueError(f"quarter 格式應為 YYYYQn，例如 2011Q3: {quarter}")
+        start, end = f'{year:04d}-{3 * q - 2:02d}', f'{year:04d}-{3 * q:02d}'
+    for label in (start, end):
+        if label is not None:
+            try:
+                month_key(label)
+            except ValueError:
+                raise ValueError(f"月份格式應為 YYYY-MM: {label}")
+    filters['from'], filters['to'] = start, end
+    group_by = (values('group_by') or [None])[0]
+    return filters, group_by, values('metrics')
+
+
+def _json_value(value):
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (np.floating, float)):
+        # 加 0.0 使 -0.0 輸出為 0.0
+        return None if np.isnan(value) else float(value) + 0.0
+    return value
+
+
+def make_handler(index, source):
+    """建立綁定 index 的請求處理類別"""
+
+    class KpiRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            started = time.perf_counter()
+            try:
+                if url.path == '/health':
+                    body = {'status': 'ok', 'source': source, 'rows': index.source_rows, 'index_rows': len(index)}
+                elif url.path == '/dimensions':
+                    body = index.dimensions()
+                elif url.path == '/kpi':
+                    filters, group_by, metrics = parse_query(parse_qs(url.query))
+                    table = index.query(filters, group_by, metrics)
+                    records = [{k: _json_value(v) for k, v in row.items()} for row in table.to_dict('records')]
+                    body = {'filters': {k: v for k, v in filters.items() if v is not None}, 'group_by': group_by,
+                            'rows': records if group_by else None, 'kpi': None if group_by else records[0]}
+                else:
+                    self._send(404, {'error': f'未知的路徑 {url.path}，可用: /kpi, /dimensions, /health'})
+                    return
+            except ValueError as e:
+                self._send(400, {'error': str(e)})
+                return
+            body['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 3)
+            self._send(200, body)
+
+        def _send(self, status, body):
+            payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            print(f"{self.address_string()} - {format % args}")
+
+    return KpiRequestHandler
+
+
+def make_server(index, source, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """建立 HTTP 伺服器（port 為 0 時由系統分配），呼叫端負責 serve_forever()"""
+    return ThreadingHTTPServer((host, port), make_handler(index, source))
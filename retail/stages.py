@@ -0,0 +1,108 @@
+"""互不依賴的分析階段，可在進程池中並行執行
+
+每個階段是 stage(partitions, columns)：partitions 是 {工作表名稱: DataFrame}，columns 是
+{角色: 列名}（角色同 COLUMN_KEYWORDS）。並行時分區不經 pickle 傳給子進程，而是由子進程以
+memory map 開啟 Arrow 交接檔，只有匯總後的小表會傳回主進程。
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from retail.cube import OrderCube
+from retail.handoff import HANDOFF_DIR, open_partitions, read_manifest
+from retail.matching import latency_tables, match_returns
+from retail.metrics import customer_totals
+from retail.quality import profile_partitions, quality_tables
+
+
+def cube_stage(partitions, columns):
+    """步驟6、8：Normal Order 和 Return Order 只掃描一次，建立訂單立方體（月度和產品匯總都是它的投影）"""
+    return OrderCube.from_frames(partitions['Normal Order'], partitions['return order'], columns)
+
+
+def customer_stage(partitions, columns):
+    """步驟9：按客戶計算最後購買日、唯一 Invoice 數和總金額；缺少 Invoice 列時為 None"""
+    return customer_totals(partitions['Normal Order'], columns)
+
+
+def return_rate_stage(partitions, columns):
+    """步驟2-4：由訂單立方體投影，回傳 {維度列: 含退貨率的投影}"""
+    return cube_stage(partitions, columns).return_rates()
+
+
+def return_latency_stage(partitions, columns):
+    """步驟4.2：每筆退貨以 as-of join 配對最近的原始銷售，回傳配對明細和按 StockCode、Country 的延遲分佈"""
+    return latency_tables(match_returns(partitions['Normal Order'], partitions['return order'], columns))
+
+
+def quality_stage(partitions, columns):
+    """步驟5.1：三個分區的資料品質剖析（每個分區的指示矩陣只掃描一次）
+
+    回傳 {'abnormal': 按 StockCode 和 Country 的缺失計數和比例, 'columns': 每個分區、每一列的品質計數}
+    """
+    return quality_tables(profile_partitions(partitions, columns), columns)
+
+
+PROMPT_STAGES = {
+    'cube': cube_stage,
+    'customers': customer_stage,
+}
+
+
+RETURN_ABNORMAL_STAGES = {
+    'return_rates': return_rate_stage,
+    'return_latency': return_latency_stage,
+    'quality': quality_stage,
+}
+
+
+def _default_dtypes(result):
+    """子進程的結果來自 Arrow 型別的分區，轉回 pandas 預設型別，與單進程執行的結果一致
+
+    pandas 的 metadata 記錄了原本的 ArrowDtype，必須忽略，否則 to_pandas() 又還原為 double[pyarrow] 等型別
+    （在 ArrowDtype 上 round(2) 的結果與 numpy 不同）。
+    """
+    if isinstance(result, pd.DataFrame):
+        import pyarrow as pa
+
+        return pa.Table.from_pandas(result, preserve_index=False).to_pandas(ignore_metadata=True)
+    if isinstance(result, OrderCube):
+        return OrderCube(_default_dtypes(result.cells), _default_dtypes(result.customers), result.columns)
+    if isinstance(result, dict):
+        return {key: _default_dtypes(value) for key, value in result.items()}
+    if isinstance(result, tuple):
+        return tuple(_default_dtypes(value) for value in result)
+    return result
+
+
+def _run_from_handoff(stage, columns, directory):
+    partitions = open_partitions(directory)
+    return _default_dtypes(stage(partitions, columns))
+
+
+def process_context():
+    # 兩個腳本沒有 __main__ 保護，spawn/forkserver 會在子進程重新執行整個腳本，只能使用 fork
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context('fork')
+
+
+def run_stages(stages, partitions, columns, workers=1, directory=HANDOFF_DIR):
+    """執行互不依賴的階段，回傳 {階段名稱: 結果}
+
+    workers > 1 時每個階段在獨立進程中執行，分區從 directory 的交接檔以 memory map 開啟；
+    交接檔不存在或平台不支援 fork 時改為在目前進程依序執行。
+    """
+    if workers > 1 and len(stages) > 1:
+        context = process_context()
+        if context is None:
+            print("警告: 此平台不支援 fork，改為單進程執行")
+        elif read_manifest(directory) is None:
+            print(f"警告: 找不到交接檔 {directory}/，改為單進程執行")
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(stages)), mp_context=context) as pool:
+                futures = {name: pool.submit(_run_from_handoff, stage, columns, directory)
+                           for name, stage in stages.items()}
+                return {name: future.result() for name, future in futures.items()}
+    return {name: stage(partitions, columns) for name, stage in stages.items()}
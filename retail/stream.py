@@ -0,0 +1,255 @@
+"""串流模式：分塊讀取原始資料，逐塊分類並累加匯總，記憶體只與分組數量有關"""
+import os
+
+import pandas as pd
+
+from retail.cube import MONTHLY_COLUMNS, OrderCube
+from retail.hll import GroupedHLL
+from retail.ingest import as_text, cache_covers, cache_paths, check_cache
+from retail.timeindex import add_time_index
+from retail.topk import SpaceSaving
+
+DEFAULT_CHUNK_ROWS = 100_000
+
+
+def _iter_excel_chunks(source_path, chunk_rows):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(source_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [str(c).strip() if c is not None else '' for c in next(rows, ())]
+        buffer = []
+        emitted = False
+        for row in rows:
+            buffer.append(row[:len(header)])
+            if len(buffer) >= chunk_rows:
+                yield pd.DataFrame(buffer, columns=header)
+                buffer = []
+                emitted = True
+        if buffer or not emitted:
+            yield pd.DataFrame(buffer, columns=header)
+    finally:
+        workbook.close()
+
+
+def _iter_arrow_chunks(arrow_path, columns=None):
+    import pyarrow as pa
+
+    reader = pa.ipc.open_file(pa.memory_map(arrow_path, 'r'))
+    if reader.num_record_batches == 0:
+        empty = reader.schema.empty_table()
+        yield (empty if columns is None else empty.select(columns)).to_pandas()
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        yield (batch if columns is None else batch.select(columns)).to_pandas()
+
+
+def _iter_parquet_chunks(parquet_path, chunk_rows, columns=None):
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(parquet_path)
+    emitted = False
+    for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns):
+        emitted = True
+        yield batch.to_pandas()
+    if not emitted:
+        empty = parquet_file.schema_arrow.empty_table()
+        yield (empty if columns is None else empty.select(columns)).to_pandas()
+
+
+def iter_source_chunks(source_path, chunk_rows=DEFAULT_CHUNK_ROWS, use_cache=True, columns=None):
+    """依檔案類型分塊讀取原始資料，至少產出一個（可能為空的）分塊；columns 為要讀取的原始列名（None 為全部）"""
+    extension = os.path.splitext(source_path)[1].lower()
+    if extension == '.csv':
+        chunks = pd.read_csv(source_path, chunksize=chunk_rows, usecols=columns)
+    elif extension == '.parquet':
+        chunks = _iter_parquet_chunks(source_path, chunk_rows, columns)
+    elif extension in ('.feather', '.arrow'):
+        chunks = _iter_arrow_chunks(source_path, columns)
+    elif use_cache and cache_covers(check_cache(source_path), columns):
+        print(f"從快取分塊載入 {os.path.basename(cache_paths(source_path)[0])}...")
+        chunks = _iter_arrow_chunks(cache_paths(source_path)[0], columns)
+    else:
+        print(f"正在分塊讀取 {os.path.basename(source_path)}（openpyxl read-only）...")
+        # openpyxl 逐列讀取所有儲存格，投影在組成分塊後進行
+        wanted = None if columns is None else {str(c).strip() for c in columns}
+        chunks = (chunk if wanted is None else chunk[[c for c in chunk.columns if c in wanted]]
+                  for chunk in _iter_excel_chunks(source_path, chunk_rows))
+
+    for chunk in chunks:
+        chunk.columns = [str(c).strip() for c in chunk.columns]
+        yield chunk
+
+
+def _fold_sum(acc, part):
+    """合併兩個以相同索引分組的加總結果"""
+    if acc is None:
+        return part
+    return acc.add(part, fill_value=0)
+
+
+def _fold_sketch(acc, keys, values, precision):
+    """以 HyperLogLog 累積每個鍵的不重複值，不保留原始鍵組合"""
+    sketch = GroupedHLL.from_values(keys, values, precision)
+    return sketch if acc is None else acc.merge(sketch)
+
+
+class StreamingAggregator:
+    """逐塊分類為 Abnormal/Return/Normal，累加步驟5的計數、訂單立方體（步驟6、8）和步驟9的客戶匯總
+
+    precision 不為 None 時，立方體不保留客戶組合，每月客戶數和各國客戶數以 HyperLogLog 累積，
+    記憶體與不重複客戶數量無關（SKU 數由立方體的格建立 HyperLogLog）。
+    top_capacity 不為 None 時，SKU 的 Revenue 以 Space-Saving 只追蹤 top_capacity 個 SKU。
+    """
+
+    def __init__(self, quantity_col, price_col, customerid_col, description_col, date_col,
+                 stockcode_col=None, country_col=None, invoice_col=None, precision=None, top_capacity=None):
+        self.quantity_col = quantity_col
+        self.price_col = price_col
+        self.customerid_col = customerid_col
+        self.description_col = description_col
+        self.date_col = date_col
+        self.stockcode_col = stockcode_col
+        self.country_col = country_col
+        self.invoice_col = invoice_col
+        self.precision = precision
+        self.top_capacity = top_capacity
+        self.columns = {'quantity': quantity_col, 'customerid': customerid_col, 'date': date_col,
+                        'stockcode': stockcode_col, 'country': country_col}
+
+        self.counts = {'Abnormal Order': 0, 'Normal Order': 0, 'Return Order': 0}
+        self.totals = {'Abnormal Order': 0.0, 'Normal Order': 0.0, 'Return Order': 0.0}
+        self.cube = None
+        self._monthly_customers = {'normal': None, 'return': None}
+        self._sku_top = None
+        self._country_customers = None
+        self._customer_sums = None
+        self._customer_last = None
+        self._invoice_pairs = set()
+
+    def update(self, chunk):
+        """處理一個分塊，回傳 (abnormal, return, normal) 三個分類結果"""
+        chunk = chunk.copy()
+        # 文字列統一轉為字串，避免各分塊推斷出不同型別（例如 StockCode 有時全是數字）
+        for col in (self.stockcode_col, self.invoice_col, self.description_col, self.country_col):
+            if col and col in chunk.columns:
+                chunk[col] = as_text(chunk[col])
+        # 數值列統一為浮點數，避免各分塊推斷出 int/float 不同型別
+        for col in (self.price_col, self.customerid_col):
+            if pd.api.types.is_integer_dtype(chunk[col]):
+                chunk[col] = chunk[col].astype('float64')
+        chunk['Total'] = chunk[self.quantity_col] * chunk[self.price_col]
+
+        missing_mask = chunk[self.customerid_col].isna() | chunk[self.description_col].isna()
+        abnormal = chunk[missing_mask]
+        rest = chunk[~missing_mask]
+        return_mask = rest[self.quantity_col] < 0
+        returned = rest[return_mask].copy()
+        normal = rest[~return_mask].copy()
+
+        for name, part in (('Abnormal Order', abnormal), ('Normal Order', normal), ('Return Order', returned)):
+            self.counts[name] += len(part)
+            self.totals[name] += part['Total'].sum() if len(part) > 0 else 0
+
+        # 與完整模式相同：月度及產品 KPI 只使用日期可解析的資料
+        normal = self._with_year_month(normal)
+        returned = self._with_year_month(returned)
+        self._update_cube(normal, returned)
+        self._update_customers(normal)
+        return abnormal, returned, normal
+
+    def _with_year_month(self, part):
+        # 各分塊沿用第一塊推斷出的日期格式，YearMonth 為整數月份鍵
+        return add_time_index(part, self.date_col)
+
+    def _update_cube(self, normal, returned):
+        if len(normal) == 0 and len(returned) == 0:
+            return
+        cube = OrderCube.from_frames(normal, returned, self.columns, with_customers=self.precision is None)
+        self.cube = cube if self.cube is None else self.cube.merge(cube)
+        if self.precision is not None:
+            for kind, part in (('normal', normal), ('return', returned)):
+                if len(part) > 0:
+                    self._monthly_customers[kind] = _fold_sketch(
+                        self._monthly_customers[kind], part['YearMonth'], part[self.customerid_col], self.precision)
+            if self.country_col and len(normal) > 0:
+                self._country_customers = _fold_sketch(self._country_customers, normal[self.country_col],
+                                                       normal[self.customerid_col], self.precision)
+        if self.stockcode_col and self.top_capacity is not None and len(normal) > 0:
+            top = SpaceSaving.from_frame(normal, self.stockcode_col, 'Total', self.top_capacity,
+                                         extras=[self.quantity_col])
+            self._sku_top = top if self._sku_top is None else self._sku_top.merge(top)
+
+    def _update_customers(self, normal):
+        if len(normal) == 0 or not self.invoice_col:
+            return
+        grouped = normal.groupby(self.customerid_col)
+        self._customer_sums = _fold_sum(self._customer_sums, grouped['Total'].sum())
+        last = grouped[self.date_col].max()
+        if self._customer_last is None:
+            self._customer_last = last
+        else:
+            self._customer_last = pd.concat([self._customer_last, last]).groupby(level=0).max()
+        self._update_invoices(normal)
+
+    def _update_invoices(self, normal):
+        """記錄出現過的 (客戶, Invoice) 組合，Frequency 在 customer_totals 時由組合計數
+
+        同一張 Invoice 的交易行不相鄰（例如來源按其他列排序）或跨越分塊時都只計一次，與完整模式相同；
+        記憶體與不重複的 Invoice 數成正比，與交易行數無關。
+        """
+        pairs = normal[[self.customerid_col, self.invoice_col]].dropna().drop_duplicates()
+        self._invoice_pairs.update(zip(pairs[self.customerid_col], pairs[self.invoice_col]))
+
+    def monthly(self, kind):
+        """回傳與 groupby('YearMonth') 相同欄位的月度匯總（YearMonth 為字串）"""
+        if self.cube is None:
+            return pd.DataFrame(columns=['YearMonth', *MONTHLY_COLUMNS[kind]])
+        return self.cube.monthly(kind, self.precision, self._monthly_customers[kind])
+
+    def monthly_customers(self, kind):
+        """每月不重複的 (YearMonth, 客戶) 組合；HyperLogLog 模式不保留組合，回傳 None"""
+        if self.precision is not None:
+            return None
+        if self.cube is None:
+            return pd.DataFrame(columns=['YearMonth', self.customerid_col])
+        return self.cube.monthly_customers(kind)
+
+    def sku_totals(self):
+        """每個 SKU 的 Revenue 和 Quantity 加總（與 groupby(stockcode) 相同）
+
+        Space-Saving 模式只有追蹤中的 SKU，Revenue 為上限並附 Revenue_Error；
+        Quantity 只包含開始追蹤之後的分塊。
+        """
+        if self.top_capacity is not None:
+            if self._sku_top is None:
+                return pd.DataFrame(columns=['SKU', 'Revenue', 'Quantity'])
+            result = self._sku_top.top(key_name='SKU', weight_name='Revenue')
+            return result.rename(columns={self.quantity_col: 'Quantity'})
+        if self.cube is None:
+            return pd.DataFrame(columns=['SKU', 'Revenue', 'Quantity'])
+        return self.cube.sku_totals()
+
+    def sku_diversity(self):
+        """每月不同的 SKU 數量"""
+        if self.cube is None:
+            return pd.DataFrame(columns=['YearMonth', 'SKU_Count'])
+        return self.cube.sku_diversity(self.precision)
+
+    def country_totals(self):
+        """每個國家的 Revenue、Orders、Customers"""
+        if self.cube is None:
+            return pd.DataFrame(columns=['Country', 'Revenue', 'Orders', 'Customers'])
+        return self.cube.country_totals(self.precision, self._country_customers)
+
+    def customer_totals(self):
+        """每個客戶的最後購買日、唯一 Invoice 數和總金額（RFM 的輸入）"""
+        columns = ['CustomerID', 'LastPurchaseDate', 'Frequency', 'Monetary']
+        if self._customer_sums is None:
+            return pd.DataFrame(columns=columns)
+        pairs = pd.DataFrame(list(self._invoice_pairs), columns=['CustomerID', 'Invoice'])
+        invoices = pairs.groupby('CustomerID').size().reindex(self._customer_sums.index, fill_value=0)
+        result = pd.concat([self._customer_last, invoices, self._customer_sums], axis=1).sort_index().reset_index()
+        result.columns = columns
+        return result
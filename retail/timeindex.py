@@ -0,0 +1,78 @@
+"""時間索引：日期只解析一次，月份以整數鍵分組，只在輸出時格式化為 'YYYY-MM'
+
+月份鍵為 int32 的 年 * 12 + (月 - 1)，大小順序即時間順序，相鄰月份相差 1；
+明細表和交接檔中的 YearMonth 列存的是月份鍵，匯總表、工作表輸出時再由 format_months 轉為標籤。
+日期列解析後為 datetime64[ns]（即 int64 的 epoch 奈秒），之後的步驟不需要再次解析。
+"""
+import numpy as np
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+
+MONTH_COLUMN = 'YearMonth'
+MISSING_MONTH = -1
+
+# 各日期列推斷出的格式，串流模式的後續分塊沿用第一塊的格式
+_DATE_FORMATS = {}
+
+
+def parse_dates(values, name=None):
+    """將日期列解析為 datetime64；已是日期型別時不重新解析，無法解析的值為 NaT
+
+    文字日期的格式由第一個非缺失值推斷（與 pandas 相同）並按 name 快取，整列以同一個明確格式解析。
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    date_format = _DATE_FORMATS.get(name)
+    if date_format is None:
+        sample = values.dropna()
+        if len(sample) > 0 and isinstance(sample.iloc[0], str):
+            date_format = guess_datetime_format(sample.iloc[0])
+            if date_format is not None and name is not None:
+                _DATE_FORMATS[name] = date_format
+    return pd.to_datetime(values, format=date_format, errors='coerce')
+
+
+def month_keys(dates):
+    """日期列的月份鍵（int32）；缺失日期為 MISSING_MONTH"""
+    values = parse_dates(dates).to_numpy(dtype='datetime64[ns]', na_value=np.datetime64('NaT'))
+    valid = ~np.isnat(values)
+    keys = np.full(len(values), MISSING_MONTH, dtype=np.int32)
+    # datetime64[M] 是自 1970-01 起的月數
+    keys[valid] = values[valid].astype('datetime64[M]').astype(np.int64) + 1970 * 12
+    return keys
+
+
+def month_key(label):
+    """'YYYY-MM' 標籤對應的月份鍵"""
+    year, month = str(label).split('-')
+    year, month = int(year), int(month)
+    if not 1 <= month <= 12:
+        raise ValueError(f"月份超出範圍: {label}")
+    return year * 12 + month - 1
+
+
+def month_labels(keys, missing=None):
+    """月份鍵轉為 'YYYY-MM' 標籤；只對不重複的鍵格式化字串，缺失的鍵為 missing"""
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return np.array([], dtype=object)
+    uniques, inverse = np.unique(keys, return_inverse=True)
+    labels = np.array([missing if key < 0 else f'{key // 12:04d}-{key % 12 + 1:02d}' for key in uniques.astype(np.int64)],
+                      dtype=object)
+    return labels[inverse.reshape(-1)]
+
+
+def add_time_index(frame, date_col):
+    """解析日期列、移除日期無法解析的資料，並加上 YearMonth 月份鍵"""
+    frame[date_col] = parse_dates(frame[date_col], date_col)
+    frame = frame.dropna(subset=[date_col])
+    frame[MONTH_COLUMN] = month_keys(frame[date_col])
+    return frame
+
+
+def format_months(table, column=MONTH_COLUMN):
+    """輸出前將月份鍵列轉為 'YYYY-MM' 標籤；沒有此列或已是標籤時原樣回傳"""
+    if column not in table.columns or not pd.api.types.is_integer_dtype(table[column]):
+        return table
+    return table.assign(**{column: month_labels(table[column].to_numpy())})
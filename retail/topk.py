@@ -0,0 +1,106 @@
+"""前 K 名：資料在記憶體中時以 argpartition 部分選取，串流或分區執行時以 Space-Saving 追蹤
+
+top_k 與 DataFrame.nlargest(k, column) 相同（同值時保留先出現的行，缺失值排在最後），
+但只對選出的 K 行排序，不排序整張表。
+
+SpaceSaving 最多追蹤 capacity 個鍵的權重加總（例如 SKU 的 Revenue）：未追蹤的鍵被加入時，
+取代目前權重最小的鍵並繼承其權重作為誤差上限。每個鍵的真實加總在 [權重 - 誤差, 權重] 之間；
+真實加總大於 總權重 / capacity 的鍵一定會被追蹤。兩個 sketch 可以合併（各分塊、分區、子進程），
+合併後誤差上限不變。權重需為非負數。
+"""
+import numpy as np
+import pandas as pd
+
+ERROR_SUFFIX = '_Error'
+
+
+def top_k_positions(values, k):
+    """values 中最大的 k 個值的位置，由大到小；同值時位置小的在前，非缺失值不足 k 個時以缺失值依位置補足"""
+    values = np.asarray(values, dtype=float)
+    missing = np.isnan(values)
+    positions = np.flatnonzero(~missing)
+    candidates = values[positions]
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    if len(candidates) < k:
+        ordered = positions[np.lexsort((positions, -candidates))]
+        return np.concatenate([ordered, np.flatnonzero(missing)[:k - len(candidates)]])
+    if len(candidates) > k:
+        # 第 k 大的值為門檻：大於門檻的全部保留，等於門檻的依位置補足 k 個
+        threshold = candidates[np.argpartition(candidates, len(candidates) - k)[len(candidates) - k]]
+        above = positions[candidates > threshold]
+        ties = positions[candidates == threshold][:k - len(above)]
+        positions = np.concatenate([above, ties])
+        candidates = values[positions]
+    return positions[np.lexsort((positions, -candidates))]
+
+
+def top_k(frame, column, k):
+    """frame 中 column 最大的 k 行（與 nlargest(k, column) 相同），保留原索引"""
+    if len(frame) == 0:
+        return frame.copy()
+    return frame.iloc[top_k_positions(frame[column].to_numpy(dtype=float, na_value=np.nan), k)].copy()
+
+
+class SpaceSaving:
+    """按權重加總的 Space-Saving heavy hitter sketch；extras 為隨追蹤鍵一併加總的其他列
+
+    table 以鍵為索引，含 weight（權重加總上限）、error（高估上限）和 extras 各列。
+    """
+
+    def __init__(self, capacity, extras=(), table=None):
+        self.capacity = int(capacity)
+        self.extras = list(extras)
+        if table is None:
+            table = pd.DataFrame(columns=['weight', 'error'] + self.extras, dtype=float)
+        self.table = table
+
+    @classmethod
+    def from_frame(cls, frame, key_col, weight_col, capacity, extras=()):
+        """由一塊資料建立 sketch：先精確匯總，超過 capacity 個鍵時只保留權重最大的部分"""
+        sums = frame.groupby(key_col, observed=True, sort=False)[[weight_col] + list(extras)].sum()
+        table = pd.DataFrame({'weight': sums[weight_col].astype(float), 'error': 0.0})
+        for col in extras:
+            table[col] = sums[col].astype(float)
+        return cls(capacity, extras, table)._truncate()
+
+    @property
+    def floor(self):
+        """未追蹤鍵的權重上限：追蹤已滿時為最小權重，未滿時為 0（全部鍵都被追蹤）"""
+        if len(self.table) < self.capacity or len(self.table) == 0:
+            return 0.0
+        return float(self.table['weight'].min())
+
+    def _truncate(self):
+        if len(self.table) > self.capacity:
+            self.table = self.table.iloc[top_k_positions(self.table['weight'].to_numpy(), self.capacity)]
+        return self
+
+    def merge(self, other):
+        """合併另一個 sketch：一方沒有追蹤的鍵以該方的 floor 作為權重和誤差上限"""
+        if other.extras != self.extras:
+            raise ValueError(f"Space-Saving 的附加列不一致: {self.extras} != {other.extras}")
+        keys = self.table.index.union(other.table.index, sort=False)
+        left = self.table.reindex(keys)
+        right = other.table.reindex(keys)
+        table = pd.DataFrame({
+            'weight': left['weight'].fillna(self.floor) + right['weight'].fillna(other.floor),
+            'error': left['error'].fillna(self.floor) + right['error'].fillna(other.floor),
+        }, index=keys)
+        for col in self.extras:
+            table[col] = left[col].fillna(0) + right[col].fillna(0)
+        return SpaceSaving(max(self.capacity, other.capacity), self.extras, table)._truncate()
+
+    def update(self, frame, key_col, weight_col):
+        """加入一塊資料"""
+        return self.merge(SpaceSaving.from_frame(frame, key_col, weight_col, self.capacity, self.extras))
+
+    def top(self, k=None, key_name='Key', weight_name='Weight'):
+        """追蹤中權重最大的 k 個鍵（k 為 None 時全部），含 <權重列>_Error 誤差上限"""
+        positions = top_k_positions(self.table['weight'].to_numpy(), len(self.table) if k is None else k)
+        table = self.table.iloc[positions]
+        result = pd.DataFrame({key_name: table.index, weight_name: table['weight'].to_numpy()})
+        for col in self.extras:
+            result[col] = table[col].to_numpy()
+        result[weight_name + ERROR_SUFFIX] = table['error'].to_numpy()
+        return result
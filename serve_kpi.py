@@ -0,0 +1,34 @@
+import argparse
+import time
+
+from retail.service import DEFAULT_HOST, DEFAULT_PORT, load_index, make_server
+
+parser = argparse.ArgumentParser(description='Online Retail KPI 查詢服務（本機 HTTP/JSON API）')
+parser.add_argument('--host', default=DEFAULT_HOST,
+                    help=f'監聽位址（預設 {DEFAULT_HOST}，只接受本機連線）')
+parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                    help=f'監聽埠（預設 {DEFAULT_PORT}，0 表示由系統分配）')
+args = parser.parse_args()
+
+# 載入 execute_prompt.py 輸出的清理後分區，只建立一次索引
+print("=== 載入清理後的訂單並建立 KPI 索引 ===")
+started = time.perf_counter()
+index, source = load_index()
+print(f"從 {source} 載入 {index.source_rows} 行，匯總為 {len(index)} 個 (月份, Country, StockCode, CustomerID) 組合"
+      f"，耗時 {time.perf_counter() - started:.2f} 秒")
+
+server = make_server(index, source, args.host, args.port)
+host, port = server.server_address[:2]
+print(f"\n=== KPI 查詢服務已啟動: http://{host}:{port} ===")
+print("查詢範例:")
+print(f"  http://{host}:{port}/kpi?country=Germany&quarter=2011Q3&metrics=ARPU,AOV")
+print(f"  http://{host}:{port}/kpi?sku=85123A&from=2011-06&metrics=Return_Rate,Return_Frequency")
+print(f"  http://{host}:{port}/kpi?country=Germany&group_by=month")
+print(f"  http://{host}:{port}/dimensions")
+print("按 Ctrl+C 停止")
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    print("\n服務已停止")
+finally:
+    server.server_close()
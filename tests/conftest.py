@@ -0,0 +1,16 @@
+"""retail/ 模組的測試；從專案根目錄執行 python -m pytest"""
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.generate_data import RetailGenerator  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def retail_frame():
+    """與 online_retail_II.xlsx 相同欄位的合成交易資料（固定種子）"""
+    return pd.concat(RetailGenerator(20000, seed=0).chunks(), ignore_index=True)
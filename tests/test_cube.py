@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from retail.cube import OrderCube
+from retail.ingest import resolve_columns
+from retail.returns import add_return_rates
+from retail.timeindex import MONTH_COLUMN, format_months
+
+from test_dataset import _partitions
+
+
+@pytest.fixture(scope='module')
+def partitions(retail_frame):
+    return _partitions(retail_frame.copy())
+
+
+@pytest.fixture(scope='module')
+def cube(partitions, retail_frame):
+    return OrderCube.from_frames(partitions['Normal Order'], partitions['return order'],
+                                 resolve_columns(list(retail_frame.columns)))
+
+
+def _expected(partitions, keys):
+    """直接由明細分組計算的退貨率"""
+    parts = []
+    for sheet_name, is_return in (('Normal Order', False), ('return order', True)):
+        frame = partitions[sheet_name]
+        counted = frame['Quantity'].notna().astype('int64')
+        parts.append(frame[keys].assign(
+            Return_Amount=frame['Total'] if is_return else 0.0,
+            Return_Count=counted if is_return else 0,
+            Revenue=0.0 if is_return else frame['Total'],
+            Normal_Count=0 if is_return else counted,
+        ))
+    analysis = pd.concat(parts, ignore_index=True).groupby(keys, sort=True).sum().reset_index()
+    return format_months(add_return_rates(analysis))
+
+
+@pytest.mark.parametrize('dimensions, keys', [
+    (['Country', 'StockCode'], ['Country', 'StockCode']),
+    ([MONTH_COLUMN, 'CustomerID'], [MONTH_COLUMN, 'Customer ID']),
+])
+def test_project_dimension_combinations(cube, partitions, dimensions, keys):
+    result = cube.project(dimensions, names=keys)
+    expected = _expected(partitions, keys)
+    assert len(result) > len(cube.project(dimensions[0]))
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_return_rates_are_single_dimension_projections(cube):
+    rates = cube.return_rates()
+    assert list(rates) == ['StockCode', 'Customer ID', 'Country']
+    pd.testing.assert_frame_equal(rates['Country'], cube.project('Country'))
+    assert rates['Customer ID']['Return_Count'].sum() == cube.rows('return')
+
+
+def test_project_rejects_dimensions_outside_the_cube(cube):
+    with pytest.raises(ValueError):
+        cube.project(['CustomerID', 'StockCode'])
+    with pytest.raises(ValueError):
+        cube.project(['Description'])
+    assert np.isclose(cube.project('Country')['Revenue'].sum(), cube.project('StockCode')['Revenue'].sum())
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+
+from retail.cube import OrderCube
+from retail.dataset import monthly_summaries, read_dataset, read_dataset_manifest, seed_summaries, write_dataset
+from retail.ingest import resolve_columns
+from retail.timeindex import add_time_index
+
+
+def _partitions(frame):
+    frame = frame.assign(Total=frame['Quantity'] * frame['Price'])
+    valid = frame['Customer ID'].notna() & frame['Description'].notna()
+    return {
+        'Normal Order': add_time_index(frame[valid & (frame['Quantity'] >= 0)], 'InvoiceDate'),
+        'return order': add_time_index(frame[valid & (frame['Quantity'] < 0)], 'InvoiceDate'),
+        'Abnormal Order': frame[~valid],
+    }
+
+
+def test_monthly_summaries_match_cube_and_reuse_unchanged_months(retail_frame, tmp_path):
+    columns = resolve_columns(list(retail_frame.columns))
+    partitions = _partitions(retail_frame)
+    write_dataset(partitions, 'InvoiceDate', directory=tmp_path)
+    expected = OrderCube.from_frames(partitions['Normal Order'], partitions['return order'], columns).summaries()
+
+    summaries = monthly_summaries(columns, directory=tmp_path)
+    for result, table in zip(summaries['monthly'], expected['monthly']):
+        pd.testing.assert_frame_equal(result, table, check_dtype=False)
+    pd.testing.assert_frame_equal(summaries['sku_diversity'], expected['products']['sku_diversity'], check_dtype=False)
+    assert summaries['reused'] == 0
+
+    # 只改變一個月份：只有該月份重新計算
+    changed = retail_frame.drop(index=retail_frame.index[:50])
+    write_dataset(_partitions(changed), 'InvoiceDate', directory=tmp_path)
+    summaries = monthly_summaries(columns, directory=tmp_path)
+    assert summaries['computed'] == 1
+    assert summaries['reused'] == len(summaries['monthly'][0]) - 1
+
+
+def test_month_range_prunes_partitions(retail_frame, tmp_path):
+    columns = resolve_columns(list(retail_frame.columns))
+    write_dataset(_partitions(retail_frame), 'InvoiceDate', directory=tmp_path)
+    normal, returned = monthly_summaries(columns, '2010-03', '2010-05', directory=tmp_path)['monthly']
+    assert normal['YearMonth'].tolist() == ['2010-03', '2010-04', '2010-05']
+    rows, files_read, files_total = read_dataset('Normal Order', '2010-03', '2010-05', directory=tmp_path)
+    assert files_read == 3 < files_total
+    assert np.isclose(normal['Revenue'].sum(), rows['Total'].sum())
+
+
+def test_seeded_summaries_are_reused_by_month_range_queries(retail_frame, tmp_path):
+    columns = resolve_columns(list(retail_frame.columns))
+    partitions = _partitions(retail_frame)
+    write_dataset(partitions, 'InvoiceDate', directory=tmp_path)
+    expected = OrderCube.from_frames(partitions['Normal Order'], partitions['return order'], columns).summaries()
+    seeded = seed_summaries(expected['monthly'], expected['products']['sku_diversity'], columns, directory=tmp_path)
+    assert seeded == len(expected['monthly'][0])
+
+    # 範圍查詢不重新讀取任何分區，結果與由分區計算的相同
+    summaries = monthly_summaries(columns, '2010-03', '2010-05', directory=tmp_path)
+    assert summaries['computed'] == 0 and summaries['reused'] == 3
+    (tmp_path / '_summaries.json').unlink()
+    recomputed = monthly_summaries(columns, '2010-03', '2010-05', directory=tmp_path)
+    assert recomputed['computed'] == 3
+    for result, table in zip(summaries['monthly'], recomputed['monthly']):
+        pd.testing.assert_frame_equal(result, table)
+    pd.testing.assert_frame_equal(summaries['sku_diversity'], recomputed['sku_diversity'])
+
+
+def test_sheets_missing_from_a_rerun_are_removed(retail_frame, tmp_path):
+    partitions = _partitions(retail_frame)
+    write_dataset({**partitions, 'Duplicate Order': partitions['Abnormal Order']}, 'InvoiceDate', directory=tmp_path)
+    assert (tmp_path / 'duplicate_order').is_dir()
+
+    # 不使用 --dedup 重新執行：上次的 Duplicate Order 分區全部刪除
+    summary = write_dataset(partitions, 'InvoiceDate', directory=tmp_path)
+    assert not (tmp_path / 'duplicate_order').exists()
+    assert summary['Duplicate Order'][:2] == (0, 0) and summary['Duplicate Order'][2] > 0
+    assert 'Duplicate Order' not in read_dataset_manifest(tmp_path)['partitions']
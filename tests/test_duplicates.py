@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+
+from retail.duplicates import DUPLICATE_TYPE_COLUMN, duplicate_types, split_duplicates
+from retail.ingest import resolve_columns
+
+
+def _frame():
+    return pd.DataFrame({
+        'Invoice': ['1', '1', '1', '1', '2', '2', '3'],
+        'StockCode': ['A', 'A', 'A', 'A', 'A', 'A', 'B'],
+        'Quantity': [1, 1, 1, 1, 1, 2, 1],
+        'Price': [1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0],
+        'InvoiceDate': pd.to_datetime(['2011-01-01 10:00:00', '2011-01-01 10:00:00', '2011-01-01 10:00:30',
+                                       '2011-01-01 10:05:00', '2011-01-01 10:00:00', '2011-01-01 10:00:10', None]),
+    })
+
+
+def test_exact_and_near_duplicates():
+    frame = _frame()
+    columns = resolve_columns(list(frame.columns))
+    assert list(duplicate_types(frame, columns)) == [None, 'Exact', None, None, None, None, None]
+    # 30 秒後的同一 (Invoice, StockCode, Quantity) 為近似重複，5 分鐘後的不是；Quantity 不同的不比較
+    assert list(duplicate_types(frame, columns, window=60)) == [None, 'Exact', 'Near', None, None, None, None]
+    # 與同組前一筆比較：window 夠大時逐筆串連
+    assert list(duplicate_types(frame, columns, window=300)) == [None, 'Exact', 'Near', 'Near', None, None, None]
+
+
+def test_near_duplicates_compare_in_date_order():
+    frame = _frame().iloc[[3, 2, 0]].reset_index(drop=True)
+    columns = resolve_columns(list(frame.columns))
+    # 按日期排序後最早的一筆（原始的最後一行）保留
+    assert list(duplicate_types(frame, columns, window=60)) == [None, 'Near', None]
+
+
+def _brute_force(frame, columns, window):
+    key_cols = [col for col in columns.values() if col and col in frame.columns]
+    types = np.where(frame[key_cols].duplicated(keep='first'), 'Exact', None).astype(object)
+    near_cols = [columns['invoice'], columns['stockcode'], columns['quantity']]
+    dates = frame[columns['date']]
+    candidates = frame[(types == None) & dates.notna()]  # noqa: E711
+    for _, group in candidates.groupby(near_cols, sort=False):
+        group = group.sort_values(columns['date'], kind='stable')
+        gaps = group[columns['date']].diff().dt.total_seconds()
+        types[frame.index.get_indexer(group.index[(gaps <= window).to_numpy()])] = 'Near'
+    return types
+
+
+def test_matches_brute_force(retail_frame):
+    frame = retail_frame.iloc[:5000].copy()
+    frame['InvoiceDate'] = pd.to_datetime(frame['InvoiceDate'])
+    # 加入完全重複和幾秒後重新掃描的行
+    rescanned = frame.iloc[::50].assign(InvoiceDate=lambda f: f['InvoiceDate'] + pd.Timedelta(seconds=20))
+    frame = pd.concat([frame, frame.iloc[::70], rescanned], ignore_index=True)
+    columns = resolve_columns(list(frame.columns))
+
+    types = duplicate_types(frame, columns, window=60)
+    assert list(types) == list(_brute_force(frame, columns, 60))
+    assert {'Exact', 'Near'} <= set(types)
+
+    duplicates, rest = split_duplicates(frame, columns, window=60)
+    assert len(duplicates) + len(rest) == len(frame)
+    assert list(duplicates[DUPLICATE_TYPE_COLUMN]) == [t for t in types if t is not None]
+    assert not rest.duplicated().any()
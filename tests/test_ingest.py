@@ -0,0 +1,25 @@
+import pandas as pd
+
+from retail.ingest import check_cache, load_source, projection, read_header, resolve_columns
+
+
+def test_first_parse_only_reads_projected_columns(retail_frame, tmp_path):
+    source = tmp_path / 'wide.csv'
+    retail_frame.iloc[:500].assign(Note='x', Extra=1.5).to_csv(source, index=False)
+    header = read_header(str(source))
+    columns = projection(header, resolve_columns(header))
+    assert 'Note' not in columns
+
+    df = load_source(str(source), columns=columns)
+    meta = check_cache(str(source))
+    assert meta['columns'] == header
+    assert meta['cached_columns'] == columns
+    # 列名仍可由快取取得；快取有的列直接載入
+    assert read_header(str(source)) == header
+    pd.testing.assert_frame_equal(load_source(str(source), columns=columns), df)
+
+    # 需要快取沒有的列時重新解析，並與快取原有的列合併保存
+    extended = load_source(str(source), columns=columns[:2] + ['Note'])
+    assert list(extended.columns) == columns[:2] + ['Note']
+    assert check_cache(str(source))['cached_columns'] == [col for col in header if col in set(columns) | {'Note'}]
+    assert list(load_source(str(source)).columns) == header
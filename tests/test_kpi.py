@@ -0,0 +1,91 @@
+import pandas as pd
+import pytest
+
+from retail.kpi import (KpiState, aov_arpu_table, append_source, apply_aov_arpu, apply_growth, merge_monthly,
+                        monthly_kpis_table)
+from retail.stream import StreamingAggregator
+
+COLUMNS = ('Quantity', 'Price', 'Customer ID', 'Description', 'InvoiceDate')
+
+
+def _aggregate(frame):
+    aggregator = StreamingAggregator(*COLUMNS)
+    aggregator.update(frame)
+    return aggregator
+
+
+def _full_kpis(frame):
+    """與完整執行相同：月度匯總 -> 合併 -> 全部重算增長率和 AOV/ARPU"""
+    aggregator = _aggregate(frame)
+    kpis = merge_monthly(aggregator.monthly('normal'), aggregator.monthly('return'))
+    apply_growth(kpis)
+    apply_aov_arpu(kpis)
+    return aggregator, kpis
+
+
+def _build_state(frame):
+    aggregator, kpis = _full_kpis(frame)
+    return KpiState.build(aggregator.monthly('normal'), aggregator.monthly('return'),
+                          aggregator.monthly_customers('normal'), aggregator.monthly_customers('return'), kpis)
+
+
+def _assert_same_as_rebuild(state, frame):
+    _, expected = _full_kpis(frame)
+    pd.testing.assert_frame_equal(monthly_kpis_table(state.kpis), monthly_kpis_table(expected), check_dtype=False)
+    pd.testing.assert_frame_equal(aov_arpu_table(state.kpis), aov_arpu_table(expected), check_dtype=False)
+
+
+@pytest.fixture
+def months(retail_frame):
+    return pd.to_datetime(retail_frame['InvoiceDate']).dt.strftime('%Y-%m')
+
+
+def test_append_new_month_matches_full_rebuild(retail_frame, months, tmp_path):
+    last = months.max()
+    history, new = retail_frame[months < last], retail_frame[months == last]
+    state = _build_state(history)
+    new.to_csv(tmp_path / 'new.csv', index=False)
+
+    assert append_source(state, str(tmp_path / 'new.csv')) == [last]
+    _assert_same_as_rebuild(state, pd.concat([history, new]))
+
+
+def test_append_late_rows_of_existing_months_matches_full_rebuild(retail_frame, months, tmp_path):
+    # 已有月份的補登資料：該月和下一期的增長率都要重算
+    late = retail_frame.index.isin(retail_frame[months.isin(['2010-03', '2010-07'])].index[::3])
+    history, new = retail_frame[~late], retail_frame[late]
+    state = _build_state(history)
+    new.to_csv(tmp_path / 'late.csv', index=False)
+
+    assert append_source(state, str(tmp_path / 'late.csv')) == ['2010-03', '2010-07']
+    _assert_same_as_rebuild(state, pd.concat([history, new]))
+
+
+def test_append_rejects_same_file_twice(retail_frame, months, tmp_path):
+    last = months.max()
+    state = _build_state(retail_frame[months < last])
+    retail_frame[months == last].to_csv(tmp_path / 'new.csv', index=False)
+    append_source(state, str(tmp_path / 'new.csv'))
+    with pytest.raises(ValueError):
+        append_source(state, str(tmp_path / 'new.csv'))
+
+
+@pytest.mark.parametrize('built, requested', [
+    ({'dedup': True, 'dedup_window': None}, None),
+    ({'dedup': True, 'dedup_window': 60.0}, {'dedup': True, 'dedup_window': 60.0}),
+    (None, {'dedup': True, 'dedup_window': None}),
+    ({'parts': 2}, None),
+])
+def test_append_refuses_options_it_cannot_reproduce(retail_frame, months, tmp_path, built, requested):
+    # 重複交易和部分之間的重疊要與所有歷史資料比對，只讀取新檔案無法得到與完整重算相同的結果
+    last = months.max()
+    aggregator, kpis = _full_kpis(retail_frame[months < last])
+    state = KpiState.build(aggregator.monthly('normal'), aggregator.monthly('return'),
+                           aggregator.monthly_customers('normal'), aggregator.monthly_customers('return'), kpis,
+                           options=built)
+    state.save(tmp_path / 'state')
+    state = KpiState.load(tmp_path / 'state')
+    retail_frame[months == last].to_csv(tmp_path / 'new.csv', index=False)
+    with pytest.raises(ValueError):
+        append_source(state, str(tmp_path / 'new.csv'), options=requested)
+    assert state.sources == []
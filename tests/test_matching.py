@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from retail.ingest import resolve_columns
+from retail.matching import LATENCY_BUCKETS, LINE_ORDER, latency_tables, match_returns
+
+
+def _brute_force(sales, returns):
+    """逐筆退貨掃描所有銷售：同一客戶、同一 StockCode、日期不晚於退貨的最後一筆（日期相同取原始順序的最後一筆）"""
+    rows = []
+    for _, line in returns.iterrows():
+        candidates = sales[(sales['Customer ID'] == line['Customer ID']) & (sales['StockCode'] == line['StockCode'])
+                           & (sales['InvoiceDate'] <= line['InvoiceDate'])]
+        candidates = candidates[candidates['InvoiceDate'] == candidates['InvoiceDate'].max()]
+        sale = candidates.iloc[-1] if len(candidates) and pd.notna(line['Customer ID']) else None
+        rows.append({
+            'Invoice': line['Invoice'], 'StockCode': line['StockCode'], 'Quantity': line['Quantity'],
+            'Return_Date': line['InvoiceDate'],
+            'Sale_Invoice': None if sale is None else sale['Invoice'],
+            'Sale_Date': pd.NaT if sale is None else sale['InvoiceDate'],
+        })
+    return pd.DataFrame(rows).sort_values(LINE_ORDER, kind='stable').reset_index(drop=True)
+
+
+def test_matches_brute_force(retail_frame):
+    frame = retail_frame.iloc[:6000].copy()
+    frame['InvoiceDate'] = pd.to_datetime(frame['InvoiceDate'])
+    sales = frame[frame['Quantity'] > 0]
+    # 合成資料的退貨不對應任何銷售：另外由部分銷售產生幾天後的退貨（同一 Invoice 的多行在同一時間，測試日期相同的情況）
+    later = sales.iloc[::40].copy()
+    later['Invoice'] = 'C' + later['Invoice'].astype(str)
+    later['Quantity'] = -later['Quantity']
+    later['InvoiceDate'] += pd.to_timedelta(np.arange(len(later)) % 120, unit='D')
+    returns = pd.concat([frame[frame['Quantity'] < 0], later], ignore_index=True)
+    columns = resolve_columns(list(frame.columns))
+
+    lines = match_returns(sales, returns, columns)
+    expected = _brute_force(sales, returns)
+    assert len(lines) == len(returns)
+    assert lines['Sale_Invoice'].notna().any() and lines['Sale_Invoice'].isna().any()
+    dtypes = {'Sale_Invoice': object, 'Return_Date': 'datetime64[ns]', 'Sale_Date': 'datetime64[ns]'}
+    pd.testing.assert_frame_equal(lines[expected.columns].astype(dtypes), expected.astype(dtypes), check_dtype=False)
+    latency = (expected['Return_Date'] - expected['Sale_Date']).dt.total_seconds() / 86400
+    np.testing.assert_allclose(lines['Latency_Days'], latency)
+
+
+def test_latency_buckets_and_unmatched():
+    sales = pd.DataFrame({
+        'Invoice': ['S1', 'S2', 'S3'], 'StockCode': ['A', 'A', 'B'], 'Customer ID': [1.0, 1.0, 2.0],
+        'Country': ['UK'] * 3, 'Quantity': [5, 5, 5],
+        'InvoiceDate': pd.to_datetime(['2011-01-01', '2011-02-01', '2011-01-01']),
+    })
+    returns = pd.DataFrame({
+        'Invoice': ['C1', 'C2', 'C3', 'C4'], 'StockCode': ['A', 'A', 'B', 'B'], 'Customer ID': [1.0, 1.0, 2.0, 3.0],
+        'Country': ['UK', 'UK', 'UK', 'France'], 'Quantity': [-1, -1, -1, -1],
+        'InvoiceDate': pd.to_datetime(['2011-01-08', '2011-02-05', '2011-06-01', '2011-06-01']),
+    })
+    tables = latency_tables(match_returns(sales, returns, resolve_columns(list(sales.columns))))
+
+    lines = tables['lines'].set_index('Invoice')
+    # 剛好 7 天落在 Within_7_Days（右閉）；C2 配對最近的 S2 而不是 S1；C4 的客戶沒有銷售
+    assert list(lines['Sale_Invoice'].fillna('-')) == ['S1', 'S2', 'S3', '-']
+    assert list(lines['Latency_Days'].fillna(-1)) == [7.0, 4.0, 151.0, -1.0]
+    assert list(lines['Matched']) == [True, True, True, False]
+
+    product = tables['product'].set_index('StockCode')
+    assert product.loc['A', list(LATENCY_BUCKETS)].tolist() == [2, 0, 0, 0]
+    assert product.loc['B', list(LATENCY_BUCKETS)].tolist() == [0, 0, 0, 1]
+    assert product.loc['B', 'Unmatched'] == 1
+    assert product.loc['B', 'Unmatched_Rate'] == pytest.approx(0.5)
+    country = tables['country'].set_index('Country')
+    assert country.loc['France', 'Matched'] == 0 and np.isnan(country.loc['France', 'Latency_Mean'])
@@ -0,0 +1,56 @@
+import pandas as pd
+
+from retail.parts import combine_parts, expand_sources, unify_dtypes
+
+
+def _frame(codes):
+    return pd.DataFrame({'StockCode': codes, 'Quantity': [1] * len(codes)})
+
+
+def test_overlap_keeps_max_count_across_parts():
+    # 每一行在合併結果中出現的次數是它在任一部分中出現的最多次數
+    first = _frame(['a', 'a', 'b', 'c'])
+    second = _frame(['a', 'b', 'b', 'd', 'a', 'a'])
+    combined, removed = combine_parts([first, second])
+    assert list(combined['StockCode']) == ['a', 'a', 'b', 'c', 'b', 'd', 'a']
+    assert removed == 3
+
+
+def test_overlap_uses_all_earlier_parts():
+    parts = [_frame(['a']), _frame(['a', 'a']), _frame(['a', 'a', 'b']), _frame(['a'])]
+    combined, removed = combine_parts(parts)
+    assert sorted(combined['StockCode']) == ['a', 'a', 'b']
+    assert removed == 4
+
+
+def test_overlap_compares_whole_rows():
+    first = _frame(['a', 'b'])
+    second = _frame(['a', 'b']).assign(Quantity=[1, 2])
+    combined, removed = combine_parts([first, second])
+    assert combined.to_dict('list') == {'StockCode': ['a', 'b', 'b'], 'Quantity': [1, 1, 2]}
+    assert removed == 1
+
+
+def test_unify_dtypes():
+    first = pd.DataFrame({'StockCode': pd.Categorical(['85123A', 'X']), 'Country': pd.Categorical(['UK', 'UK']),
+                          'Price': [1.0, 2.0]})
+    second = pd.DataFrame({'StockCode': [85123, 22423], 'Country': pd.Categorical(['France', 'UK'])})
+    first, second = unify_dtypes([first, second])
+    # categorical 字典取聯集；categorical 與數字混合時還原為值再統一為字串；缺少的列補為缺失值
+    assert isinstance(first['Country'].dtype, pd.CategoricalDtype)
+    assert set(first['Country'].cat.categories) == set(second['Country'].cat.categories) == {'UK', 'France'}
+    assert list(second['StockCode']) == ['85123', '22423']
+    assert list(first['StockCode']) == ['85123A', 'X']
+    assert second['Price'].isna().all()
+    combined = pd.concat([first, second], ignore_index=True)
+    assert isinstance(combined['Country'].dtype, pd.CategoricalDtype)
+
+
+def test_expand_sources(tmp_path):
+    with pd.ExcelWriter(tmp_path / 'years.xlsx') as writer:
+        _frame(['a']).to_excel(writer, sheet_name='2010', index=False)
+        _frame(['b']).to_excel(writer, sheet_name='2011', index=False)
+    _frame(['c']).to_csv(tmp_path / 'extra.csv', index=False)
+    parts = expand_sources([str(tmp_path / 'years.xlsx'), str(tmp_path / '*.csv')])
+    assert parts == [(str(tmp_path / 'years.xlsx'), '2010'), (str(tmp_path / 'years.xlsx'), '2011'),
+                     (str(tmp_path / 'extra.csv'), None)]
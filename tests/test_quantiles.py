@@ -0,0 +1,88 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from retail.quantiles import KLLSketch, QuantileScorer, quantile_scores
+from retail.rfm import score_rfm
+
+
+def test_scores_match_qcut_without_ties():
+    values = pd.Series(np.random.default_rng(0).normal(size=1000))
+    scores, scorer = quantile_scores(values)
+    expected = pd.qcut(values, 5, labels=[1, 2, 3, 4, 5]).astype(int).to_numpy()
+    assert (scores == expected).all()
+    assert not scorer.has_duplicate_edges
+
+
+def test_reverse_scores():
+    values = pd.Series(np.arange(100))
+    scores, _ = quantile_scores(values, reverse=True)
+    assert scores[0] == 5 and scores[-1] == 1
+
+
+def _baseline_scores(values, reverse=False):
+    """原本 execute_prompt.py 的做法：qcut 無法分成 5 組時改以 rank(method='first') 分組"""
+    try:
+        scores = pd.qcut(values, q=5, labels=[1, 2, 3, 4, 5], duplicates='drop').astype(int)
+    except ValueError:
+        scores = pd.qcut(values.rank(method='first'), q=5, labels=[1, 2, 3, 4, 5], duplicates='drop').astype(int)
+    return (6 - scores if reverse else scores).to_numpy()
+
+
+def test_tied_frequency_matches_baseline_rank_tie_break():
+    # 大部分客戶只有 1 張 Invoice，分位點 0.2、0.4 都落在 1
+    rng = np.random.default_rng(5)
+    values = pd.Series(rng.permutation([1] * 60 + [2] * 15 + [3] * 10 + list(range(4, 19))))
+    scores, scorer = quantile_scores(values)
+    assert scorer.has_duplicate_edges
+    assert (scores == _baseline_scores(values)).all()
+    assert sorted(set(scores)) == [1, 2, 3, 4, 5]
+    # edges 仍是指標的值；新客戶的原始值以值評分，相同的值落在包含它的最低一組
+    assert scorer.edges[0] == 1 and scorer.edges[-1] == 18
+    assert list(scorer.score([1, 2, 18])) == [1, 4, 5]
+    reversed_scores, _ = quantile_scores(values, reverse=True)
+    assert (reversed_scores == _baseline_scores(values, reverse=True)).all()
+
+
+def test_saved_boundaries_reproduce_scores():
+    rng = np.random.default_rng(1)
+    rfm = pd.DataFrame({
+        'Recency': rng.integers(0, 400, 500),
+        'Frequency': np.where(rng.random(500) < 0.5, 1, rng.integers(1, 60, 500)),
+        'Monetary': rng.gamma(2, 300, 500).round(2),
+    })
+    scorers = json.loads(json.dumps(score_rfm(rfm)))
+    assert scorers['Frequency']['rank_edges'] is not None and scorers['Monetary']['rank_edges'] is None
+    for metric, score_col, reverse in (('Recency', 'R_Score', True), ('Frequency', 'F_Score', False),
+                                       ('Monetary', 'M_Score', False)):
+        assert (rfm[score_col].to_numpy() == _baseline_scores(rfm[metric], reverse)).all()
+        restored = QuantileScorer.from_dict(scorers[metric])
+        if restored.rank_edges is None:
+            restored_scores = restored.score(rfm[metric])
+        else:
+            restored_scores = restored.score_ranks(rfm[metric].rank(method='first'))
+        assert (restored_scores == rfm[score_col].to_numpy()).all()
+
+
+def test_sketch_keeps_duplicate_edges_in_value_space():
+    values = pd.Series([1] * 600 + list(range(2, 402)))
+    scores, scorer = quantile_scores(values, sketch_k=50)
+    assert scorer.rank_edges is None
+    assert set(scores[values == 1]) == {1}
+
+
+def test_exact_sketch_matches_percentile():
+    values = np.random.default_rng(3).exponential(size=2000)
+    sketch = KLLSketch(k=len(values)).update(values[:1000]).merge(KLLSketch(k=len(values)).update(values[1000:]))
+    qs = np.linspace(0, 1, 6)
+    assert np.allclose(sketch.quantile(qs), np.percentile(values, qs * 100))
+
+
+def test_compressed_sketch_rank_error():
+    values = np.random.default_rng(4).lognormal(size=50000)
+    sketch = KLLSketch(k=200)
+    for chunk in np.array_split(values, 10):
+        sketch.update(chunk)
+    ranks = np.searchsorted(np.sort(values), sketch.quantile([0.2, 0.4, 0.6, 0.8])) / len(values)
+    assert np.abs(ranks - [0.2, 0.4, 0.6, 0.8]).max() < 0.03
@@ -0,0 +1,141 @@
+import json
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from retail.cube import OrderCube
+from retail.ingest import resolve_columns
+from retail.kpi import apply_aov_arpu, apply_growth, merge_monthly, monthly_kpis_table
+from retail.service import KpiIndex, make_server, parse_query
+from retail.timeindex import MISSING_MONTH, MONTH_COLUMN, month_key
+
+from test_dataset import _partitions
+
+
+@pytest.fixture(scope='module')
+def partitions(retail_frame):
+    return _partitions(retail_frame.copy())
+
+
+@pytest.fixture(scope='module')
+def index(partitions):
+    return KpiIndex(partitions['Normal Order'], partitions['return order'])
+
+
+@pytest.fixture(scope='module')
+def server(index):
+    server = make_server(index, 'test', port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://%s:%d' % server.server_address[:2]
+    server.shutdown()
+    server.server_close()
+
+
+def _get(url):
+    try:
+        with urlopen(url) as response:
+            return response.status, json.loads(response.read())
+    except HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def _expected(normal, returns):
+    """篩選後的交易行直接計算的 KPI"""
+    revenue = normal['Total'].sum()
+    return {
+        'Revenue': round(revenue, 2),
+        'Return': round(returns['Total'].sum(), 2),
+        'Normal_Orders': int(normal['Total'].notna().sum()),
+        'Return_Orders': int(returns['Total'].notna().sum()),
+        'Customer': int(normal['Customer ID'].nunique()),
+    }
+
+
+def _assert_kpi(result, normal, returns):
+    for metric, value in _expected(normal, returns).items():
+        assert result[metric] == pytest.approx(value, abs=0.011), metric
+
+
+def test_group_by_month_matches_monthly_kpi_table(server, partitions, retail_frame):
+    summaries = OrderCube.from_frames(partitions['Normal Order'], partitions['return order'],
+                                      resolve_columns(list(retail_frame.columns))).summaries()
+    kpis = merge_monthly(*summaries['monthly'])
+    apply_growth(kpis)
+    apply_aov_arpu(kpis)
+    expected = monthly_kpis_table(kpis).merge(kpis[['YearMonth', 'AOV', 'ARPU']], on='YearMonth')
+
+    status, body = _get(f'{server}/kpi?group_by=month')
+    assert status == 200
+    result = pd.DataFrame(body['rows']).rename(columns={'month': 'YearMonth'})
+    columns = ['YearMonth', 'Gross_Revenue', 'Return', 'Revenue', 'Gross_Orders', 'Return_Orders', 'Normal_Orders',
+               'Customer', 'AOV', 'ARPU']
+    pd.testing.assert_frame_equal(result[columns], expected[columns], check_dtype=False)
+
+
+def test_filters_match_direct_computation(server, partitions):
+    normal, returns = partitions['Normal Order'], partitions['return order']
+    q3 = (month_key('2011-07'), month_key('2011-09'))
+
+    def subset(frame, countries=None, skus=None, months=None):
+        mask = pd.Series(True, index=frame.index)
+        if countries is not None:
+            mask &= frame['Country'].isin(countries)
+        if skus is not None:
+            mask &= frame['StockCode'].astype(str).isin(skus)
+        if months is not None:
+            mask &= frame[MONTH_COLUMN].between(*months)
+        return frame[mask]
+
+    cases = [
+        ('country=Germany,France&quarter=2011Q3', dict(countries=['Germany', 'France'], months=q3)),
+        ('sku=87283&from=2010-06', dict(skus=['87283'], months=(month_key('2010-06'), np.inf))),
+        ('country=EIRE&sku=99304V,23400&to=2010-12',
+         dict(countries=['EIRE'], skus=['99304V', '23400'], months=(-np.inf, month_key('2010-12')))),
+        ('from=2011-02&to=2011-02', dict(months=(month_key('2011-02'),) * 2)),
+    ]
+    for query, filters in cases:
+        status, body = _get(f'{server}/kpi?{query}')
+        assert status == 200, query
+        _assert_kpi(body['kpi'], subset(normal, **filters), subset(returns, **filters))
+
+
+def test_unknown_filter_values_select_nothing(server):
+    status, body = _get(f'{server}/kpi?country=Atlantis&metrics=Revenue,Customer')
+    assert status == 200
+    assert body['kpi'] == {'Revenue': 0.0, 'Customer': 0}
+
+
+@pytest.mark.parametrize('query', ['quarter=2011Q5', 'quarter=2011-3', 'from=2011-13', 'to=soon',
+                                   'metrics=Revenue,Profit', 'group_by=week'])
+def test_bad_input_returns_400(server, query):
+    status, body = _get(f'{server}/kpi?{query}')
+    assert status == 400
+    assert body['error']
+
+
+def test_parse_query_quarter_bounds():
+    filters, group_by, metrics = parse_query({'quarter': ['2011q4'], 'country': ['Germany, France,'],
+                                              'metrics': ['AOV,ARPU']})
+    assert (filters['from'], filters['to']) == ('2011-10', '2011-12')
+    assert filters['country'] == ['Germany', 'France']
+    assert group_by is None and metrics == ['AOV', 'ARPU']
+
+
+def test_missing_month_rows_only_counted_without_month_range(partitions):
+    normal = partitions['Normal Order']
+    undated = normal.iloc[:5].assign(**{MONTH_COLUMN: np.int32(MISSING_MONTH)})
+    index = KpiIndex(pd.concat([undated, normal], ignore_index=True), partitions['return order'])
+    first = normal[MONTH_COLUMN].min()
+
+    everything = index.query(metrics=['Revenue']).iloc[0]['Revenue']
+    assert everything == pytest.approx(round(normal['Total'].sum() + undated['Total'].sum(), 2))
+    # 範圍從最早的月份開始時，月份鍵 -1 的行不在範圍內
+    ranged = index.query({'to': '2011-12'}, metrics=['Revenue']).iloc[0]['Revenue']
+    assert ranged == pytest.approx(round(normal['Total'].sum(), 2))
+    rows = index.select({'from': f'{first // 12:04d}-{first % 12 + 1:02d}'})
+    assert (index.codes['month'][rows] >= 0).all()
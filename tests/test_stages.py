@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from retail.cube import OrderCube
+from retail.handoff import write_partitions
+from retail.ingest import resolve_columns, to_arrow_safe
+from retail.stages import PROMPT_STAGES, RETURN_ABNORMAL_STAGES, run_stages
+
+from test_dataset import _partitions
+
+
+def _assert_same(parallel, sequential):
+    if isinstance(sequential, pd.DataFrame):
+        # 文字列在子進程中是 Arrow 字串，與 object 只有型別不同；數字和日期列的型別必須相同
+        pd.testing.assert_frame_equal(parallel.reset_index(drop=True), sequential.reset_index(drop=True),
+                                      check_exact=True, check_dtype=False)
+        kinds = sequential.select_dtypes(['number', 'datetime']).columns
+        assert parallel[kinds].dtypes.to_dict() == sequential[kinds].dtypes.to_dict()
+        # 輸出前的四捨五入也要一致（ArrowDtype 上的 round(2) 會留下 946.5699999999999 之類的值）
+        numeric = sequential.select_dtypes('number').columns
+        np.testing.assert_array_equal(parallel[numeric].round(2).to_numpy(), sequential[numeric].round(2).to_numpy())
+    elif isinstance(sequential, OrderCube):
+        _assert_same(parallel.cells, sequential.cells)
+        _assert_same(parallel.customers, sequential.customers)
+    elif isinstance(sequential, (dict, tuple)):
+        items = sequential.items() if isinstance(sequential, dict) else enumerate(sequential)
+        for key, value in items:
+            _assert_same(parallel[key], value)
+    else:
+        assert parallel == sequential
+
+
+@pytest.mark.parametrize('stages', [PROMPT_STAGES, RETURN_ABNORMAL_STAGES], ids=['prompt', 'return_abnormal'])
+def test_workers_match_sequential(retail_frame, tmp_path, stages):
+    # 與 execute_prompt.py 相同：載入時混合型別的列（StockCode、Invoice）已轉為字串
+    partitions = _partitions(to_arrow_safe(retail_frame.copy()))
+    columns = resolve_columns(list(retail_frame.columns))
+    write_partitions(partitions, directory=tmp_path)
+
+    sequential = run_stages(stages, partitions, columns)
+    parallel = run_stages(stages, partitions, columns, workers=2, directory=tmp_path)
+    _assert_same(parallel, sequential)
@@ -0,0 +1,35 @@
+import pytest
+
+from retail.stream import StreamingAggregator
+
+COLUMNS = ('Quantity', 'Price', 'Customer ID', 'Description', 'InvoiceDate', 'StockCode', 'Country', 'Invoice')
+
+
+def _customer_frequency(frame, chunk_rows):
+    aggregator = StreamingAggregator(*COLUMNS)
+    for start in range(0, len(frame), chunk_rows):
+        aggregator.update(frame.iloc[start:start + chunk_rows])
+    return aggregator.customer_totals().set_index('CustomerID')['Frequency']
+
+
+def _expected_frequency(frame):
+    normal = frame[frame['Customer ID'].notna() & frame['Description'].notna() & (frame['Quantity'] >= 0)]
+    return normal.groupby('Customer ID')['Invoice'].nunique()
+
+
+@pytest.mark.parametrize('chunk_rows', [13, 500, 100000])
+def test_frequency_matches_full_mode(retail_frame, chunk_rows):
+    # 很小的分塊使同一張 Invoice 跨越多個分塊
+    retail_frame = retail_frame.iloc[:4000]
+    expected = _expected_frequency(retail_frame)
+    frequency = _customer_frequency(retail_frame, chunk_rows)
+    assert frequency.reindex(expected.index).tolist() == expected.tolist()
+
+
+@pytest.mark.parametrize('chunk_rows', [500, 5000])
+def test_frequency_is_exact_when_invoices_are_not_grouped(retail_frame, chunk_rows):
+    # 打亂後同一張 Invoice 的交易行分散在不同位置和分塊
+    shuffled = retail_frame.sample(frac=1, random_state=0)
+    expected = _expected_frequency(shuffled)
+    frequency = _customer_frequency(shuffled, chunk_rows)
+    assert frequency.reindex(expected.index).tolist() == expected.tolist()